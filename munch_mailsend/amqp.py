@@ -1,3 +1,5 @@
+import time
+
 from django.conf import settings
 from kombu import Queue
 from kombu import Exchange
@@ -13,3 +15,54 @@ def get_queue(connection, name):
 
 def get_queue_size(queue):
     return queue.queue_declare(passive=True).message_count
+
+
+def get_task_signature(body):
+    """ Return (args, kwargs) of a task message body """
+    if isinstance(body, (list, tuple)):
+        return list(body[0]), dict(body[1])
+    return list(body.get('args') or []), dict(body.get('kwargs') or {})
+
+
+def get_confirmed_connection(app):
+    """ Broker connection whose publications wait for broker confirms """
+    transport_options = dict(
+        app.conf.BROKER_TRANSPORT_OPTIONS or {}, confirm_publish=True)
+    return app.connection(transport_options=transport_options)
+
+
+def drain_queue(app, channel, queue, republish, batch_size=100, rate=None):
+    """
+    Move messages of `queue` elsewhere with `republish(producer, body)`.
+
+    Messages are fetched `batch_size` at a time with basic_get,
+    republished through a single producer and acked once per batch, so a
+    crash never loses them (at worst they are republished twice).
+    `rate` caps republished messages per second. Returns the number of
+    moved messages.
+    """
+    queue = queue.bind(channel)
+    producer = app.amqp.TaskProducer(channel)
+    moved = 0
+    while True:
+        started = time.monotonic()
+        messages = []
+        while len(messages) < batch_size:
+            message = queue.get(no_ack=False)
+            if message is None:
+                break
+            messages.append(message)
+        if not messages:
+            break
+
+        for message in messages:
+            republish(producer, message.payload)
+        channel.basic_ack(messages[-1].delivery_tag, multiple=True)
+        moved += len(messages)
+
+        if len(messages) < batch_size:
+            break
+        if rate:
+            time.sleep(max(0, len(messages) / rate - (
+                time.monotonic() - started)))
+    return moved
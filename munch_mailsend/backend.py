@@ -1,6 +1,9 @@
 import logging
 
+from celery import current_app
 from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
 from django.core.mail.backends.base import BaseEmailBackend
 from django.utils.module_loading import import_string
 
@@ -9,9 +12,15 @@ from munch.core.mail.utils import mk_base64_uuid
 from munch.core.mail.models import AbstractMailStatus
 
 from .models import Mail
-from .models import RawMail
+from .models import RawMailDigest
 from .tasks import route_envelope
 from .utils import message_to_envelope
+from .utils import normalize_line_endings
+from .utils.lanes import get_lane
+from .utils.lanes import get_routing_options
+from .utils.payloads import TaskBackend
+from .utils.payloads import encode_backend
+from .utils.payloads import get_routing_headers
 
 log = logging.getLogger(__name__)
 
@@ -30,16 +39,22 @@ class Backend(BaseEmailBackend):
         self.get_envelope = import_string(self.build_envelope_task_path)
         self.mailstatus_class = import_string(self.mailstatus_class_path)
         self.record_status_task = import_string(self.record_status_task_path)
+        self.task_kwargs = encode_backend(TaskBackend(
+            self.mailstatus_class_path, self.record_status_task_path,
+            self.build_envelope_task_path))
 
         self.sandbox = settings.MAILSEND['SANDBOX']
 
-    def _route(self, identifier, headers, attempts, priority=50):
+    def _route(
+            self, identifier, headers, attempts, priority=50, producer=None):
+        lane = get_lane(priority)
+        kwargs = self.task_kwargs
+        if lane:
+            kwargs = dict(kwargs, lane=lane)
         return route_envelope.apply_async(
-            (identifier, headers, attempts), {
-                'mailstatus_class_path': self.mailstatus_class_path,
-                'record_status_task_path': self.record_status_task_path,
-                'build_envelope_task_path': self.build_envelope_task_path},
-            priority=priority).id
+            (identifier, get_routing_headers(headers), attempts),
+            kwargs, priority=priority, producer=producer,
+            **get_routing_options(lane)).id
 
     def _handle_sandbox(self, identifier, recipient):
         log.info('Ignoring {} envelope because SANDBOX is enabled'.format(
@@ -80,27 +95,110 @@ class Backend(BaseEmailBackend):
     def send_messages(self, email_messages):
         if not email_messages:
             return
+        # Each message goes through record_status_task and model signals,
+        # use send_envelopes_bulk() explicitly to skip them
         num_sent = 0
         for message in email_messages:
-            if self.send_simple_message(message, system=True):
-                num_sent += 1
+            self.send_simple_message(message, system=True)
+            num_sent += 1
         return num_sent
 
+    def _get_identifier(self, envelope):
+        identifier = envelope.headers.get(
+            settings.MAILSEND['X_MESSAGE_ID_HEADER'])
+        if identifier is None:
+            identifier = mk_base64_uuid()
+            envelope.headers.add_header(
+                settings.MAILSEND['X_MESSAGE_ID_HEADER'], identifier)
+        return identifier
+
+    def send_envelopes_bulk(self, envelopes, priority=50, chunk_size=1000):
+        """
+        Queue many envelopes at once (eg. a campaign)
+
+        Envelopes are handled by chunks: Mail and QUEUED MailStatus rows
+        are inserted with bulk_create (bypassing model signals, including
+        munch-core hooks and worker policies, and record_status_task), so
+        it must be called explicitly: send_messages() never uses it.
+        Identical bodies share one RawMail and routing tasks of a chunk
+        are published through a single producer.
+
+        Returns the number of queued envelopes.
+        """
+        count = 0
+        chunk = []
+        for envelope in envelopes:
+            chunk.append(envelope)
+            if len(chunk) >= chunk_size:
+                count += self._send_envelopes_chunk(chunk, priority)
+                chunk = []
+        if chunk:
+            count += self._send_envelopes_chunk(chunk, priority)
+        return count
+
+    def _send_envelopes_chunk(self, envelopes, priority):
+        messages = {}
+        mails = []
+        for envelope in envelopes:
+            identifier = self._get_identifier(envelope)
+            envelope.message = normalize_line_endings(envelope.message)
+            digest = RawMailDigest.objects.get_digest(envelope.message)
+            messages[digest] = envelope.message
+            mails.append((digest, Mail(
+                identifier=identifier, headers=dict(envelope.headers),
+                sender=envelope.sender, recipient=envelope.recipients[0])))
+
+        now = timezone.now()
+        with transaction.atomic():
+            # Digests stay locked until mails are inserted: take them in
+            # the same order in every chunk to avoid deadlocks
+            raw_mails = {
+                digest: RawMailDigest.objects.get_or_create_raw_mail(
+                    messages[digest])[0] for digest in sorted(messages)}
+            for digest, mail in mails:
+                mail.message = raw_mails[digest]
+            mails = Mail.objects.bulk_create([mail for _, mail in mails])
+            if any(mail.pk is None for mail in mails):
+                # Primary keys are not set back by every Django version
+                pks = dict(Mail.objects.filter(
+                    identifier__in=[m.identifier for m in mails]).values_list(
+                        'identifier', 'pk'))
+                for mail in mails:
+                    mail.pk = pks[mail.identifier]
+            self.mailstatus_class.objects.bulk_create([
+                self.mailstatus_class(
+                    mail=mail, status=AbstractMailStatus.QUEUED,
+                    creation_date=now,
+                    source_ip=settings.MAILSEND.get('SMTP_WORKER_SRC_ADDR'),
+                    destination_domain=extract_domain(mail.recipient))
+                for mail in mails])
+
+        if self.sandbox:
+            for mail in mails:
+                self._handle_sandbox(mail.identifier, mail.recipient)
+            return len(mails)
+
+        with current_app.producer_or_acquire() as producer:
+            for mail in mails:
+                self._route(
+                    mail.identifier, mail.headers, 0,
+                    priority=priority, producer=producer)
+        return len(mails)
+
     def send_simple_envelope(self, envelope, identifier=None, priority=50):
         if not identifier:
-            identifier = envelope.headers.get(
-                settings.MAILSEND['X_MESSAGE_ID_HEADER'])
-            if identifier is None:
-                identifier = mk_base64_uuid()
-                envelope.headers.add_header(
-                    settings.MAILSEND['X_MESSAGE_ID_HEADER'], identifier)
-
-        raw_mail, created = RawMail.objects.get_or_create(
-            content=envelope.message)
-        mail = Mail.objects.create(
-            identifier=identifier,
-            headers=dict(envelope.headers), message=raw_mail,
-            sender=envelope.sender, recipient=envelope.recipients[0])
+            identifier = self._get_identifier(envelope)
+
+        # Store the normalized body so that every (re)build of this
+        # envelope reuses it as-is
+        envelope.message = normalize_line_endings(envelope.message)
+        with transaction.atomic():
+            raw_mail, created = RawMailDigest.objects.\
+                get_or_create_raw_mail(envelope.message)
+            mail = Mail.objects.create(
+                identifier=identifier,
+                headers=dict(envelope.headers), message=raw_mail,
+                sender=envelope.sender, recipient=envelope.recipients[0])
         mailstatus = self.mailstatus_class(
             mail=mail, status=AbstractMailStatus.QUEUED,
             destination_domain=extract_domain(envelope.recipients[0]))
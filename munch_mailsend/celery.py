@@ -1,6 +1,7 @@
 import sys
 
 from celery.signals import worker_shutdown
+from celery.signals import worker_process_shutdown
 from celery.signals import celeryd_after_setup
 from django.conf import settings
 
@@ -11,6 +12,8 @@ from munch.core.celery import munch_tasks_router
 
 available_worker_types += ['mx', 'router']
 
+heartbeat = None
+
 
 def add_queues():
     munch_tasks_router.add_queue(
@@ -25,7 +28,9 @@ def register_tasks():
         'gc': [
             'munch_mailsend.tasks.ping_workers',
             'munch_mailsend.tasks.check_disabled_workers',
+            'munch_mailsend.tasks.collect_queue_sizes',
             'munch_mailsend.tasks.dispatch_queued',
+            'munch_mailsend.tasks.publish_delayed_tasks',
             'munch_mailsend.tasks.purge_raw_mail'
         ]
     }
@@ -35,7 +40,11 @@ def register_tasks():
 @celeryd_after_setup.connect
 @catch_exception
 def configure_worker(instance, **kwargs):
+    global heartbeat
     from .models import Worker
+    from .utils.lanes import get_lanes
+    from .utils.heartbeat import Heartbeat
+    from .utils.lanes import get_lane_queue_name
 
     if any([t in get_worker_types() for t in ['mx', 'all']]):
         from .tasks import send_email  # noqa
@@ -52,20 +61,29 @@ def configure_worker(instance, **kwargs):
             'WORKER_POLICIES_SETTINGS', {})
         worker.enabled = True
         worker.save()
-        queue = settings.MAILSEND.get(
-            'MX_WORKER_QUEUE_PREFIX', '').format(ip=worker.ip)
-        munch_tasks_router.register_to_queue(queue)
-        queue = settings.MAILSEND.get(
-            'MX_WORKER_QUEUE_RETRY_PREFIX', '').format(ip=worker.ip)
-        munch_tasks_router.register_to_queue(queue)
+        heartbeat = Heartbeat(worker.ip)
+        heartbeat.start()
+        # Celery 3 can't weight queues: lanes are consumed in turn, each
+        # getting an equal share whatever the backlog of other lanes
+        for lane in get_lanes():
+            munch_tasks_router.register_to_queue(
+                worker.get_queue_name(lane=lane))
+            munch_tasks_router.register_to_queue(
+                worker.get_queue_name(retry=True, lane=lane))
     if any([t in get_worker_types() for t in ['router', 'all']]):
         from .tasks import route_envelope  # noqa
         sys.stdout.write('[mailsend-app] Registering worker as ROUTER...')
         munch_tasks_router.register_as_worker('router')
+        for lane in get_lanes()[:-1]:
+            munch_tasks_router.register_to_queue(get_lane_queue_name(
+                settings.MAILSEND.get('ROUTING_QUEUE'), lane))
     if any([t in get_worker_types() for t in ['gc', 'all']]):
         from .tasks import ping_workers  # noqa
         from .tasks import dispatch_queued  # noqa
+        from .tasks import purge_raw_mail  # noqa
+        from .tasks import publish_delayed_tasks  # noqa
         from .tasks import check_disabled_workers  # noqa
+        from .tasks import collect_queue_sizes  # noqa
         sys.stdout.write(
             '[mailsend-app] Registering worker as GARBAGE COLLECTOR...')
         munch_tasks_router.register_as_worker('gc')
@@ -77,6 +95,10 @@ def worker_shutdown(*args, **kwargs):
     sender = kwargs.get('sender')
 
     if any([t in get_worker_types() for t in ['mx', 'all']]):
+        from .utils.sink import flush_status_sinks
+        flush_status_sinks()
+        if heartbeat is not None:
+            heartbeat.stop()
         sys.stdout.write('[mailsend-app] Disabling MX worker instance...')
         workers = Worker.objects.filter(
             ip=settings.MAILSEND.get('SMTP_WORKER_SRC_ADDR'), name=sender)
@@ -95,3 +117,11 @@ def worker_shutdown(*args, **kwargs):
         workers[0].save()
         sys.stdout.write(
             '[mailsend-app] MX worker disabled and removed from cache. Bye !')
+
+
+@worker_process_shutdown.connect
+def worker_process_shutdown(*args, **kwargs):
+    # Statuses deferred by prefork children are written by each of them
+    if any([t in get_worker_types() for t in ['mx', 'all']]):
+        from .utils.sink import flush_status_sinks
+        flush_status_sinks()
@@ -8,6 +8,10 @@ from amqp.exceptions import NotFound
 from ...models import Worker
 from ...amqp import get_queue
 from ...amqp import get_queue_size
+from ...utils.delay import get_delay_queue_key
+from ...utils.delay import count_delayed_tasks
+from ...utils.lanes import get_lanes
+from ...utils.lanes import get_lane_queue_name
 
 log = logging.getLogger(__name__)
 
@@ -23,10 +27,11 @@ class Command(BaseCommand):
         except NotFound:
             self.print_not_found_queue(name)
 
-    def print_worker_queue_line(self, worker, details='', retry=False):
+    def print_worker_queue_line(
+            self, worker, details='', retry=False, lane=None):
         try:
             count = 0
-            queue = worker.get_queue(self.connection, retry=retry)
+            queue = worker.get_queue(self.connection, retry=retry, lane=lane)
             if self.scheduled_tasks:
                 if self.scheduled_tasks:
                     for t in self.scheduled_tasks.get(worker.name):
@@ -51,9 +56,13 @@ class Command(BaseCommand):
         self.line_format = '{:35}: {} {}'
         self.connection = app.connection()
         self.print_queue_line(settings.CELERY_DEFAULT_QUEUE)
-        self.print_queue_line(settings.MAILSEND.get('ROUTING_QUEUE'))
+        for lane in get_lanes():
+            self.print_queue_line(get_lane_queue_name(
+                settings.MAILSEND.get('ROUTING_QUEUE'), lane))
         self.print_queue_line(settings.MAILSEND.get(
             'QUEUED_MAIL_QUEUE'))
+        self.stdout.write(self.line_format.format(
+            get_delay_queue_key(), count_delayed_tasks(), '(delay queue)'))
 
         self.stdout.write('')
         for worker in Worker.objects.all():
@@ -67,5 +76,7 @@ class Command(BaseCommand):
                     [worker.name]).scheduled() or {}
             details = self.style.ERROR(
                 '(disabled) ') if not worker.enabled else ''
-            self.print_worker_queue_line(worker, details)
-            self.print_worker_queue_line(worker, details, retry=True)
+            for lane in get_lanes():
+                self.print_worker_queue_line(worker, details, lane=lane)
+                self.print_worker_queue_line(
+                    worker, details, retry=True, lane=lane)
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from ...utils.purge import purge_raw_mails
+from ...utils.purge import get_purge_stats
+
+
+class Command(BaseCommand):
+    help = 'Detach and delete RawMail of mails that reached a final state'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', dest='batch_size', type=int, default=None,
+            help="Mails handled per batch (Default: PURGE_BATCH_SIZE)")
+        parser.add_argument(
+            '--max-batches', dest='max_batches', type=int, default=None,
+            help="Stop after this number of batches")
+        parser.add_argument(
+            '--stats', dest='stats', action='store_true',
+            help="Only print purge statistics")
+
+    def handle(self, *args, **options):
+        if not options['stats']:
+            mails, raw_mails = purge_raw_mails(
+                options['batch_size'], options['max_batches'])
+            self.stdout.write(self.style.SUCCESS(
+                '{} mail(s) detached, {} RawMail deleted.'.format(
+                    mails, raw_mails)))
+        for key, value in sorted(get_purge_stats().items()):
+            self.stdout.write('{:20}: {}'.format(key, value))
@@ -0,0 +1,31 @@
+import time
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ...utils.delay import publish_due_tasks
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Publish tasks of the delay queue when they are due'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', dest='interval', type=float,
+            default=settings.MAILSEND['DELAY_QUEUE_INTERVAL'],
+            help="Seconds between two checks of the delay queue")
+        parser.add_argument(
+            '--once', dest='once', action='store_true',
+            help="Publish due tasks once and exit")
+
+    def handle(self, *args, **options):
+        while True:
+            published = publish_due_tasks()
+            if options['once']:
+                self.stdout.write(
+                    '{} delayed task(s) published.'.format(published))
+                return
+            time.sleep(options['interval'])
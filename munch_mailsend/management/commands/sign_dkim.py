@@ -1,47 +1,129 @@
 import sys
+import mailbox
+from multiprocessing import Pool
 
 from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
 
 from ...utils import dkim
+from ...utils.messages import iter_messages
+from ...utils.dkim.crypto import UnparsableKeyError
+from ...utils.dkim.crypto import parse_pem_private_key
+
+HEADERS_TO_SIGN = [
+    'From', 'Subject', 'Reply-To', 'To', 'Date',
+    'Message-ID', 'List-ID', 'List-Unsubscribe',
+    'Sender', 'Content-Type', 'MIME-Version']
+_ENCODED_HEADERS_TO_SIGN = [h.encode('utf-8') for h in HEADERS_TO_SIGN]
+
+# Per process signing parameters, set once by _init_signer
+_signer = {}
+
+
+def _init_signer(private_key, selector, domain, identity):
+    # `private_key` is parsed by the parent: a bad key must not make
+    # every pool process fail (and be respawned) forever
+    _signer.update({
+        'private_key': private_key, 'selector': selector,
+        'domain': domain, 'identity': identity})
+
+
+def _sign_message(item):
+    label, message = item
+    try:
+        sig = dkim.sign(
+            message, _signer['selector'], _signer['domain'],
+            _signer['private_key'], identity=_signer['identity'],
+            include_headers=_ENCODED_HEADERS_TO_SIGN)
+        return label, sig + b'\n' + message, None
+    except Exception as exc:
+        return label, message, str(exc)
 
 
 class Command(BaseCommand):
-    help = 'DKIM sign .eml'
+    help = (
+        'DKIM sign .eml read from stdin, or every message of the given '
+        'maildirs, mboxes or directories of .eml files into a mailbox')
 
     def add_arguments(self, parser):
         parser.add_argument('selector', type=str)
         parser.add_argument('domain', type=str)
         parser.add_argument('privatekeyfile', type=str)
+        parser.add_argument('paths', nargs='*', type=str)
         parser.add_argument('-i', '--identity', type=str, required=False)
+        parser.add_argument(
+            '-o', '--output', dest='output', type=str,
+            help="Output mbox (or maildir with --maildir) for bulk mode")
+        parser.add_argument(
+            '--maildir', dest='maildir', action='store_true',
+            help="Write signed messages to a maildir instead of an mbox")
+        parser.add_argument(
+            '-p', '--processes', dest='processes', default=None, type=int,
+            help="Signing processes (Default: number of CPUs)")
 
     def handle(self, *args, **options):
-        sys.stdin = sys.stdin.detach()
-        sys.stdout = sys.stdout.detach()
-
         identity = options['identity']
 
         domain = options['domain'].encode('utf-8')
         selector = options['selector'].encode('utf-8')
-        privatekeyfile = options['privatekeyfile']
+        with open(options['privatekeyfile'], 'rb') as f:
+            try:
+                private_key = parse_pem_private_key(f.read())
+            except (UnparsableKeyError, ValueError) as exc:
+                raise CommandError('Invalid private key {}: {}'.format(
+                    options['privatekeyfile'], exc))
 
         if identity:
             identity = identity.encode('utf-8')
 
+        if options['paths']:
+            return self.handle_bulk(
+                options, private_key, selector, domain, identity)
+
+        sys.stdin = sys.stdin.detach()
+        sys.stdout = sys.stdout.detach()
+
         message = sys.stdin.read()
+        sig = dkim.sign(
+            message, selector, domain, private_key,
+            identity=identity, include_headers=_ENCODED_HEADERS_TO_SIGN)
+        sys.stdout.write(sig + b'\n')
+        sys.stdout.write(message)
+
+    def handle_bulk(self, options, private_key, selector, domain, identity):
+        if not options['output']:
+            raise CommandError('--output is required to sign mailboxes')
+        if options['maildir']:
+            output = mailbox.Maildir(options['output'], factory=None)
+        else:
+            output = mailbox.mbox(options['output'])
+
+        def messages():
+            for path in options['paths']:
+                yield from iter_messages(path)
+
+        signed, failed = 0, 0
+        pool = Pool(
+            options['processes'], initializer=_init_signer,
+            initargs=(private_key, selector, domain, identity))
         try:
-            HEADERS_TO_SIGN = [
-                'From', 'Subject', 'Reply-To', 'To', 'Date',
-                'Message-ID', 'List-ID', 'List-Unsubscribe',
-                'Sender', 'Content-Type', 'MIME-Version']
-            _ENCODED_HEADERS_TO_SIGN = [
-                h.encode('utf-8') for h in HEADERS_TO_SIGN]
-            sig = dkim.sign(
-                message, selector, domain,
-                open(privatekeyfile, "rb").read(),
-                identity=identity, include_headers=_ENCODED_HEADERS_TO_SIGN)
-            sys.stdout.write(sig + b'\n')
-            sys.stdout.write(message)
-        except Exception as e:
-            raise
-            print(e, file=sys.stderr)
-            sys.stdout.write(message)
+            output.lock()
+            for label, message, error in pool.imap(
+                    _sign_message, messages(), chunksize=16):
+                if error:
+                    failed += 1
+                    self.stderr.write(
+                        '{}: not signed ({})'.format(label, error))
+                else:
+                    signed += 1
+                output.add(message)
+            output.flush()
+        finally:
+            pool.close()
+            pool.join()
+            output.unlock()
+            output.close()
+
+        self.stdout.write(
+            '{} message(s) signed, {} copied unsigned into {}. Done.'.format(
+                signed, failed, options['output']))
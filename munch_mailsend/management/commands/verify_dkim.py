@@ -3,12 +3,61 @@ import sys
 from django.core.management.base import BaseCommand
 
 from ...utils import dkim
+from ...utils.messages import iter_messages
+from ...utils.dkim.dnscache import TXTCache
 
 
 class Command(BaseCommand):
-    help = 'DKIM verify envelope'
+    help = (
+        'DKIM verify envelope read from stdin, or every message of the '
+        'given maildirs, mboxes or directories of .eml files')
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', type=str)
+        parser.add_argument(
+            '--concurrency', dest='concurrency', default=20, type=int,
+            help="Concurrent public key DNS lookups (Default: 20)")
+        parser.add_argument(
+            '--ttl', dest='ttl', default=60 * 60, type=int,
+            help="Public key cache duration in seconds (Default: 3600)")
+        parser.add_argument(
+            '--negative-ttl', dest='negative_ttl', default=60 * 5, type=int,
+            help="Missing public key cache duration in seconds (Default: 300)")
+        parser.add_argument(
+            '--quiet', dest='quiet', action='store_true',
+            help="Only print failures and the summary")
 
     def handle(self, *args, **options):
+        if not options['paths']:
+            return self.handle_stdin()
+
+        self.cache = TXTCache(
+            dkim.get_txt, ttl=options['ttl'],
+            negative_ttl=options['negative_ttl'])
+        self.prefetch_keys(options['paths'], options['concurrency'])
+
+        verified, failed = 0, 0
+        for path in options['paths']:
+            for label, message in iter_messages(path):
+                ok, reason = self.verify(message)
+                if ok:
+                    verified += 1
+                    if not options['quiet']:
+                        self.stdout.write('{}: signature ok'.format(label))
+                else:
+                    failed += 1
+                    self.stdout.write(self.style.ERROR(
+                        '{}: signature verification failed ({})'.format(
+                            label, reason)))
+
+        self.stdout.write(
+            '{} message(s) verified, {} failed ({} DNS lookup(s), '
+            '{} cache hit(s)). Done.'.format(
+                verified, failed, self.cache.misses, self.cache.hits))
+        if failed:
+            sys.exit(1)
+
+    def handle_stdin(self):
         sys.stdin = sys.stdin.detach()
         message = sys.stdin.read()
 
@@ -18,3 +67,42 @@ class Command(BaseCommand):
             print("signature verification failed")
             sys.exit(1)
         print("signature ok")
+
+    def prefetch_keys(self, paths, concurrency):
+        """ Resolve every distinct public key once, concurrently """
+        from gevent.threadpool import ThreadPool
+
+        names = set()
+        for path in paths:
+            for label, message in iter_messages(path):
+                try:
+                    name = dkim.DKIM(message).get_key_name()
+                except dkim.DKIMException:
+                    continue
+                if name:
+                    names.add(name)
+
+        def resolve(name):
+            try:
+                self.cache(name)
+            except Exception:
+                # Will be retried (and reported) during verification
+                pass
+
+        pool = ThreadPool(max(1, concurrency))
+        for _ in pool.imap_unordered(resolve, names):
+            pass
+        pool.kill()
+
+    def verify(self, message):
+        try:
+            d = dkim.DKIM(message)
+            if d.verify(dnsfunc=self.cache):
+                return True, None
+            if not d.signature_headers():
+                return False, 'no signature'
+            return False, 'bad signature'
+        except dkim.DKIMException as exc:
+            return False, str(exc)
+        except Exception as exc:
+            return False, 'unexpected error: {}'.format(exc)
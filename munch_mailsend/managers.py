@@ -1,11 +1,16 @@
+import time
 import pickle
+import hashlib
 import logging
 
 from django.conf import settings
 from django.db import models
+from django.db import transaction
 from django.utils.module_loading import import_string
 from django_redis import get_redis_connection
 
+from munch.core.mail.models import RawMail
+
 logger = logging.getLogger(__name__)
 
 conn = get_redis_connection()
@@ -34,6 +39,7 @@ class WorkerManager(models.Manager):
         if record_performance:
             timer.stop()
 
+        policies = []
         for path in settings.MAILSEND.get('WORKER_POLICIES'):
             try:
                 policy = import_string(path)
@@ -51,10 +57,12 @@ class WorkerManager(models.Manager):
                 timer = statsd.timer(path)
                 timer.start()
 
-            workers = policy(
+            policy = policy(
                 identifier, headers,
                 mailstatus_class, reply_code,
-                reply_message, not_before).apply(workers)
+                reply_message, not_before)
+            policies.append(policy)
+            workers = policy.apply(workers)
 
             if record_performance:
                 timer.stop()
@@ -65,13 +73,17 @@ class WorkerManager(models.Manager):
             timer = statsd.timer('munch_mailsend.policies.mx.Last')
             timer.start()
 
-        result = LastPolicy().apply(workers)
+        worker, next_available, score, workers = LastPolicy().apply(workers)
+        if worker:
+            chosen = next(w for w in workers if w.get('ip') == worker.ip)
+            for policy in policies:
+                next_available = policy.reserve(chosen, next_available)
 
         if record_performance:
             timer.stop()
             total_timer.stop()
 
-        return result
+        return worker, next_available, score, workers
 
     def set_to_cache(self, worker):
         return conn.hset("{}:{}".format(
@@ -84,15 +96,16 @@ class WorkerManager(models.Manager):
                 'policies_settings': worker.policies_settings}))
 
     def get_from_cache(self, ip=None):
+        """
+        Return cached workers, or the one sending from `ip` (None if not
+        cached)
+        """
+        key = "{}:{}".format(
+            settings.MAILSEND.get('CACHE_PREFIX'), self.CACHE_PREFIX)
         if ip:
-            return pickle.loads(conn.hget(
-                "{}:{}".format(
-                    settings.MAILSEND.get('CACHE_PREFIX'),
-                    self.CACHE_PREFIX, ip)))
-        for worker in conn.hgetall("{}:{}".format(
-                settings.MAILSEND.get('CACHE_PREFIX'),
-                self.CACHE_PREFIX)).values():
-            yield pickle.loads(worker)
+            worker = conn.hget(key, ip)
+            return pickle.loads(worker) if worker is not None else None
+        return (pickle.loads(worker) for worker in conn.hgetall(key).values())
 
     def remove_from_cache(self, worker):
         return conn.hdel("{}:{}".format(
@@ -103,3 +116,80 @@ class WorkerManager(models.Manager):
         for key in conn.scan_iter('{}:{}'.format(
                 settings.MAILSEND.get('CACHE_PREFIX'), self.CACHE_PREFIX)):
             conn.delete(key)
+
+    def get_queue_sizes_key(self):
+        return '{}:{}:queue_sizes'.format(
+            settings.MAILSEND.get('CACHE_PREFIX'), self.CACHE_PREFIX)
+
+    def set_queue_sizes(self, sizes):
+        """ Store queued tasks count of every worker (by IP) """
+        pipe = conn.pipeline()
+        pipe.delete(self.get_queue_sizes_key())
+        if sizes:
+            pipe.hmset(self.get_queue_sizes_key(), sizes)
+            pipe.expire(
+                self.get_queue_sizes_key(),
+                settings.MAILSEND['QUEUE_SIZES_CACHE_TIMEOUT'])
+        pipe.execute()
+
+    def get_queue_sizes(self):
+        """ Return last collected queued tasks count by worker IP """
+        return {
+            ip.decode('utf-8'): int(size) for ip, size in conn.hgetall(
+                self.get_queue_sizes_key()).items()}
+
+    def get_heartbeats_key(self):
+        return '{}:{}:heartbeats'.format(
+            settings.MAILSEND.get('CACHE_PREFIX'), self.CACHE_PREFIX)
+
+    def send_heartbeat(self, ip, now=None):
+        return conn.zadd(self.get_heartbeats_key(), now or time.time(), ip)
+
+    def remove_heartbeats(self, ips):
+        if ips:
+            return conn.zrem(self.get_heartbeats_key(), *ips)
+
+    def get_stale_ips(self, timeout=None, now=None):
+        """
+        Return IPs of workers whose last heartbeat is older than `timeout`
+        seconds. Workers that never sent any heartbeat are not returned.
+        """
+        if timeout is None:
+            timeout = settings.MAILSEND['WORKER_HEARTBEAT']['timeout']
+        return {ip.decode('utf-8') for ip in conn.zrangebyscore(
+            self.get_heartbeats_key(), '-inf',
+            (now or time.time()) - timeout)}
+
+
+class RawMailDigestManager(models.Manager):
+    @staticmethod
+    def get_digest(content):
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        return hashlib.sha256(content).hexdigest()
+
+    def get_or_create_raw_mail(self, content):
+        """
+        Return (raw_mail, created) for `content`, looking it up by its
+        sha256 instead of comparing the whole content column.
+
+        The digest row stays locked until the end of the transaction so
+        that the purge can't delete the raw mail in the meantime: call
+        it in the transaction inserting the mail that uses it.
+        """
+        digest = self.get_digest(content)
+        with transaction.atomic():
+            try:
+                return self.select_for_update().select_related(
+                    'raw_mail').get(digest=digest).raw_mail, False
+            except self.model.DoesNotExist:
+                pass
+            raw_mail = RawMail.objects.create(content=content)
+            # Handles concurrent inserts of the same digest
+            raw_mail_digest, created = self.get_or_create(
+                digest=digest, defaults={'raw_mail': raw_mail})
+            if not created:
+                raw_mail.delete()
+                return self.select_for_update().select_related(
+                    'raw_mail').get(pk=raw_mail_digest.pk).raw_mail, False
+        return raw_mail, True
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_permissions'),
+        ('munch_mailsend', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RawMailDigest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64, unique=True)),
+                ('raw_mail', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='mailsend_digest', to='core.RawMail')),
+            ],
+        ),
+    ]
@@ -13,6 +13,9 @@ from munch.core.mail.models import AbstractMailStatus
 
 from .settings import settings
 from .managers import WorkerManager
+from .managers import RawMailDigestManager
+from .utils import normalize_line_endings
+from .utils.lanes import get_lane_queue_name
 
 
 class Worker(models.Model):
@@ -30,19 +33,19 @@ class Worker(models.Model):
     def __str__(self):
         return '{} ({})'.format(self.name, self.ip)
 
-    def get_queue_name(self, retry=False):
+    def get_queue_name(self, retry=False, lane=None):
         base = settings.MAILSEND.get('MX_WORKER_QUEUE_PREFIX')
         if retry:
             base = settings.MAILSEND.get('MX_WORKER_QUEUE_RETRY_PREFIX')
-        return base.format(ip=self.ip)
+        return get_lane_queue_name(base.format(ip=self.ip), lane)
 
-    def get_queue(self, connection, retry=False):
+    def get_queue(self, connection, retry=False, lane=None):
         exchange = Exchange(
             channel=connection,
             name=settings.CELERY_DEFAULT_EXCHANGE,
             type=settings.CELERY_DEFAULT_EXCHANGE_TYPE)
         return Queue(self.get_queue_name(
-            retry=retry), exchange=exchange).bind(connection)
+            retry=retry, lane=lane), exchange=exchange).bind(connection)
 
     def get_queue_size(self, queue):
         return queue.queue_declare(passive=True).message_count
@@ -55,6 +58,18 @@ class Worker(models.Model):
             WorkerManager().remove_from_cache(self)
 
 
+class RawMailDigest(models.Model):
+    """ Content hash of a RawMail, used to deduplicate bodies """
+    digest = models.CharField(max_length=64, unique=True)
+    raw_mail = models.OneToOneField(
+        RawMail, on_delete=models.CASCADE, related_name='mailsend_digest')
+
+    objects = RawMailDigestManager()
+
+    def __str__(self):
+        return self.digest
+
+
 def get_mail_identifier():
     return mk_base64_uuid('i-')
 
@@ -83,6 +98,9 @@ class Mail(AbstractMail):
                 "there is no RawMail attached to it.")
         message = self.message.content or ""
         envelope.parse(headers.encode('utf-8') + message.encode('utf-8'))
+        # Stored bodies are normalized at ingestion, so this is only
+        # a scan unless the RawMail comes from elsewhere
+        envelope.message = normalize_line_endings(envelope.message)
         envelope.sender = self.sender
         envelope.recipients.append(self.recipient)
         return envelope
@@ -90,9 +108,3 @@ class Mail(AbstractMail):
 
 class MailStatus(AbstractMailStatus):
     mail = models.ForeignKey(Mail)
-
-    def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        if self.status in self.FINAL_STATES:
-            self.mail.message = None
-            self.mail.save()
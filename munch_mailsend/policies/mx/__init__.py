@@ -22,6 +22,11 @@ class First:
             for worker in Worker.objects.filter(enabled=True):
                 Worker.objects.set_to_cache(worker)
             workers = list(Worker.objects.get_from_cache())
+        # Workers that stopped sending heartbeats are considered down
+        # until "ping_workers" disables them
+        stale_ips = Worker.objects.get_stale_ips()
+        if stale_ips:
+            workers = [w for w in workers if w['ip'] not in stale_ips]
         for worker in workers:
             worker['score'] = 0.0
             worker['next_available'] = not_before or timezone.now()
@@ -60,6 +65,20 @@ class WorkerPolicyBase:
         return worker.get('policies_settings', {}).get(
             self.__module__.split('.')[-1], {})
 
+    @classmethod
+    def get_source_settings(cls, source_ip):
+        """
+            Settings of this policy for the worker sending from
+            `source_ip` (the ones `apply` got for it), from the workers
+            cache. Falls back to WORKER_POLICIES_SETTINGS, which MX
+            workers also register as their own.
+        """
+        worker = Worker.objects.get_from_cache(ip=source_ip) or {
+            'policies_settings': settings.MAILSEND.get(
+                'WORKER_POLICIES_SETTINGS', {})}
+        return (worker.get('policies_settings') or {}).get(
+            cls.__module__.split('.')[-1], {})
+
     def old(self):
         return datetime(year=1970, month=1, day=1).replace(tzinfo=pytz.utc)
 
@@ -76,6 +95,16 @@ class WorkerPolicyBase:
         """
         raise NotImplementedError
 
+    def reserve(self, worker, next_available):
+        """
+            Called (still under the routing lock) with the worker chosen
+            by `Last` and the date its mail is to be sent at. Policies
+            consuming some capacity reserve it here, in one atomic call,
+            and return the date they got it at (never earlier). The mail
+            is sent at the date returned by the last policy.
+        """
+        return next_available
+
     ###########
     # Signals #
     ###########
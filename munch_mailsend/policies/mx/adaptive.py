@@ -0,0 +1,164 @@
+from datetime import datetime
+from datetime import timedelta
+
+import pytz
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from . import CACHE_PREFIX
+from . import CACHE_TIMEOUT
+from . import WorkerPolicyBase
+
+conn = get_redis_connection('default')
+
+DEFAULT_SETTINGS = {
+    'initial_interval': 1,
+    'min_interval': 0.1,
+    'max_interval': 60 * 5,
+    'decrease_factor': 2,
+    'increase_step': 0.05,
+    'decrease_on': ['421', '4.7.'],
+    'max_queued': 60 * 15}
+
+# KEYS: (ip, domain) state
+# ARGV: requested date, default interval, ttl
+reserve_script = conn.register_script("""
+local interval = tonumber(redis.call('HGET', KEYS[1], 'interval') or ARGV[2])
+local next_slot = tonumber(redis.call('HGET', KEYS[1], 'next_slot') or 0)
+local slot = math.max(next_slot, tonumber(ARGV[1]))
+redis.call('HSET', KEYS[1], 'next_slot', slot + interval)
+redis.call('HSET', KEYS[1], 'interval', interval)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return tostring(slot)
+""")
+
+# KEYS: (ip, domain) state
+# ARGV: "decrease" or "increase", default interval, decrease factor,
+#       increase step, min interval, max interval, ttl
+feedback_script = conn.register_script("""
+local interval = tonumber(redis.call('HGET', KEYS[1], 'interval') or ARGV[2])
+if ARGV[1] == 'decrease' then
+    interval = math.min(interval * tonumber(ARGV[3]), tonumber(ARGV[6]))
+else
+    interval = math.max(
+        1 / (1 / interval + tonumber(ARGV[4])), tonumber(ARGV[5]))
+end
+redis.call('HSET', KEYS[1], 'interval', interval)
+redis.call('EXPIRE', KEYS[1], ARGV[7])
+return tostring(interval)
+""")
+
+
+def get_adaptive_settings(policies_settings=None):
+    if policies_settings is None:
+        policies_settings = settings.MAILSEND.get(
+            'WORKER_POLICIES_SETTINGS', {})
+    return dict(DEFAULT_SETTINGS, **policies_settings.get('adaptive', {}))
+
+
+class Policy(WorkerPolicyBase):
+    """
+        Learn the sending rate of each (source IP, destination domain)
+        from replies: the interval between two sendings is multiplied by
+        `decrease_factor` on each deferral matching `decrease_on` (reply
+        codes or enhanced status code prefixes) and the rate grows by
+        `increase_step` mail per second on each delivery (AIMD).
+
+        The slot of the chosen worker is reserved when routing (see
+        `reserve`) and the mail is sent at it.
+
+        # Example of settings
+        {
+            'initial_interval': 1,
+            'min_interval': 0.1,
+            'max_interval': 60 * 5,
+            'decrease_factor': 2,
+            'increase_step': 0.05,
+            'decrease_on': ['421', '4.7.'],
+            'max_queued': 60 * 15
+        }
+    """
+    def apply(self, workers):
+        domain = self.get_domain(self.headers.get('To'))
+        now = self.now()
+        not_before = self.not_before or now
+
+        pipe = conn.pipeline()
+        for worker in workers:
+            pipe.hmget(
+                self.get_key(worker.get('ip'), domain),
+                'interval', 'next_slot')
+        states = pipe.execute()
+
+        available_workers = []
+        for worker, (interval, next_slot) in zip(workers, states):
+            worker_settings = get_adaptive_settings(
+                worker.get('policies_settings', {}))
+            if next_slot is None:
+                next_available = not_before
+            else:
+                next_available = max(not_before, datetime.fromtimestamp(
+                    float(next_slot), pytz.utc))
+            max_queued_datetime = now + timedelta(
+                seconds=worker_settings['max_queued'])
+            if next_available > max_queued_datetime:
+                self.logger.debug(
+                    '[{}] [worker:{}] Learned rate for {} (one mail every '
+                    '{} second(s)) is too low to schedule before {}'.format(
+                        self.identifier, worker.get('ip'), domain,
+                        float(interval or worker_settings[
+                            'initial_interval']),
+                        max_queued_datetime))
+                continue
+            if next_available > worker.get('next_available', now):
+                worker['next_available'] = next_available
+            available_workers.append(worker)
+        return available_workers
+
+    def reserve(self, worker, next_available):
+        worker_settings = get_adaptive_settings(
+            worker.get('policies_settings', {}))
+        slot = datetime.fromtimestamp(float(reserve_script(
+            keys=[self.get_key(
+                worker.get('ip'), self.get_domain(self.headers.get('To')))],
+            args=[
+                next_available.timestamp(),
+                worker_settings['initial_interval'], CACHE_TIMEOUT])),
+            pytz.utc)
+        return max(next_available, slot)
+
+    @staticmethod
+    def get_key(source_ip, destination_domain):
+        return '{}:adaptive:{}:{}'.format(
+            CACHE_PREFIX, source_ip, destination_domain)
+
+    @staticmethod
+    def is_deferral(instance, decrease_on):
+        codes = []
+        if instance.raw_msg:
+            codes.append(instance.raw_msg.split(' ', 1)[0])
+        if instance.status_code:
+            codes.append(instance.status_code)
+        return any(
+            code.startswith(prefix) for code in codes
+            for prefix in decrease_on)
+
+    ###########
+    # Signals #
+    ###########
+
+    @classmethod
+    def mailstatus_pre_save(cls, instance, manager):
+        key = cls.get_key(instance.source_ip, instance.destination_domain)
+        # Same settings as the ones `apply` used for this worker
+        options = dict(DEFAULT_SETTINGS, **cls.get_source_settings(
+            instance.source_ip))
+        if instance.status in [instance.DELIVERED] or (
+                instance.status in [instance.DELAYED] and
+                cls.is_deferral(instance, options['decrease_on'])):
+            feedback_script(keys=[key], args=[
+                'increase' if instance.status == instance.DELIVERED
+                else 'decrease',
+                options['initial_interval'], options['decrease_factor'],
+                options['increase_step'], options['min_interval'],
+                options['max_interval'], CACHE_TIMEOUT])
@@ -0,0 +1,42 @@
+from . import WorkerPolicyBase
+from ...models import Worker
+
+
+class Policy(WorkerPolicyBase):
+    """
+        Penalize workers with many queued tasks, using queue sizes
+        collected by "collect_queue_sizes" task. Does nothing when
+        sizes are not collected (or too old).
+
+        # Example of settings
+        {
+            # Score removed per `threshold` queued tasks
+            'penalty': 0.5,
+            'threshold': 1000,
+            # Workers with more queued tasks are not used (unless
+            # all workers are above)
+            'max_queued': 20000
+        }
+    """
+    def apply(self, workers):
+        sizes = Worker.objects.get_queue_sizes()
+        if not sizes:
+            return workers
+
+        available_workers = []
+        for worker in workers:
+            worker_settings = self.get_settings(worker)
+            size = sizes.get(worker.get('ip'), 0)
+            max_queued = worker_settings.get('max_queued')
+            if max_queued and size >= max_queued:
+                self.logger.debug(
+                    '[{}] [worker:{}] Too many queued tasks ({} >= {})'.format(
+                        self.identifier, worker.get('ip'), size, max_queued))
+                continue
+            worker['score'] -= round(
+                worker_settings.get('penalty', 0.5) * size /
+                worker_settings.get('threshold', 1000), 2)
+            available_workers.append(worker)
+
+        # Better to queue on a busy worker than not at all
+        return available_workers or workers
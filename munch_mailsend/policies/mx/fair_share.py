@@ -0,0 +1,155 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from . import CACHE_PREFIX
+from . import CACHE_TIMEOUT
+from . import WorkerPolicyBase
+
+conn = get_redis_connection('default')
+
+DEFAULT_SETTINGS = {
+    'weights': {},
+    'default_weight': 1,
+    'max_queued': 60 * 30,
+    'min_queued': 60,
+    'inflight_timeout': 60 * 60}
+
+
+def get_fair_share_settings(policies_settings=None):
+    if policies_settings is None:
+        policies_settings = settings.MAILSEND.get(
+            'WORKER_POLICIES_SETTINGS', {})
+    return dict(DEFAULT_SETTINGS, **policies_settings.get('fair_share', {}))
+
+
+def get_user(headers):
+    return headers.get(settings.MAILSEND.get('X_USER_ID_HEADER'))
+
+
+class Policy(WorkerPolicyBase):
+    """
+        Share scarce sending slots of a destination domain between
+        users (X_USER_ID_HEADER), weighted fair queuing style.
+
+        Mails scheduled and not yet sent are tracked per user and per
+        domain. A user holding more than its weighted share of them
+        can only be scheduled within the same share of the `max_queued`
+        horizon (at least `min_queued` seconds): later slots are left to
+        other users and its mail is routed again later.
+
+        Must come after policies setting `next_available` (eg.
+        `rate_limit` or `token_bucket`).
+
+        # Example of settings
+        {
+            'weights': {'42': 4},
+            'default_weight': 1,
+            'max_queued': 60 * 30,
+            'min_queued': 60,
+            'inflight_timeout': 60 * 60
+        }
+    """
+    def apply(self, workers):
+        user = get_user(self.headers)
+        if not user:
+            return workers
+        domain = self.get_domain(self.headers.get('To'))
+        timestamp = time.time()
+
+        users = {u.decode('utf-8') for u in conn.zrangebyscore(
+            self.get_users_key(domain), timestamp, '+inf')}
+        users.add(user)
+        if len(users) == 1:
+            return workers
+        users = sorted(users)
+        pipe = conn.pipeline()
+        for u in users:
+            pipe.zcount(
+                self.get_inflight_key(domain, u), timestamp, '+inf')
+        inflight = dict(zip(users, pipe.execute()))
+        total = sum(inflight.values())
+
+        now = self.now()
+        available_workers = []
+        for worker in workers:
+            options = get_fair_share_settings(
+                worker.get('policies_settings', {}))
+            weights = {
+                u: options['weights'].get(u, options['default_weight'])
+                for u in users if inflight[u] or u == user}
+            share = weights[user] / sum(weights.values())
+            if inflight[user] <= total * share:
+                available_workers.append(worker)
+                continue
+            horizon = now + timedelta(seconds=max(
+                options['min_queued'], options['max_queued'] * share))
+            if worker.get('next_available', now) > horizon:
+                self.logger.debug(
+                    '[{}] [worker:{}] User {} is above its share ({:.2f}) '
+                    'of {} mails scheduled to {}. Not scheduling it after '
+                    '{}'.format(
+                        self.identifier, worker.get('ip'), user, share,
+                        total, domain, horizon))
+                continue
+            available_workers.append(worker)
+        return available_workers
+
+    @staticmethod
+    def get_users_key(destination_domain):
+        return '{}:fair_share:{}'.format(CACHE_PREFIX, destination_domain)
+
+    @staticmethod
+    def get_inflight_key(destination_domain, user):
+        return '{}:fair_share:{}:{}'.format(
+            CACHE_PREFIX, destination_domain, user)
+
+    @staticmethod
+    def get_mail_key(identifier):
+        return '{}:fair_share:mail:{}'.format(CACHE_PREFIX, identifier)
+
+    ###########
+    # Signals #
+    ###########
+
+    @classmethod
+    def mailstatus_pre_save(cls, instance, manager):
+        domain = instance.destination_domain
+        identifier = instance.mail.identifier
+        if instance.status in [instance.SENDING]:
+            user = get_user(getattr(instance.mail, 'headers', None) or {})
+            if not user:
+                return
+            options = dict(
+                DEFAULT_SETTINGS, **cls.get_source_settings(
+                    instance.source_ip))
+            expires = instance.creation_date.timestamp() + options[
+                'inflight_timeout']
+            pipe = conn.pipeline()
+            # Entries are scored by expiration so that mails whose
+            # final status was never recorded are eventually forgotten
+            for key, member in [
+                    (cls.get_inflight_key(domain, user), identifier),
+                    (cls.get_users_key(domain), user)]:
+                pipe.zadd(key, expires, member)
+                pipe.zremrangebyscore(key, '-inf', time.time())
+                pipe.expire(key, CACHE_TIMEOUT)
+            pipe.set(
+                cls.get_mail_key(identifier), user,
+                max(1, int(expires - time.time())))
+            pipe.execute()
+        elif instance.status in [instance.DELAYED] + list(
+                instance.FINAL_STATES):
+            # Statuses recorded by MX workers may come with a bare Mail
+            # (status sink), so the user is the one stored when sending
+            user = conn.get(cls.get_mail_key(identifier))
+            if user is None:
+                return
+            pipe = conn.pipeline()
+            pipe.zrem(
+                cls.get_inflight_key(domain, user.decode('utf-8')),
+                identifier)
+            pipe.delete(cls.get_mail_key(identifier))
+            pipe.execute()
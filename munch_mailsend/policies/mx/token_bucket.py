@@ -0,0 +1,163 @@
+import random
+import logging
+from datetime import datetime
+from datetime import timedelta
+
+import pytz
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from . import CACHE_PREFIX
+from . import WorkerPolicyBase
+from ...utils.buckets import get_windows
+from ...utils.buckets import bucket_call
+
+log = logging.getLogger(__name__)
+
+conn = get_redis_connection('default')
+
+MX_CACHE_TIMEOUT = 60 * 60
+# Lookups run while routing lock is held: keep them short and retry
+# failed ones soon
+MX_RESOLVE_TIMEOUT = 2
+MX_NEGATIVE_CACHE_TIMEOUT = 60
+
+
+def get_mx_host(domain):
+    """
+    Return (and cache) the preferred MX host of `domain`, or `domain`
+    itself if it can't be resolved
+    """
+    key = '{}:mx:{}'.format(CACHE_PREFIX, domain)
+    mx_host = conn.get(key)
+    if mx_host is not None:
+        return mx_host.decode('utf-8')
+    import dns.resolver
+    try:
+        answers = dns.resolver.query(
+            domain, 'MX', lifetime=MX_RESOLVE_TIMEOUT)
+        mx_host = str(min(
+            answers, key=lambda a: a.preference).exchange).rstrip('.').lower()
+        timeout = MX_CACHE_TIMEOUT
+    except Exception:
+        log.debug('Failed to resolve MX of {}'.format(domain), exc_info=True)
+        mx_host = domain
+        timeout = MX_NEGATIVE_CACHE_TIMEOUT
+    conn.set(key, mx_host, timeout)
+    return mx_host
+
+
+def get_global_buckets(domain):
+    """
+    Return fleet wide (key_prefix, windows) buckets of `domain`,
+    from GLOBAL_RATE_LIMITS setting
+    """
+    options = settings.MAILSEND.get('GLOBAL_RATE_LIMITS', {})
+    buckets = []
+    windows = get_windows(options.get('domains', []), domain)
+    if windows:
+        buckets.append(('{}:token_bucket:global:domain:{}'.format(
+            CACHE_PREFIX, domain), windows))
+    if options.get('mx'):
+        mx_host = get_mx_host(domain)
+        windows = get_windows(options['mx'], mx_host)
+        if windows:
+            buckets.append(('{}:token_bucket:global:mx:{}'.format(
+                CACHE_PREFIX, mx_host), windows))
+    return buckets
+
+
+class Policy(WorkerPolicyBase):
+    """
+        Alternative to `rate_limit` policy using token buckets, so routing
+        cost doesn't depend on the number of already scheduled mails.
+
+        Windows of each domain are (limit, period) or
+        (limit, period, burst) tuples and are all enforced.
+
+        Fleet wide limits of GLOBAL_RATE_LIMITS setting are enforced
+        within the same atomic call. Workers are ranked on available
+        tokens and those of the chosen one are reserved (see `reserve`)
+        before releasing the routing lock: routers of other domains or
+        pools sharing global buckets can't take the same tokens.
+
+        # Example of settings
+        priotitize options: `earlier`, `equal`
+        {
+            'domains': [
+                (r'.*yahoo.com', [(1, 2, 10), (1000, 60 * 60)]),
+                (r'.*', [(1, 1, 5)])],
+            'max_queued': 60 * 30,
+            'prioritize': 'earlier'
+        }
+    """
+    def apply(self, workers):
+        domain = self.get_domain(self.headers.get('To'))
+        now = self.now()
+        not_before = self.not_before or now
+
+        self.global_buckets = get_global_buckets(domain)
+        pipe = conn.pipeline()
+        for worker in workers:
+            bucket_call(
+                self.get_buckets(worker, domain), not_before.timestamp(),
+                client=pipe)
+        reservations = pipe.execute()
+
+        for worker, reservation in zip(workers, reservations):
+            next_available = datetime.fromtimestamp(
+                float(reservation), pytz.utc)
+            self.logger.debug(
+                '[{}] [worker:{}] Token available for {} at {}'.format(
+                    self.identifier, worker.get('ip'), domain,
+                    next_available.astimezone()))
+            if next_available > worker.get('next_available', now):
+                worker['next_available'] = next_available
+
+        # Then order available workers based on next_available
+        workers = sorted(workers, key=lambda w: (
+            w.get('next_available'), random.random()))
+        ranked_workers = []
+        for index, worker in enumerate(workers):
+            worker_settings = self.get_settings(worker)
+            max_queued_datetime = now + timedelta(
+                seconds=int(worker_settings.get('max_queued', 30)))
+            if worker.get('next_available') > max_queued_datetime:
+                self.logger.debug(
+                    '[{}] [worker:{}] Next available is '
+                    'too far (max_queue:{}) to be scheduled '
+                    'for this worker (next_available:{})'.format(
+                        self.identifier, worker.get('ip'),
+                        max_queued_datetime,
+                        worker.get('next_available').astimezone()))
+                continue
+            if worker_settings.get('prioritize', 'earlier') == 'earlier':
+                worker['score'] += round((len(workers) - index) * 0.1, 2)
+            ranked_workers.append(worker)
+        return ranked_workers
+
+    def reserve(self, worker, next_available):
+        domain = self.get_domain(self.headers.get('To'))
+        buckets = self.get_buckets(worker, domain)
+        if not any(windows for _, windows in buckets):
+            return next_available
+        reservation = datetime.fromtimestamp(float(bucket_call(
+            buckets, next_available.timestamp(), reserve=True)), pytz.utc)
+        if reservation > next_available:
+            self.logger.debug(
+                '[{}] [worker:{}] Tokens for {} reserved at {}'.format(
+                    self.identifier, worker.get('ip'), domain,
+                    reservation.astimezone()))
+        return max(next_available, reservation)
+
+    def get_buckets(self, worker, domain):
+        """ Buckets of `worker` for `domain`, and fleet wide ones """
+        windows = get_windows(
+            self.get_settings(worker).get('domains', []), domain)
+        return [(self.get_key(worker.get('ip'), domain), windows)] + (
+            self.global_buckets)
+
+    @staticmethod
+    def get_key(source_ip, destination_domain):
+        return '{}:token_bucket:{}:{}'.format(
+            CACHE_PREFIX, source_ip, destination_domain)
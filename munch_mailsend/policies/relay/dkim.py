@@ -5,8 +5,9 @@ from slimta.policy import RelayPolicy
 
 from munch.core.mail.utils import extract_domain
 
-from ...utils.dkim import sign
+from ...utils.dkim import sign_stream
 from ...utils.dkim import DKIMException
+from ...utils.dkim.utils import rfc822_parse
 
 # Headers must be Relaxed-Canonicalized
 # because dkim doesn't do it automatically
@@ -35,9 +36,12 @@ class Sign(RelayPolicy):
         domain = extract_domain(identity).encode('utf-8')
 
         try:
+            # Only headers are parsed, the body is hashed in place
+            # without being copied along with them
             headers_data, message_data = envelope.flatten()
-            dkim_header = sign(
-                headers_data + message_data,
+            headers, _ = rfc822_parse(headers_data)
+            dkim_header = sign_stream(
+                headers, message_data,
                 settings.MAILSEND.get('DKIM_SELECTOR', '').encode('utf-8'),
                 domain,
                 settings.MAILSEND.get('DKIM_PRIVATE_KEY', '').encode('utf-8'),
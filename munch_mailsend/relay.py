@@ -8,6 +8,8 @@ from django.conf import settings
 from django.utils.module_loading import import_string
 from slimta.relay.smtp.mx import MxSmtpRelay as MxSmtpRelayBase
 
+from .utils import normalize_line_endings
+
 log = logging.getLogger(__name__)
 
 
@@ -75,11 +77,9 @@ class MxSmtpRelay(MxSmtpRelayBase):
         del envelope.headers['Subject']
         envelope.headers.add_header('Subject', subject)
         # This is to avoid "Bare LF" errors (eg: with free.fr)
-        # Probably not the cleanest way to do it but it works
-        # TODO: see if this could be done upstream in envelope generation
-        # or if slimta needs a fix (it should not let bare \n go through...)
-        envelope.message = envelope.message.decode('utf-8').replace(
-            '\n', '\r\n').encode('utf-8')
+        # Line endings are normalized when envelopes are built, this only
+        # scans envelopes coming from a custom build_envelope_task
+        envelope.message = normalize_line_endings(envelope.message)
         # Attempt delivery as usual
         log.info('[{}] Attempting delivery from <{}> to <{}> ({})'.format(
             envelope.headers.get(
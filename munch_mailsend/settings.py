@@ -1,4 +1,5 @@
 import os
+from datetime import timedelta
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
@@ -13,12 +14,67 @@ DEFAULTS = {
     'MAILSTATUS_CACHE_TIMEOUT': 60 * 60 * 24 * 15,
     'MAILSTATUS_CACHE_PREFIX': 'status',
     'TOKEN_CACHE_TIMEOUT': 60 * 60 * 24 * 10,
+    'FINAL_STATE_CACHE_TIMEOUT': 60 * 60 * 24 * 15,
+    # Envelopes stay marked as being sent at most this long
+    'SEND_CLAIM_TIMEOUT': 60 * 10,
+    # Built envelopes kept for retries (0 to disable)
+    'ENVELOPE_CACHE_TIMEOUT': 60 * 60 * 3,
+    'ENVELOPE_CACHE_MAX_SIZE': 10 * 1024 * 1024,
+    # Backends referenced by id in task payloads:
+    # {id: (mailstatus_class_path, record_status_task_path,
+    #       build_envelope_task_path)}
+    # Never re-use an id while tasks referencing it may be queued.
+    'TASK_BACKENDS': {},
+    # Headers kept in task payloads besides "To" and X_POOL_HEADER
+    'ROUTING_HEADERS': [],
+    # Keep delayed tasks in Redis until they are due instead of publishing
+    # them with a countdown. Due tasks are published by the
+    # "publish_delayed_tasks" task, added to CELERYBEAT_SCHEDULE to run
+    # every "DELAY_QUEUE_INTERVAL" seconds, or by "run_delay_scheduler"
+    'DELAY_QUEUE_ENABLED': False,
+    'DELAY_QUEUE_BATCH_SIZE': 500,
+    'DELAY_QUEUE_INTERVAL': 1,
+    # Defer MailStatus inserts of MX workers and write them in batches
+    # of "batch_size", or once the oldest pending one is
+    # "flush_interval" milliseconds old. Pending statuses are spooled in
+    # "spool_dir" (required, one file per process) until written, and
+    # written when worker processes stop. Custom MailStatus.save() and
+    # record_status tasks are bypassed and signal receivers only get a
+    # Mail with its identifier.
+    'STATUS_SINK': {
+        'enabled': False, 'batch_size': 100, 'flush_interval': 500,
+        'spool_dir': None},
+    # Finished mails handled per "purge_raw_mail" batch
+    'PURGE_BATCH_SIZE': 1000,
+    # Tasks moved per batch (and per second) when queues of disabled
+    # workers are drained back into routing
+    'DRAIN_BATCH_SIZE': 200,
+    'DRAIN_RATE': 1000,
     'ROUTER_LOCK_TIMEOUT': 60 * 5,
     'ROUTER_LOCK_WAITING': 7,
-    'MX_WORKER_MAX_PING_FAILURES': 10,
+    # MX workers send an heartbeat every "interval" seconds and are
+    # considered down once the last one is older than "timeout" seconds
+    'WORKER_HEARTBEAT': {'interval': 5, 'timeout': 30},
+    # Worker queue sizes collected by "collect_queue_sizes" are
+    # ignored after this number of seconds. When the backlog worker policy
+    # is enabled, the task is added to CELERYBEAT_SCHEDULE to run every
+    # "QUEUE_SIZES_INTERVAL" seconds
+    'QUEUE_SIZES_CACHE_TIMEOUT': 15,
+    'QUEUE_SIZES_INTERVAL': 5,
     'MX_WORKER_QUEUE_PREFIX': 'mailsend.mail.send.first:{ip}',
     'MX_WORKER_QUEUE_RETRY_PREFIX': 'mailsend.mail.send.retry:{ip}',
     'ROUTING_QUEUE': 'mailsend.mail.routing',
+    # Priority lanes as (name, minimum priority) tuples, most prioritized
+    # first. Each lane has its own routing and MX worker queues (named
+    # "<queue>:<lane>"). Tasks below every minimum priority go to the
+    # default lane, which uses the queues above. Ex:
+    # [('system', 100), ('transactional', 60)]
+    # Lanes isolate rather than prioritize: workers consume every lane in
+    # turn, so a campaign backlog doesn't queue ahead of other lanes, but
+    # each lane gets the same share of a worker (no weights).
+    # CELERYD_PREFETCH_MULTIPLIER defaults to 1 when lanes are set, so
+    # at most one campaign task per process is prefetched ahead of them.
+    'PRIORITY_LANES': [],
     'QUEUED_MAIL_QUEUE': 'mailsend.mail.queued',
     'RETRY_POLICY': {
         # Minimun time between two retries
@@ -26,7 +82,16 @@ DEFAULTS = {
         # Maximum time between two retries
         'max_retry_interval': 3600,
         # Time before we drop the mail and notify sender
-        'time_before_drop': 2 * 24 * 3600},
+        'time_before_drop': 2 * 24 * 3600,
+        # Spread retries by +/- this ratio
+        'jitter': 0},
+    # Retry policies overriding RETRY_POLICY, first match wins. Each one
+    # may restrict itself to destination domains matching a "domains"
+    # regex and/or replies whose code or enhanced status code starts
+    # with one of "reply_codes". Ex:
+    # {'reply_codes': ['421', '4.7.'], 'min_retry_interval': 1800,
+    #  'max_retry_interval': 7200, 'time_before_drop': 3 * 24 * 3600}
+    'RETRY_POLICIES': [],
     'BLACKLISTED_HEADERS': [],
     'RELAY_POLICIES': [
         'munch_mailsend.policies.relay.headers.StripBlacklisted',
@@ -35,7 +100,13 @@ DEFAULTS = {
         'munch_mailsend.policies.mx.pool.Policy',
         'munch_mailsend.policies.mx.rate_limit.Policy',
         'munch_mailsend.policies.mx.greylist.Policy',
-        'munch_mailsend.policies.mx.warm_up.Policy'],
+        'munch_mailsend.policies.mx.warm_up.Policy',
+        'munch_mailsend.policies.mx.backlog.Policy'],
+    # Fleet wide limits enforced by "token_bucket" worker policy, by
+    # destination domain and/or destination MX host:
+    # {'domains': [(pattern, windows)], 'mx': [(pattern, windows)]}
+    # with windows as (limit, period) or (limit, period, burst) tuples.
+    'GLOBAL_RATE_LIMITS': {'domains': [], 'mx': []},
     'SANDBOX': False,
     'TASKS_SETTINGS': {
         'send_email': {
@@ -94,3 +165,42 @@ for field in MANDATORY_SETTINGS:
 # Set some defaults
 for field in DEFAULTS:
     settings.MAILSEND.setdefault(field, DEFAULTS[field])
+
+# Deferred MailStatus must survive worker crashes
+if settings.MAILSEND['STATUS_SINK'].get('enabled') and \
+        not settings.MAILSEND['STATUS_SINK'].get('spool_dir'):
+    raise ImproperlyConfigured(
+        'Must set "MAILSEND[\'STATUS_SINK\'][\'spool_dir\']" if the '
+        'status sink is enabled.')
+
+
+# Periodic tasks run on gc workers
+def add_beat_entry(task, interval):
+    """ Schedule `task` every `interval` seconds unless already scheduled """
+    beat_schedule = getattr(settings, 'CELERYBEAT_SCHEDULE', None) or {}
+    if not any(
+            entry.get('task') == 'munch_mailsend.tasks.{}'.format(task)
+            for entry in beat_schedule.values()):
+        beat_schedule['munch_mailsend.{}'.format(task)] = {
+            'task': 'munch_mailsend.tasks.{}'.format(task),
+            'schedule': timedelta(seconds=interval),
+            # Don't pile up runs when gc workers are late
+            'options': {'expires': interval}}
+    settings.CELERYBEAT_SCHEDULE = beat_schedule
+
+
+# Due tasks of the delay queue are published by gc workers
+if settings.MAILSEND['DELAY_QUEUE_ENABLED']:
+    add_beat_entry(
+        'publish_delayed_tasks', settings.MAILSEND['DELAY_QUEUE_INTERVAL'])
+
+# The backlog policy reads queue sizes collected by gc workers
+if 'munch_mailsend.policies.mx.backlog.Policy' in settings.MAILSEND.get(
+        'WORKER_POLICIES', []):
+    add_beat_entry(
+        'collect_queue_sizes', settings.MAILSEND['QUEUE_SIZES_INTERVAL'])
+
+# Each prefetched task may come from a bulk lane
+if settings.MAILSEND['PRIORITY_LANES'] and not hasattr(
+        settings, 'CELERYD_PREFETCH_MULTIPLIER'):
+    settings.CELERYD_PREFETCH_MULTIPLIER = 1
@@ -1,6 +1,8 @@
 from django.conf import settings
 
 from .policies import run_policies
+from .utils.purge import mark_for_purge
+from .utils.tasks import set_final_state
 
 
 def pre_save_mailstatus(sender, instance, raw, **kwargs):
@@ -8,12 +10,19 @@ def pre_save_mailstatus(sender, instance, raw, **kwargs):
     if not instance.pk and not raw:
         if not instance.source_ip:
             instance.source_ip = settings.MAILSEND.get('SMTP_WORKER_SRC_ADDR')
+    # Final state flag checked by routing and sending tasks
+    if not instance.pk and instance.status in [
+            instance.DELETED] + list(instance.FINAL_STATES):
+        set_final_state(instance.mail.identifier, instance.status)
     # Policies
     if not instance.pk:
         run_policies(instance, 'mailstatus_pre_save')
 
 
 def post_save_mailstatus(sender, instance, created, raw, **kwargs):
+    # RawMail of finished mails are detached by "purge_raw_mail" task
+    if created and instance.status in instance.FINAL_STATES:
+        mark_for_purge(instance.mail.identifier)
     # Policies
     if created:
         run_policies(instance, 'mailstatus_post_save')
@@ -1,7 +1,7 @@
 import uuid
-import socket
 import logging
 from random import randint
+from itertools import product
 from datetime import timedelta
 
 from celery import task
@@ -13,6 +13,7 @@ from django.utils.module_loading import import_string
 from slimta.smtp.reply import Reply
 from slimta.relay.smtp.mx import PermanentRelayError
 from slimta.relay.smtp.mx import TransientRelayError
+from amqp.exceptions import NotFound
 from django_redis import get_redis_connection
 
 from munch.core.mail.utils import extract_domain
@@ -22,12 +23,31 @@ from munch.core.mail.exceptions import SoftFailure
 from munch.core.utils import get_worker_types
 
 from .utils import save_timer
-from .utils import ExponentialBackOff
+from .utils import get_backoff
+from .utils import get_retry_policy
 from .utils.tasks import acquire_lock
 from .utils.tasks import release_lock
+from .utils.tasks import get_final_state
+from .utils.tasks import get_final_state_key
+from .utils.tasks import cache_envelope
+from .utils.tasks import get_cached_envelope
+from .utils.tasks import delete_cached_envelope
+from .utils.sink import get_status_sink
+from .utils.delay import delay_task
+from .utils.delay import publish_due_tasks
+from .utils.purge import purge_raw_mails
+from .utils.payloads import encode_backend
+from .utils.payloads import decode_backend
+from .utils.payloads import get_routing_headers
+from .utils.lanes import get_lanes
+from .utils.lanes import get_lane_queue_name
+from .utils.lanes import get_routing_options
 from .models import Worker
 from .amqp import get_queue
+from .amqp import drain_queue
 from .amqp import get_queue_size
+from .amqp import get_task_signature
+from .amqp import get_confirmed_connection
 from .relay import MxSmtpRelay
 
 log = logging.getLogger(__name__)
@@ -44,12 +64,22 @@ worker_types = get_worker_types()
     retry_message='Error while trying to send email. Retrying.')
 @save_timer(name='mailsend.tasks.send_email')
 def send_email(
-        identifier, headers, attempts, mailstatus_class_path,
-        record_status_task_path, build_envelope_task_path, token=None):
+        identifier, headers, attempts, mailstatus_class_path=None,
+        record_status_task_path=None, build_envelope_task_path=None,
+        token=None, backend=None, version=1, lane=None):
     # Retrieve MailStatus class and record_status task
-    mailstatus_class = import_string(mailstatus_class_path)
-    record_status_task = import_string(record_status_task_path)
-    build_envelope_task = import_string(build_envelope_task_path)
+    task_backend = decode_backend(
+        version, backend, mailstatus_class_path,
+        record_status_task_path, build_envelope_task_path)
+    backend_kwargs = encode_backend(task_backend)
+    # Every task of this envelope stays in its priority lane
+    if lane:
+        backend_kwargs['lane'] = lane
+    headers = get_routing_headers(headers)
+    mailstatus_class = import_string(task_backend.mailstatus_class_path)
+    record_status_task = import_string(task_backend.record_status_task_path)
+    build_envelope_task = import_string(
+        task_backend.build_envelope_task_path)
 
     # Helper to create a new MailStatus
     def record_new_status(status, identifier, headers, reply, ehlo):
@@ -79,8 +109,12 @@ def send_email(
         #   - Creation of object derived from AbstractMailStatus
         #     will use the local worker IP address as source
         #     (although we could pass it)
+        # With the status sink, only the database insert is deferred.
         try:
-            record_status_task(mailstatus, identifier, ehlo, reply)
+            if settings.MAILSEND['STATUS_SINK']['enabled']:
+                get_status_sink(mailstatus_class).add(mailstatus, identifier)
+            else:
+                record_status_task(mailstatus, identifier, ehlo, reply)
         except SoftFailure as exc:
             log.info(
                 'SoftFailure during "send_email" task ('
@@ -88,6 +122,7 @@ def send_email(
             return
         if status in AbstractMailStatus.FINAL_STATES:
             delete_envelope_token(identifier)
+            delete_cached_envelope(identifier)
 
     # Helper to properly handle a transient failure
     def handle_transient_failure(
@@ -96,7 +131,10 @@ def send_email(
             '[{}] Handling transient failure ({} {})'
             ' (attempts:{}).'.format(
                 identifier, reply.code, reply.message, attempts))
-        backoff = ExponentialBackOff(settings.MAILSEND.get('RETRY_POLICY'))
+        backoff = get_backoff(get_retry_policy(
+            settings.MAILSEND['RETRY_POLICIES'],
+            settings.MAILSEND.get('RETRY_POLICY'),
+            domain=extract_domain(headers.get('To')), reply=reply))
         wait = backoff(attempts + 1)
         if wait:
             not_before = timezone.now() + timedelta(seconds=wait)
@@ -104,59 +142,24 @@ def send_email(
                 AbstractMailStatus.DELAYED,
                 identifier, headers, reply, ehlo)
             route_envelope.apply_async(
-                (
-                    identifier, headers,
-                    attempts + 1,
-                    mailstatus_class_path,
-                    record_status_task_path,
-                    build_envelope_task_path),
-                {'not_before': not_before, 'reply': reply})
+                (identifier, headers, attempts + 1),
+                dict(backend_kwargs, not_before=not_before, reply=reply),
+                **get_routing_options(lane))
         else:
             reply.message += ' (Too many retries)'
             record_new_status(
                 AbstractMailStatus.DROPPED, identifier, headers, reply, ehlo)
 
-    if not any([t in worker_types for t in ['mx', 'all']]):
-        countdown = 60 * 10
-        log.error(
-            '[{}] [worker:{}] Received "send_email" task but '
-            'this is not an MX worker ({}) (re-routing in {} minutes)'.format(
-                identifier,
-                settings.MAILSEND['SMTP_WORKER_SRC_ADDR'],
-                worker_type, countdown / 60))
-        reply = Reply(
-            '450',
-            (
-                '4.0.0 Unhandled delivery error: Re-trying to send '
-                'envelope in {} minutes.').format(countdown / 60))
-        ehlo = settings.MAILSEND['SMTP_WORKER_SRC_ADDR']
-        record_new_status(
-            AbstractMailStatus.DELAYED, identifier, headers, reply, ehlo)
-        route_envelope.apply_async(
-            (
-                identifier, headers, attempts,
-                mailstatus_class_path,
-                record_status_task_path,
-                build_envelope_task_path),
-            {'not_before': None, 'reply': None},
-            countdown=countdown)
-        return
-
-    # Envelope with final states must be discards
-    latest_status = mailstatus_class.objects.filter(
-        status__in=[AbstractMailStatus.DELETED] +
-        list(AbstractMailStatus.FINAL_STATES), mail__identifier=identifier)
-    if latest_status:
+    # Reject duplicate, stale and already handled tasks with a single
+    # Redis call, before any database or envelope work
+    claim = claim_envelope(identifier, token)
+    if claim == CLAIM_FINAL:
         log.debug(
-            "[{}] Envelope ignored because it has already been "
-            "{} at {}".format(
-                identifier, latest_status[0].status,
-                latest_status[0].creation_date))
+            "[{}] Envelope ignored because it has already reached "
+            "a final state".format(identifier))
         return
-
     # If envelope doesn't have token in cache, there is a serious problem
-    current_token = get_envelope_token(identifier)
-    if current_token is None:
+    if claim == CLAIM_NO_TOKEN:
         reply = Reply(
             '450',
             '4.0.0 Unhandled delivery error: No envelope token found in cache')
@@ -168,68 +171,111 @@ def send_email(
             "Envelope will be re-routed.".format(identifier), exc_info=True)
         return
     # If token mismatch, maybe this task is a duplicate (problem incoming)
-    if token != current_token:
+    if claim == CLAIM_STALE:
+        log.info(
+            "[{}] Discarding this send_email task "
+            "because token doesn't match".format(identifier))
+        return
+    if claim == CLAIM_IN_FLIGHT:
         log.info(
-            "[{}] Discarding these send_email task "
-            "because token doesn't match")
+            "[{}] Discarding this send_email task because the "
+            "envelope is already being sent".format(identifier))
         return
     log.debug('[{}] Token is valid: {}'.format(identifier, token))
 
-    if attempts:
-        log.debug(
-            '[{}] [worker:{}] Retrying to send (attempts:{}) '
-            '(from:{}) (to:{})...'.format(
-                identifier, settings.MAILSEND['SMTP_WORKER_SRC_ADDR'],
-                attempts, headers['From'], headers['To']))
-    else:
-        log.debug(
-            '[{}] [worker:{}] Sending envelope '
-            '(from:{}) (to:{})...'.format(
-                identifier, settings.MAILSEND['SMTP_WORKER_SRC_ADDR'],
-                headers['From'], headers['To']))
-
     try:
-        relay = MxSmtpRelay()
-        # We call parent (slimta.relay.Relay) _attempt()
-        # to run relay policies
-        try:
-            envelope = build_envelope_task(identifier)
-        except SoftFailure as exc:
-            log.info(
-                'SoftFailure during "send_email" task ('
-                'discarding this task): {}'.format(str(exc)), exc_info=True)
+        if not any([t in worker_types for t in ['mx', 'all']]):
+            countdown = 60 * 10
+            log.error(
+                '[{}] [worker:{}] Received "send_email" task but this '
+                'is not an MX worker ({}) (re-routing in {} minutes)'.format(
+                    identifier,
+                    settings.MAILSEND['SMTP_WORKER_SRC_ADDR'],
+                    worker_types, countdown / 60))
+            reply = Reply(
+                '450',
+                (
+                    '4.0.0 Unhandled delivery error: Re-trying to send '
+                    'envelope in {} minutes.').format(countdown / 60))
+            ehlo = settings.MAILSEND['SMTP_WORKER_SRC_ADDR']
+            record_new_status(
+                AbstractMailStatus.DELAYED, identifier, headers, reply, ehlo)
+            delay_task(
+                route_envelope, (identifier, headers, attempts),
+                dict(backend_kwargs, not_before=None, reply=None),
+                countdown=countdown, **get_routing_options(lane))
             return
-        reply = relay._attempt(envelope, attempts)
-        # We assume single-recipient
-        if isinstance(reply, (list, tuple)):
-            reply = reply[0]
-        elif isinstance(reply, dict):
-            reply = list(reply.values())[0]
-    except TransientRelayError as exc:
-        handle_transient_failure(
-            identifier, headers, attempts, exc.reply, relay.ehlo)
-    except PermanentRelayError as exc:
-        log.debug(
-            '[{}] [worker:{}] Handling PermanentRelayError'
-            'with reply: {}'.format(
-                identifier,
-                settings.MAILSEND['SMTP_WORKER_SRC_ADDR'],
-                exc.reply))
-        record_new_status(
-            AbstractMailStatus.BOUNCED,
-            identifier, headers, exc.reply, relay.ehlo)
-    except (Exception, BrokenPipeError, IOError, OSError) as exc:
-        reply = Reply('450', '4.0.0 Unhandled delivery error: ' + str(exc))
-        handle_transient_failure(
-            identifier, headers, attempts, reply, relay.ehlo)
-        log.error(
-            "[{}] Error while trying to send email via Slimta. "
-            "Envelope will be re-routed.".format(
-                identifier), exc_info=True)
-    else:
-        record_new_status(
-            AbstractMailStatus.DELIVERED,
-            identifier, headers, reply, relay.ehlo)
+
+        if attempts:
+            log.debug(
+                '[{}] [worker:{}] Retrying to send (attempts:{}) '
+                '(to:{})...'.format(
+                    identifier, settings.MAILSEND['SMTP_WORKER_SRC_ADDR'],
+                    attempts, headers.get('To')))
+        else:
+            log.debug(
+                '[{}] [worker:{}] Sending envelope '
+                '(to:{})...'.format(
+                    identifier, settings.MAILSEND['SMTP_WORKER_SRC_ADDR'],
+                    headers.get('To')))
+
+        envelope, cached = None, False
+        try:
+            relay = MxSmtpRelay()
+            # Retries reuse the envelope built (and signed) by a previous
+            # attempt
+            if attempts:
+                envelope = get_cached_envelope(identifier)
+                cached = envelope is not None
+            if envelope is None:
+                try:
+                    envelope = build_envelope_task(identifier)
+                except SoftFailure as exc:
+                    log.info(
+                        'SoftFailure during "send_email" task ('
+                        'discarding this task): {}'.format(str(exc)),
+                        exc_info=True)
+                    return
+                # Same as parent (slimta.relay.Relay) _attempt()
+                # which runs relay policies before attempt()
+                relay._run_policies(envelope)
+            else:
+                log.debug('[{}] Using cached envelope'.format(identifier))
+            reply = relay.attempt(envelope, attempts)
+            # We assume single-recipient
+            if isinstance(reply, (list, tuple)):
+                reply = reply[0]
+            elif isinstance(reply, dict):
+                reply = list(reply.values())[0]
+        except TransientRelayError as exc:
+            if not cached:
+                cache_envelope(identifier, envelope)
+            handle_transient_failure(
+                identifier, headers, attempts, exc.reply, relay.ehlo)
+        except PermanentRelayError as exc:
+            log.debug(
+                '[{}] [worker:{}] Handling PermanentRelayError'
+                'with reply: {}'.format(
+                    identifier,
+                    settings.MAILSEND['SMTP_WORKER_SRC_ADDR'],
+                    exc.reply))
+            record_new_status(
+                AbstractMailStatus.BOUNCED,
+                identifier, headers, exc.reply, relay.ehlo)
+        except (Exception, BrokenPipeError, IOError, OSError) as exc:
+            reply = Reply('450', '4.0.0 Unhandled delivery error: ' + str(exc))
+            handle_transient_failure(
+                identifier, headers, attempts, reply, relay.ehlo)
+            log.error(
+                "[{}] Error while trying to send email via Slimta. "
+                "Envelope will be re-routed.".format(
+                    identifier), exc_info=True)
+        else:
+            record_new_status(
+                AbstractMailStatus.DELIVERED,
+                identifier, headers, reply, relay.ehlo)
+    finally:
+        release_envelope_claim(identifier, token)
 
 
 @task_autoretry(
@@ -241,9 +287,9 @@ def send_email(
     retry_message='Error while trying to route envelope. Retrying.')
 @save_timer(name='mailsend.tasks.route_envelope')
 def route_envelope(
-        identifier, headers, attempts, mailstatus_class_path,
-        record_status_task_path, build_envelope_task_path,
-        not_before=None, reply=None):
+        identifier, headers, attempts, mailstatus_class_path=None,
+        record_status_task_path=None, build_envelope_task_path=None,
+        not_before=None, reply=None, backend=None, version=1, lane=None):
     """
         This envelope routing task take initiate attempt
         to free Slimta Edge from SMTP connection
@@ -251,16 +297,20 @@ def route_envelope(
     record_performance = settings.STATSD_ENABLED
 
     lock = None
-    mailstatus_class = import_string(mailstatus_class_path)
-    latest_status = mailstatus_class.objects.filter(
-        status__in=[AbstractMailStatus.DELETED] +
-        list(AbstractMailStatus.FINAL_STATES), mail__identifier=identifier)
-    if latest_status:
+    task_backend = decode_backend(
+        version, backend, mailstatus_class_path,
+        record_status_task_path, build_envelope_task_path)
+    backend_kwargs = encode_backend(task_backend)
+    # Every task of this envelope stays in its priority lane
+    if lane:
+        backend_kwargs['lane'] = lane
+    headers = get_routing_headers(headers)
+    mailstatus_class = import_string(task_backend.mailstatus_class_path)
+    final_state = get_final_state(identifier, mailstatus_class)
+    if final_state:
         log.debug(
             "[{}] Envelope ignored because it has already been "
-            "{} at {}".format(
-                identifier, latest_status[0].status,
-                latest_status[0].creation_date))
+            "{}".format(identifier, final_state))
         return
     # Ensure we close Django database connection because we don't
     # want to have opened connections while waiting for lock.
@@ -315,30 +365,29 @@ def route_envelope(
                     'destination_domain': extract_domain(
                         headers.get('To'))}
                 if not attempts:
-                    routing_key = worker.get_queue_name()
+                    routing_key = worker.get_queue_name(lane=lane)
                 else:
-                    routing_key = worker.get_queue_name(retry=True)
+                    routing_key = worker.get_queue_name(
+                        retry=True, lane=lane)
 
                 attempt = send_email.s(
                     identifier, headers, attempts,
-                    mailstatus_class_path,
-                    record_status_task_path,
-                    build_envelope_task_path,
-                    token=set_envelope_token(identifier))
+                    token=set_envelope_token(identifier), **backend_kwargs)
                 now = timezone.now()
+                countdown = 0
                 if next_available:
                     countdown = max(0, (next_available - now).total_seconds())
                 # And apply countdown to task if > 0
                 if countdown:
                     mail_status_kwargs.update({
                         'creation_date': now + timedelta(seconds=countdown)})
-                    attempt.set(countdown=countdown)
 
                 log.info(
                     '[{}] Queued with "{}" routing key in {} seconds'.format(
                         identifier, routing_key, int(countdown)))
                 mailstatus = mailstatus_class(**mail_status_kwargs)
-                record_status_task = import_string(record_status_task_path)
+                record_status_task = import_string(
+                    task_backend.record_status_task_path)
                 try:
                     record_status_task(mailstatus, identifier, attempts + 1)
                 except SoftFailure as exc:
@@ -351,20 +400,18 @@ def route_envelope(
 
                 release_lock(lock_name)
 
-                return attempt.apply_async(routing_key=routing_key).id
+                return delay_task(
+                    send_email, attempt.args, attempt.kwargs,
+                    countdown=countdown, routing_key=routing_key)
             else:
                 log.debug(
                     '[{}] No worker available. Re-route envelope '
                     'in 5 minutes'.format(identifier))
                 release_lock(lock_name)
-                return route_envelope.apply_async(
-                    (
-                        identifier, headers, attempts,
-                        mailstatus_class_path,
-                        record_status_task_path,
-                        build_envelope_task_path),
-                    {'not_before': not_before, 'reply': reply},
-                    countdown=60 * 5).id
+                return delay_task(
+                    route_envelope, (identifier, headers, attempts),
+                    dict(backend_kwargs, not_before=not_before, reply=reply),
+                    countdown=60 * 5, **get_routing_options(lane))
         except Exception:
             release_lock(lock_name)
             raise
@@ -373,55 +420,119 @@ def route_envelope(
             '[{}] Failed to acquire lock after waiting {} second(s). '
             'Re-route task in 1-6 seconds.'.format(
                 identifier, lock_blocking_timeout))
-        return route_envelope.apply_async(
-            (identifier, headers, attempts),
-            {
-                'mailstatus_class_path': mailstatus_class_path,
-                'record_status_task_path': record_status_task_path,
-                'build_envelope_task_path': build_envelope_task_path,
-                'not_before': not_before, 'reply': reply},
-            countdown=randint(1, 6)).id
+        return delay_task(
+            route_envelope, (identifier, headers, attempts),
+            dict(backend_kwargs, not_before=not_before, reply=reply),
+            countdown=randint(1, 6), **get_routing_options(lane))
 
     if lock:
         release_lock(lock_name)
 
 
+@task
+def publish_delayed_tasks():
+    """ Publish tasks of the delay queue that are due """
+    return publish_due_tasks()
+
+
+@task
+def purge_raw_mail():
+    """ Detach and delete RawMail of mails that reached a final state """
+    mails, raw_mails = purge_raw_mails()
+    log.info('{} mail(s) detached from their RawMail, {} RawMail '
+             'deleted'.format(mails, raw_mails))
+    return mails, raw_mails
+
+
 @task
 def ping_workers():
-    """ Ping enabled worker and disable them if they doesn't respond a pong """
+    """
+    Disable enabled workers whose heartbeat is stale and re-route
+    their queued tasks
+    """
     from .models import Worker
 
-    workers = Worker.objects.filter(enabled=True).only('pk', 'name')
-    pings = [list(node)[0] for node in current_app.control.ping(timeout=3)]
-    max_failure = settings.MAILSEND['MX_WORKER_MAX_PING_FAILURES']
-
+    stale_ips = Worker.objects.get_stale_ips()
+    if not stale_ips:
+        return
+    workers = list(Worker.objects.filter(
+        enabled=True, ip__in=stale_ips).only('pk', 'ip', 'name'))
     for worker in workers:
-        log.debug('[{}] Pinging worker... (timeout=3)'.format(worker.ip))
-        key = '{}:worker:ping_failures:{}'.format(
-            settings.MAILSEND.get('CACHE_PREFIX'), worker.ip)
-        if worker.name not in pings:
-            failure_counter = conn.get(key)
-            if failure_counter is None:
-                conn.set(key, 0, 60 * 5)
-                failure_counter = 0
-            log.debug('[{}] No response (failure={},max={})'.format(
-                worker.ip, failure_counter, max_failure))
-            if failure_counter > max_failure:
-                log.warn(
-                    "[{}] Worker (pk:{}) seems to have crashed because it "
-                    "doesn't have updated its status. Disabling it...".format(
-                        worker.name, worker.pk))
-                worker.enabled = False
-                worker.save()
-                conn.delete(key)
-            else:
-                log.debug(
-                    "[{}] This is a soft warning, let's see "
-                    "next ping...".format(worker.ip))
-                conn.incr(key)
-        else:
-            log.debug('[{}] Worker is up'.format(worker.ip))
-            conn.delete(key)
+        log.warn(
+            "[{}] Worker (pk:{}) seems to have crashed because it "
+            "doesn't send heartbeats anymore. Disabling it...".format(
+                worker.name, worker.pk))
+        Worker.objects.remove_from_cache(worker)
+    Worker.objects.filter(pk__in=[w.pk for w in workers]).update(
+        enabled=False)
+    Worker.objects.remove_heartbeats(stale_ips)
+    if workers:
+        check_disabled_workers.delay()
+
+
+@task
+def collect_queue_sizes():
+    """
+    Cache the number of tasks queued for each enabled worker and report
+    the backlog of each priority lane
+    """
+    from .models import Worker
+
+    sizes = {}
+    lanes = get_lanes()
+    lane_sizes = {lane: {'routing': 0, 'send': 0} for lane in lanes}
+    with current_app.connection() as connection:
+        channel = connection.channel()
+        try:
+            for lane in lanes:
+                queue = get_queue(channel, get_lane_queue_name(
+                    settings.MAILSEND['ROUTING_QUEUE'], lane))
+                try:
+                    lane_sizes[lane]['routing'] = get_queue_size(queue)
+                except NotFound:
+                    channel = connection.channel()
+            for worker in Worker.objects.filter(enabled=True).only('ip'):
+                sizes[worker.ip] = 0
+                for lane in lanes:
+                    for retry in (False, True):
+                        queue = worker.get_queue(
+                            channel, retry=retry, lane=lane)
+                        try:
+                            size = worker.get_queue_size(queue)
+                        except NotFound:
+                            # Broker closes the channel on missing queues
+                            channel = connection.channel()
+                            continue
+                        sizes[worker.ip] += size
+                        lane_sizes[lane]['send'] += size
+        finally:
+            channel.close()
+    Worker.objects.set_queue_sizes(sizes)
+
+    if settings.STATSD_ENABLED:
+        from statsd.defaults.django import statsd
+        for lane, lane_size in lane_sizes.items():
+            for name, size in lane_size.items():
+                statsd.gauge('mailsend.lanes.{}.{}'.format(
+                    lane or 'default', name), size)
+    log.debug('Priority lanes backlog: {}'.format(lane_sizes))
+    return sizes
+
+
+def reroute_task(producer, body):
+    """
+    Publish a queued send_email or route_envelope task back into routing,
+    keeping its arguments
+    """
+    args, kwargs = get_task_signature(body)
+    # A new token is given by route_envelope
+    kwargs.pop('token', None)
+    log.info(
+        '[{}] Republishing mail into routing task (attempts={})...'.format(
+            args[0], args[2]))
+    route_envelope.apply_async(
+        args, kwargs, producer=producer,
+        **get_routing_options(kwargs.get('lane')))
 
 
 @task
@@ -430,43 +541,32 @@ def check_disabled_workers():
     Check if disabled workers have tasks in queue, then re-route them
     """
     from .models import Worker
-    from .tasks import route_envelope
-
-    class Counter:
-        pass
-    c = current_app.connection()
-    counter = Counter()
-    counter.count = 0
 
-    def process_message(body, message):
-        identifier = body.get('args', [])[0]
-        attempts = body.get('args')[1]
-        log.info(
-            '[{}] Republishing mail into routing task (attempts={})...'.format(
-                identifier, attempts))
-        route_envelope.apply_async(body.get('args'))
-        message.ack()
-        counter.count += 1
-
-    for worker in Worker.objects.filter(enabled=False).only('ip'):
-        queues = [
-            worker.get_queue(connection),
-            worker.get_queue(connection, retry=True)]
-        for queue in queues:
-            queue = worker.get_queue(connection)
-            size = worker.get_queue_size(queue)
-            if size:
-                log.info(
-                    "{} tasks remaining in disabled queue {}. Republishing them...".format(
-                        size, queue.name))
-                task_consumer = current_app.amqp.TaskConsumer(
-                    c, queues=[queue], callbacks=[process_message])
-                with task_consumer:
-                    while counter.count <= size:
-                        try:
-                            connection.drain_events(timeout=2)
-                        except socket.timeout:
-                            return
+    with get_confirmed_connection(current_app) as connection:
+        channel = connection.channel()
+        try:
+            for worker in Worker.objects.filter(enabled=False).only('ip'):
+                for lane, retry in product(get_lanes(), (False, True)):
+                    queue = worker.get_queue(channel, retry=retry, lane=lane)
+                    try:
+                        size = worker.get_queue_size(queue)
+                    except NotFound:
+                        # Broker closes the channel on missing queues
+                        channel = connection.channel()
+                        continue
+                    if not size:
+                        continue
+                    log.info(
+                        "{} tasks remaining in disabled queue {}. "
+                        "Republishing them...".format(size, queue.name))
+                    moved = drain_queue(
+                        current_app, channel, queue, reroute_task,
+                        batch_size=settings.MAILSEND['DRAIN_BATCH_SIZE'],
+                        rate=settings.MAILSEND['DRAIN_RATE'])
+                    log.info("{} tasks moved from {} to routing.".format(
+                        moved, queue.name))
+        finally:
+            channel.close()
 
 
 @task
@@ -476,37 +576,21 @@ def dispatch_queued():
     This task is not used for now but maybe a management command
     could be usefull.
     """
-    from .tasks import route_envelope
-
-    class Counter:
-        pass
-    connection = current_app.connection()
-    counter = Counter()
-    counter.count = 0
-
-    def process_message(body, message):
-        identifier = body.get('args', [])[0]
-        attempts = body.get('args')[1]
-        log.info(
-            'Republishing {} mail into routing task (attempts={})...'.format(
-                identifier, attempts))
-        message.ack()
-        route_envelope.apply_async(body.get('args'))
-        counter.count += 1
-
-    queue = get_queue(connection, settings.MAILSEND['QUEUED_MAIL_QUEUE'])
-    size = get_queue_size(queue)
-    if size:
-        log.info("Rerouting {} tasks from {} queue...".format(
-            size, settings.MAILSEND['QUEUED_MAIL_QUEUE']))
-        task_consumer = current_app.amqp.TaskConsumer(
-            connection, queues=[queue], callbacks=[process_message])
-        with task_consumer:
-            while counter.count <= size:
-                try:
-                    connection.drain_events(timeout=2)
-                except socket.timeout:
-                    return
+    with get_confirmed_connection(current_app) as connection:
+        channel = connection.channel()
+        try:
+            queue = get_queue(
+                channel, settings.MAILSEND['QUEUED_MAIL_QUEUE'])
+            size = get_queue_size(queue)
+            if size:
+                log.info("Rerouting {} tasks from {} queue...".format(
+                    size, settings.MAILSEND['QUEUED_MAIL_QUEUE']))
+                drain_queue(
+                    current_app, channel, queue, reroute_task,
+                    batch_size=settings.MAILSEND['DRAIN_BATCH_SIZE'],
+                    rate=settings.MAILSEND['DRAIN_RATE'])
+        finally:
+            channel.close()
 
 
 def get_envelope_token(identifier):
@@ -527,3 +611,64 @@ def set_envelope_token(identifier):
 def delete_envelope_token(identifier):
     return conn.delete('{}:token:{}'.format(
         settings.MAILSEND['CACHE_PREFIX'], identifier))
+
+
+CLAIM_IN_FLIGHT = -3
+CLAIM_STALE = -2
+CLAIM_FINAL = -1
+CLAIM_NO_TOKEN = 0
+CLAIM_OK = 1
+
+# KEYS: final state flag, envelope token, in-flight marker
+# ARGV: task token, in-flight marker timeout
+claim_envelope_script = conn.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return -1
+end
+local current = redis.call('GET', KEYS[2])
+if not current then
+    return 0
+end
+if current ~= ARGV[1] then
+    return -2
+end
+if redis.call('GET', KEYS[3]) == ARGV[1] then
+    return -3
+end
+redis.call('SET', KEYS[3], ARGV[1], 'EX', ARGV[2])
+return 1
+""")
+
+# KEYS: in-flight marker
+# ARGV: task token
+release_claim_script = conn.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+def _in_flight_key(identifier):
+    return '{}:inflight:{}'.format(
+        settings.MAILSEND['CACHE_PREFIX'], identifier)
+
+
+def claim_envelope(identifier, token):
+    """
+    Atomically check that `identifier` hasn't reached a final state,
+    that `token` is its current envelope token and mark it in flight.
+    Returns one of the CLAIM_* values.
+    """
+    return claim_envelope_script(
+        keys=[
+            get_final_state_key(identifier),
+            '{}:token:{}'.format(
+                settings.MAILSEND['CACHE_PREFIX'], identifier),
+            _in_flight_key(identifier)],
+        args=[token or '', settings.MAILSEND['SEND_CLAIM_TIMEOUT']])
+
+
+def release_envelope_claim(identifier, token):
+    return release_claim_script(
+        keys=[_in_flight_key(identifier)], args=[token or ''])
@@ -1,3 +1,4 @@
+import re
 from functools import wraps
 
 from django.conf import settings
@@ -6,10 +7,24 @@ from slimta.envelope import Envelope
 from .backoff import *  # noqa
 
 
+BARE_LF = re.compile(br'(?<!\r)\n')
+
+
+def normalize_line_endings(data):
+    """ Turn bare LF into CRLF, leaving existing CRLF untouched.
+
+    Returns `data` itself (no copy) when there is nothing to change.
+    """
+    if BARE_LF.search(data) is None:
+        return data
+    return BARE_LF.sub(b'\r\n', data)
+
+
 def message_to_envelope(message):
     generated_message = message.message()
     envelope = Envelope()
     envelope.parse(generated_message.as_bytes())
+    envelope.message = normalize_line_endings(envelope.message)
     envelope.sender = message.from_email
     envelope.recipients.append(message.to[0])
     return envelope
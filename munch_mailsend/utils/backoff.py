@@ -1,4 +1,10 @@
+import re
 import math
+import random
+
+__all__ = ['ExponentialBackOff', 'get_backoff', 'get_retry_policy']
+
+_backoffs = {}
 
 
 class ExponentialBackOff:
@@ -8,6 +14,8 @@ class ExponentialBackOff:
     This one do not care about the envelope, only relies on timings
 
     Basic formula is A*e**n
+
+    The whole schedule is computed once, calls are a lookup.
     """
     _base = 250
 
@@ -18,6 +26,9 @@ class ExponentialBackOff:
           - max_retry_interval: Maximum time (secs) between two retries
           - time_before_drop: Time (secs) before we drop the mail
             and notify the sender
+          and optionally:
+          - jitter: delays are randomly spread by this ratio (eg. 0.1
+            for +/- 10%) so retries don't come back in waves
         """
         try:
             self.min_retry_interval = retry_policy['min_retry_interval']
@@ -27,10 +38,12 @@ class ExponentialBackOff:
             raise KeyError(
                 'RETRY_POLICY must define ''"min_retry_interval", '
                 '"max_retry_interval" and "time_before_drop')
+        self.jitter = retry_policy.get('jitter', 0)
         # for cases where the min_retry_interval is under self._base
         # ensure the difference is always at least 1
         self.base = min(self._base, self.min_retry_interval - 1)
         self.A = self.get_A()
+        self.schedule, self.cumulative = self.get_schedule()
 
     def get_A(self):
         return (self.min_retry_interval - self.base) / math.e
@@ -40,9 +53,55 @@ class ExponentialBackOff:
             self.A * math.e**attempts + self.base,
             self.max_retry_interval)
 
+    def get_schedule(self):
+        """
+        Return delays of every allowed attempt and the cumulative delay
+        before each of them
+        """
+        schedule, cumulative = [], [0]
+        while cumulative[-1] <= self.time_before_drop:
+            delay = self.delay(len(schedule))
+            schedule.append(int(delay))
+            cumulative.append(cumulative[-1] + delay)
+        return schedule, cumulative[:-1]
+
     def __call__(self, attempts):
-        total_delay = sum(self.delay(i) for i in range(attempts))
-        if total_delay <= self.time_before_drop:
-            return int(self.delay(attempts))
-        else:
+        if attempts >= len(self.schedule):
             return None
+        delay = self.schedule[attempts]
+        if self.jitter:
+            delay = max(1, int(delay * (
+                1 + random.uniform(-self.jitter, self.jitter))))
+        return delay
+
+
+def get_backoff(retry_policy):
+    """ Return the (shared) ExponentialBackOff of `retry_policy` """
+    key = tuple(sorted(
+        (k, v) for k, v in retry_policy.items()
+        if k not in ('domains', 'reply_codes')))
+    if key not in _backoffs:
+        _backoffs[key] = ExponentialBackOff(retry_policy)
+    return _backoffs[key]
+
+
+def get_retry_policy(retry_policies, default, domain=None, reply=None):
+    """
+    Return the first of `retry_policies` matching `domain` (a regex in
+    its "domains" key) and `reply` (a reply code or enhanced status code
+    prefix in its "reply_codes" key), or `default`.
+    """
+    codes = []
+    if reply is not None:
+        codes = [c for c in (
+            reply.code, getattr(reply, 'enhanced_status_code', None)) if c]
+    for retry_policy in retry_policies:
+        if 'domains' in retry_policy and not (
+                domain and re.match(retry_policy['domains'], domain)):
+            continue
+        if 'reply_codes' in retry_policy and not any(
+                code.startswith(prefix) for code in codes
+                for prefix in retry_policy['reply_codes']):
+            continue
+        return retry_policy
+    return default
@@ -0,0 +1,64 @@
+import re
+
+from django_redis import get_redis_connection
+
+conn = get_redis_connection('default')
+
+# Token buckets are implemented as GCRA: each window stores the
+# theoretical arrival time (TAT) of next token, so state is one number
+# whatever the number of scheduled mails.
+#
+# KEYS: one TAT key per (limit, period) window
+# ARGV: "peek" or "reserve", requested timestamp, then for each window
+#       emission interval and burst tolerance (both in seconds)
+# Returns timestamp at which a token is available in every window
+bucket_script = conn.register_script("""
+local at = tonumber(ARGV[2])
+for i, key in ipairs(KEYS) do
+    local tat = tonumber(redis.call('GET', key) or 0)
+    at = math.max(at, tat - tonumber(ARGV[2 + i * 2]))
+end
+if ARGV[1] == 'reserve' then
+    for i, key in ipairs(KEYS) do
+        local tat = tonumber(redis.call('GET', key) or 0)
+        tat = math.max(tat, at) + tonumber(ARGV[1 + i * 2])
+        redis.call(
+            'SET', key, tostring(tat), 'EX',
+            math.ceil(tat - tonumber(ARGV[2])) + 1)
+    end
+end
+return tostring(at)
+""")
+
+
+def get_windows(domains, domain):
+    """
+    Return windows of the first `domains` pattern matching `domain`.
+
+    `domains` is a list of (pattern, windows) where windows are
+    (limit, period) or (limit, period, burst) tuples: at most `limit`
+    mails every `period` seconds, and at most `burst` (default: `limit`)
+    at once.
+    """
+    for pattern, windows in domains:
+        if re.match(pattern, domain):
+            return [tuple(w) for w in windows]
+    return []
+
+
+def bucket_call(buckets, timestamp, reserve=False, client=None):
+    """
+    Return the timestamp (>= `timestamp`) at which every window of
+    `buckets`, a list of (key_prefix, windows), has a token available.
+    With `reserve`, consume these tokens. All buckets are checked (and
+    consumed) atomically. `client` may be a pipeline.
+    """
+    keys, args = [], ['reserve' if reserve else 'peek', timestamp]
+    for key_prefix, windows in buckets:
+        for window in windows:
+            limit, period = window[0], window[1]
+            burst = window[2] if len(window) > 2 else limit
+            interval = period / limit
+            keys.append('{}:{}:{}'.format(key_prefix, limit, period))
+            args += [interval, interval * (burst - 1)]
+    return bucket_script(keys=keys, args=args, client=client)
@@ -0,0 +1,99 @@
+import time
+import uuid
+import pickle
+import logging
+
+from celery import current_app
+from django.conf import settings
+from django_redis import get_redis_connection
+
+log = logging.getLogger(__name__)
+
+conn = get_redis_connection('default')
+
+# Scheduler lock lifetime: runs stop publishing (and release it) after
+# half of it so that the lock never expires while a run still holds it
+LOCK_TIMEOUT = 60
+
+# KEYS: lock
+# ARGV: token of the run holding it
+release_lock_script = conn.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+def get_delay_queue_key():
+    return '{}:delayed'.format(settings.MAILSEND['CACHE_PREFIX'])
+
+
+def delay_task(task, args=(), kwargs=None, countdown=0, **options):
+    """
+    Publish `task` in `countdown` seconds.
+
+    Instead of publishing it now with a countdown (which makes the
+    consuming worker hold it in memory until it is due), the task is
+    stored in a Redis sorted set scored by due time and published by
+    `publish_due_tasks`. Returns the id the task will be published with.
+    """
+    if not countdown or not settings.MAILSEND['DELAY_QUEUE_ENABLED']:
+        return task.apply_async(
+            args, kwargs, countdown=countdown or None, **options).id
+
+    options.setdefault('task_id', str(uuid.uuid4()))
+    conn.zadd(
+        get_delay_queue_key(), time.time() + countdown,
+        pickle.dumps((task.name, args, kwargs or {}, options)))
+    return options['task_id']
+
+
+def count_delayed_tasks():
+    return conn.zcard(get_delay_queue_key())
+
+
+def publish_due_tasks(batch_size=None):
+    """
+    Publish every task due by now, `batch_size` at a time.
+
+    Tasks are removed from the delay queue only once published so a
+    crashing scheduler publishes them again rather than losing them.
+    A run stops after LOCK_TIMEOUT / 2 seconds, leaving remaining tasks
+    to the next one. Returns the number of published tasks.
+    """
+    if batch_size is None:
+        batch_size = settings.MAILSEND['DELAY_QUEUE_BATCH_SIZE']
+    key = get_delay_queue_key()
+    lock_name = '{}:lock:delayed'.format(settings.MAILSEND['CACHE_PREFIX'])
+    token = str(uuid.uuid4())
+    # Only one scheduler at a time, others will pass their turn
+    if not conn.set(lock_name, token, ex=LOCK_TIMEOUT, nx=True):
+        return 0
+
+    deadline = time.monotonic() + LOCK_TIMEOUT / 2
+    published = 0
+    try:
+        while time.monotonic() < deadline:
+            items = conn.zrangebyscore(
+                key, '-inf', time.time(), start=0, num=batch_size)
+            if not items:
+                break
+            with current_app.producer_or_acquire() as producer:
+                for item in items:
+                    name, args, kwargs, options = pickle.loads(item)
+                    current_app.send_task(
+                        name, args, kwargs, producer=producer, **options)
+            conn.zrem(key, *items)
+            published += len(items)
+            if len(items) < batch_size:
+                break
+    finally:
+        if not release_lock_script(keys=[lock_name], args=[token]):
+            log.warning(
+                'Delay queue lock expired while publishing, another '
+                'scheduler may have published the same tasks')
+
+    if published:
+        log.debug('Published {} delayed task(s)'.format(published))
+    return published
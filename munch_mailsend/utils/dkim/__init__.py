@@ -13,7 +13,9 @@ from .exceptions import MessageFormatError
 from .exceptions import InvalidTagValueList
 from .utils import hash_headers
 from .utils import rfc822_parse
+from .utils import index_headers
 from .utils import get_bit_size
+from .utils import iter_body_chunks
 from .utils import parse_tag_value
 from .utils import validate_signature_fields
 from .crypto import HASH_ALGORITHMS
@@ -26,12 +28,17 @@ from .crypto import RSASSA_PKCS1_v1_5_verify
 from .canonicalization import CanonicalizationPolicy
 from .canonicalization import InvalidCanonicalizationPolicyError
 
+from .dnscache import TXTCache
+
 try:
     from .dnsplug import get_txt
 except:
     def get_txt(s):
         raise RuntimeError("DKIM.verify requires DNS or dnspython module")
 
+#: Process wide public keys cache used by default when verifying
+cached_get_txt = TXTCache(lambda name: get_txt(name))
+
 
 Relaxed, Simple = 'relaxed', 'simple'
 
@@ -128,7 +135,26 @@ class DKIM(object):
         self.headers, self.body = [], b''
         if message:
             self.headers, self.body = rfc822_parse(message)
-
+        self._reset()
+
+    #: Load a message given as already parsed header fields and a body.
+    #: @param headers: list of (name, value) pairs, as returned by
+    #: L{rfc822_parse} (values keep their leading space and trailing CRLF)
+    #: @param body: bytes, a binary file-like object or an iterable of
+    #: bytes chunks. It is consumed once, by the next sign or verify call.
+    def set_headers_and_body(self, headers, body):
+        self.headers = [[name, value] for name, value in headers]
+        self.body = body
+        self._reset()
+
+    def header_index(self):
+        """ Return the positions of each (lowercased) header name. """
+        if self._header_index is None:
+            self._header_index = index_headers(self.headers)
+        return self._header_index
+
+    def _reset(self):
+        self._header_index = None
         #: The DKIM signing domain last signed or verified.
         self.domain = None
         #: The DKIM key selector last signed or verified.
@@ -189,6 +215,7 @@ class DKIM(object):
     #: @param selector: the DKIM selector value for the signature
     #: @param domain: the DKIM domain value for the signature
     #: @param private_key: a PKCS#1 private key in base64-encoded text form
+    #: or as returned by L{parse_pem_private_key}
     #: @param identity: the DKIM identity value for the signature
     #: (default "@"+domain)
     #: @param canonicalize: the canonicalization algorithms to use
@@ -204,10 +231,12 @@ class DKIM(object):
             self, selector, domain, private_key, identity=None,
             canonicalize=('relaxed', 'simple'),
             include_headers=None, length=False):
-        try:
-            private_key = parse_pem_private_key(private_key)
-        except UnparsableKeyError as err:
-            raise KeyFormatError(err)
+        # Already parsed keys can be given to avoid parsing them each time
+        if not isinstance(private_key, dict):
+            try:
+                private_key = parse_pem_private_key(private_key)
+            except UnparsableKeyError as err:
+                raise KeyFormatError(err)
 
         if identity is not None and not identity.endswith(domain):
             raise ParameterError("identity must end with domain")
@@ -230,10 +259,12 @@ class DKIM(object):
                 raise ParameterError(
                     "The {} header field SHOULD NOT be signed".format(header))
 
-        body = canon_policy.canonicalize_body(self.body)
         hasher = HASH_ALGORITHMS[self.signature_algorithm]
         h = hasher()
-        h.update(body)
+        body_canonicalizer = canon_policy.body_canonicalizer(h)
+        for chunk in iter_body_chunks(self.body):
+            body_canonicalizer.update(chunk)
+        body_length = body_canonicalizer.finish()
         bodyhash = base64.b64encode(h.digest())
 
         signature_fields = [x for x in [
@@ -242,7 +273,7 @@ class DKIM(object):
             (b'c', canon_policy.to_c_value()),
             (b'd', domain),
             (b'i', identity or b'@' + domain),
-            length and (b'l', str(len(body)).encode('ascii')),
+            length and (b'l', str(body_length).encode('ascii')),
             (b'q', b'dns/txt'),
             (b's', selector),
             (b't', str(int(time.time())).encode('ascii')),
@@ -260,7 +291,8 @@ class DKIM(object):
         h = hasher()
         signature = dict(signature_fields)
         self.signed_headers = hash_headers(
-            h, canon_policy, headers, include_headers, dkim_header)
+            h, canon_policy, headers, include_headers, dkim_header,
+            index=self.header_index())
         self.logger.debug("Signature headers: %r" % self.signed_headers)
 
         try:
@@ -279,20 +311,47 @@ class DKIM(object):
         self.signature_fields = signature
         return b'DKIM-Signature: ' + signature_value
 
+    def signature_headers(self):
+        """ Return the DKIM-Signature header fields, topmost first. """
+        return [
+            (key, value) for key, value in self.headers
+            if key.lower() == b'dkim-signature']
+
+    @staticmethod
+    def key_name(signature):
+        """ Return the DNS name of the public key used by a signature.
+        @param signature: parsed tags of a DKIM-Signature value
+        """
+        return "{}._domainkey.{}.".format(
+            signature[b's'].decode('ascii'), signature[b'd'].decode('ascii'))
+
+    def get_key_name(self, idx=0):
+        """ Return the public key DNS name of the idx-th signature, or None
+        if there is no such signature or it can't be parsed.
+        """
+        signature_headers = self.signature_headers()
+        if len(signature_headers) <= idx:
+            return None
+        try:
+            return self.key_name(parse_tag_value(signature_headers[idx][1]))
+        except (InvalidTagValueList, KeyError, UnicodeDecodeError):
+            return None
+
     #: Verify a DKIM signature.
     #: @type idx: int
     #: @param idx: which signature to verify.
     #:               The first (topmost) signature is 0.
     #: @type dnsfunc: callable
     #: @param dnsfunc: an option function to lookup TXT resource records
-    #: for a DNS domain.  The default uses dnspython or pydns.
+    #: for a DNS domain.  The default uses dnspython or pydns through
+    #: the process wide L{cached_get_txt} cache.
     #: @return: True if signature verifies or False otherwise
     #: @raise DKIMException: when the message,
     #:                       signature, or key are badly formed
-    def verify(self, idx=0, dnsfunc=get_txt):
-        signature_headers = [
-            (key, value) for key, value in self.headers
-            if key.lower() == b'dkim-signature']
+    def verify(self, idx=0, dnsfunc=None):
+        if dnsfunc is None:
+            dnsfunc = cached_get_txt
+        signature_headers = self.signature_headers()
         if len(signature_headers) <= idx:
             return False
 
@@ -315,7 +374,6 @@ class DKIM(object):
             raise MessageFormatError("Invalid c= value: %s" % err.args[0])
 
         headers = canon_policy.canonicalize_headers(self.headers)
-        body = canon_policy.canonicalize_body(self.body)
 
         try:
             hasher = HASH_ALGORITHMS[signature[b'a'].decode('ascii')]
@@ -323,11 +381,15 @@ class DKIM(object):
             raise MessageFormatError(
                 "Unknown signature algorithm: {}".format(err.args[0]))
 
+        limit = None
         if b'l' in signature:
-            body = body[:int(signature[b'l'])]
+            limit = int(signature[b'l'])
 
         h = hasher()
-        h.update(body)
+        body_canonicalizer = canon_policy.body_canonicalizer(h, limit=limit)
+        for chunk in iter_body_chunks(self.body):
+            body_canonicalizer.update(chunk)
+        body_canonicalizer.finish()
         bodyhash = h.digest()
         self.logger.debug("bh: {}".format(base64.b64encode(bodyhash)))
         try:
@@ -338,8 +400,7 @@ class DKIM(object):
             raise ValidationError(
                 "Body hash mismatch (got {}, expected {})".format(
                     base64.b64encode(bodyhash), signature[b'bh']))
-        name = "{}._domainkey.{}.".format(
-            signature[b's'].decode('ascii'), signature[b'd'].decode('ascii'))
+        name = self.key_name(signature)
 
         s = dnsfunc(name)
         if not s:
@@ -371,7 +432,7 @@ class DKIM(object):
         h = hasher()
         hash_headers(
             h, canon_policy, headers, include_headers,
-            signature_headers[idx])
+            signature_headers[idx], index=self.header_index())
         try:
             signature = base64.b64decode(re.sub(br'\s+', b'', signature[b'b']))
             res = RSASSA_PKCS1_v1_5_verify(h, signature, public_key)
@@ -421,7 +482,36 @@ def sign(
         include_headers=include_headers, length=length)
 
 
-def verify(message, logger=None, dnsfunc=get_txt, minkey=1024):
+def sign_stream(
+        headers, body, selector, domain, privkey, identity=None,
+        canonicalize=('relaxed', 'simple'),
+        signature_algorithm='rsa-sha256',
+        include_headers=None, length=False, logger=None):
+    """
+    Sign a message given as header fields and a body stream.
+
+    The body hash is computed while the body is read, so the message
+    is never materialized as a whole.
+
+    @param headers: list of (name, value) header pairs, as returned by
+                    L{rfc822_parse}
+    @param body: bytes, a binary file-like object or an iterable of
+                 bytes chunks (with either \\n or \\r\\n line endings)
+    @return: DKIM-Signature header field terminated by \\r\\n
+
+    Other parameters are the same as for L{sign}.
+    """
+    d = DKIM(logger=logger, signature_algorithm=signature_algorithm)
+    d.set_headers_and_body(headers, body)
+    if not include_headers:
+        include_headers = d.default_sign_headers()
+    return d.sign(
+        selector, domain, privkey,
+        identity=identity, canonicalize=canonicalize,
+        include_headers=include_headers, length=length)
+
+
+def verify(message, logger=None, dnsfunc=None, minkey=1024):
     """
     Verify the first (topmost) DKIM signature on an RFC822 formatted message.
 
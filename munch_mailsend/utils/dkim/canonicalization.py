@@ -25,27 +25,154 @@ from .exceptions import InvalidCanonicalizationPolicyError
 
 
 __all__ = [
+    'BodyCanonicalizer',
     'CanonicalizationPolicy',
     'InvalidCanonicalizationPolicyError',
     ]
 
 
-def strip_trailing_whitespace(content):
-    return re.sub(br"[\t ]+\r\n", b"\r\n", content)
+NEWLINE = re.compile(br"\n")
+WHITESPACE = re.compile(br"[\t ]+")
+# Anything relaxed canonicalization would rewrite inside a line
+RELAXED_DIRTY = re.compile(br"\t|  |[\t ]$")
 
 
 def compress_whitespace(content):
-    return re.sub(br"[\t ]+", b" ", content)
-
-
-def strip_trailing_lines(content):
-    return re.sub(br"(\r\n)*$", b"\r\n", content)
+    return WHITESPACE.sub(b" ", content)
 
 
 def unfold_header_value(content):
     return re.sub(br"\r\n", b"", content)
 
 
+class BodyCanonicalizer:
+    """Canonicalize a message body in a single pass and feed a hash object.
+
+    Data is given in chunks (bytes or memoryview) with either CRLF or bare
+    LF line endings. Lines that are already canonical are passed to the
+    hasher as slices of the original buffer, consecutive ones in a single
+    update() call. Trailing empty lines are held back as a counter until
+    a non-empty line shows up, so they never reach the hasher.
+
+    @param hasher: any object with an update() method (eg. hashlib objects)
+    @param relaxed: apply "relaxed" instead of "simple" body rules
+    @param limit: only feed the first `limit` canonical bytes (l= tag)
+    """
+
+    def __init__(self, hasher, relaxed=False, limit=None):
+        self.hasher = hasher
+        self.relaxed = relaxed
+        self.limit = limit
+        #: Total length of the canonicalized body (ignoring `limit`)
+        self.length = 0
+        self._partial = b""
+        self._empty_lines = 0
+
+    def _emit(self, data):
+        if self.limit is not None:
+            remaining = self.limit - self.length
+            if remaining < len(data):
+                self.hasher.update(data[:max(remaining, 0)])
+                self.length += len(data)
+                return
+        self.hasher.update(data)
+        self.length += len(data)
+
+    def _feed(self, view, final=False):
+        """Process complete lines of `view` and return the unfinished tail."""
+        pos, end = 0, len(view)
+        # [run_start, run_end) is a span of lines already in canonical form
+        run_start = run_end = 0
+        while pos < end:
+            match = NEWLINE.search(view, pos)
+            if match is None:
+                if not final:
+                    break
+                next_pos = line_end = end
+                crlf = False
+            else:
+                next_pos = match.end()
+                line_end = match.start()
+                crlf = line_end > pos and view[line_end - 1] == 0x0d
+                if crlf:
+                    line_end -= 1
+
+            line = None
+            if self.relaxed and RELAXED_DIRTY.search(view, pos, line_end):
+                line = compress_whitespace(
+                    bytes(view[pos:line_end])).rstrip(b" ")
+
+            if line_end == pos or line == b"":
+                if run_end > run_start:
+                    self._emit(view[run_start:run_end])
+                run_start = run_end = next_pos
+                self._empty_lines += 1
+            elif line is None and crlf and not self._empty_lines:
+                # Canonical as-is: extend the current run
+                if run_end != pos:
+                    run_start = pos
+                run_end = next_pos
+            else:
+                if run_end > run_start:
+                    self._emit(view[run_start:run_end])
+                run_start = run_end = next_pos
+                if self._empty_lines:
+                    self._emit(b"\r\n" * self._empty_lines)
+                    self._empty_lines = 0
+                if line is None:
+                    if crlf:
+                        # Start a new run from this line
+                        run_start, run_end = pos, next_pos
+                        pos = next_pos
+                        continue
+                    line = view[pos:line_end]
+                self._emit(line)
+                self._emit(b"\r\n")
+            pos = next_pos
+        if run_end > run_start:
+            self._emit(view[run_start:run_end])
+        return view[pos:]
+
+    def update(self, data):
+        view = memoryview(data)
+        if self._partial:
+            match = NEWLINE.search(view)
+            if match is None:
+                self._partial += bytes(view)
+                return
+            self._feed(memoryview(self._partial + bytes(view[:match.end()])))
+            view = view[match.end():]
+        self._partial = bytes(self._feed(view))
+
+    def finish(self):
+        """Flush pending data and return the canonicalized body length."""
+        if self._partial:
+            self._feed(memoryview(self._partial), final=True)
+            self._partial = b""
+        # An empty body is a single CRLF under "simple" (RFC 6376 3.4.3)
+        # and nothing at all under "relaxed" (RFC 6376 3.4.4)
+        if not self.length and not self.relaxed:
+            self._emit(b"\r\n")
+        self._empty_lines = 0
+        return self.length
+
+
+class _Collector:
+    def __init__(self):
+        self.chunks = []
+
+    def update(self, data):
+        self.chunks.append(bytes(data))
+
+
+def canonicalize_body(body, relaxed=False):
+    collector = _Collector()
+    canonicalizer = BodyCanonicalizer(collector, relaxed=relaxed)
+    canonicalizer.update(body)
+    canonicalizer.finish()
+    return b"".join(collector.chunks)
+
+
 class Simple:
     """Class that represents the "simple" canonicalization algorithm."""
 
@@ -59,7 +186,11 @@ class Simple:
     @staticmethod
     def canonicalize_body(body):
         # Ignore all empty lines at the end of the message body.
-        return strip_trailing_lines(body)
+        return canonicalize_body(body)
+
+    @staticmethod
+    def body_canonicalizer(hasher, limit=None):
+        return BodyCanonicalizer(hasher, limit=limit)
 
 
 class Relaxed:
@@ -86,8 +217,11 @@ class Relaxed:
         # Remove all trailing WSP at end of lines.
         # Compress non-line-ending WSP to single space.
         # Ignore all empty lines at the end of the message body.
-        return strip_trailing_lines(
-            compress_whitespace(strip_trailing_whitespace(body)))
+        return canonicalize_body(body, relaxed=True)
+
+    @staticmethod
+    def body_canonicalizer(hasher, limit=None):
+        return BodyCanonicalizer(hasher, relaxed=True, limit=limit)
 
 
 class CanonicalizationPolicy:
@@ -133,5 +267,8 @@ class CanonicalizationPolicy:
     def canonicalize_body(self, body):
         return self.body_algorithm.canonicalize_body(body)
 
+    def body_canonicalizer(self, hasher, limit=None):
+        return self.body_algorithm.body_canonicalizer(hasher, limit=limit)
+
 
 ALGORITHMS = dict((c.name, c) for c in (Simple, Relaxed))
@@ -0,0 +1,68 @@
+import time
+import threading
+from collections import OrderedDict
+
+__all__ = ['TXTCache']
+
+
+class TXTCache:
+    """Memoize DNS TXT lookups, including missing records.
+
+    Instances are callables with the same signature as `get_txt`, so they
+    can be passed as `dnsfunc` to DKIM.verify. They can be shared between
+    threads: lookups run outside of the lock, so concurrent misses of a
+    name may resolve it more than once.
+
+    @param resolver: function returning the TXT record of a name or None
+    @param ttl: seconds a found record is kept
+    @param negative_ttl: seconds a missing record is remembered
+    @param max_entries: oldest entries are dropped past this size
+    """
+
+    def __init__(
+            self, resolver, ttl=60 * 60, negative_ttl=60 * 5,
+            max_entries=10000, clock=time.monotonic):
+        self.resolver = resolver
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_txt(self, name):
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        # Resolver errors (timeouts, servfail...) are not cached
+        txt = self.resolver(name)
+        self.set(name, txt, now=now)
+        return txt
+
+    __call__ = get_txt
+
+    def set(self, name, txt, now=None):
+        if now is None:
+            now = self.clock()
+        ttl = self.ttl if txt else self.negative_ttl
+        with self._lock:
+            self._entries.pop(name, None)
+            self._entries[name] = (now + ttl, txt)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __contains__(self, name):
+        with self._lock:
+            entry = self._entries.get(name)
+        return entry is not None and entry[0] > self.clock()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -8,6 +8,14 @@ from .exceptions import MessageFormatError
 
 # FWS  =  ([*WSP CRLF] 1*WSP) /  obs-FWS ; Folding white space  [RFC5322]
 FWS = br'(?:(?:\s*\r?\n)?\s+)?'
+# End of the header block: an empty line (or the message starts with one)
+HEADERS_END = re.compile(br'(?:^|\r?\n)\r?\n')
+# A header field with its continuation lines, up to its final line break
+HEADER_FIELD = re.compile(br'([\x21-\x7e]+?):([^\n]*(?:\n[\t ][^\n]*)*)')
+BARE_LF = re.compile(br'(?<!\r)\n')
+# b= tag of a DKIM-Signature value, whose content is hashed as empty
+RE_BTAG = re.compile(
+    br'([;\s]b' + FWS + br'=)(?:' + FWS + br'[a-zA-Z0-9+/=])*(?:\r?\n\Z)?')
 
 
 def get_bit_size(x):
@@ -16,13 +24,14 @@ def get_bit_size(x):
 
 
 def hash_headers(
-        hasher, canonicalize_headers, headers, include_headers, sigheader):
+        hasher, canonicalize_headers, headers, include_headers, sigheader,
+        index=None):
     """ Update hash for signed message header fields. """
-    sign_headers = select_headers(headers, include_headers)
+    sign_headers = select_headers(headers, include_headers, index=index)
     # The call to _remove() assumes that the signature b= only appears
     # once in the signature header
     cheaders = canonicalize_headers.canonicalize_headers(
-        [(sigheader[0], sigheader[1])])
+        [(sigheader[0], RE_BTAG.sub(b'\\1', sigheader[1]))])
     # the dkim sig is hashed with no trailing crlf, even if the
     # canonicalization algorithm would add one.
     for x, y in sign_headers + [(x, y.rstrip()) for x, y in cheaders]:
@@ -32,9 +41,23 @@ def hash_headers(
     return sign_headers
 
 
-def select_headers(headers, include_headers):
+def index_headers(headers):
+    """Map each lowercased header name to its positions in `headers`.
+
+    >>> index_headers([('From','biz'),('Foo','bar'),('from','baz')])
+    {'from': [0, 2], 'foo': [1]}
+    """
+    index = {}
+    for i, (name, _) in enumerate(headers):
+        index.setdefault(name.lower(), []).append(i)
+    return index
+
+
+def select_headers(headers, include_headers, index=None):
     """Select message header fields to be signed/verified.
 
+    Instances of a field are selected from bottom to top.
+
     >>> h = [('from','biz'),('foo','bar'),('from','baz'),('subject','boring')]
     >>> i = ['from','subject','to','from']
     >>> select_headers(h,i)
@@ -43,18 +66,20 @@ def select_headers(headers, include_headers):
     >>> i = ['from','subject','to','from']
     >>> select_headers(h,i)
     [('From', 'biz'), ('Subject', 'Boring')]
+
+    @param index: result of L{index_headers} for `headers`, if known
     """
+    if index is None:
+        index = index_headers(headers)
     signature_headers = []
-    last_index = {}
+    selected = {}
     for header in include_headers:
         assert header == header.lower()
-        i = last_index.get(header, len(headers))
-        while i > 0:
-            i -= 1
-            if header == headers[i][0].lower():
-                signature_headers.append(headers[i])
-                break
-        last_index[header] = i
+        positions = index.get(header, ())
+        count = selected.get(header, 0)
+        if count < len(positions):
+            signature_headers.append(headers[positions[-1 - count]])
+        selected[header] = count + 1
     return signature_headers
 
 
@@ -130,31 +155,65 @@ def rfc822_parse(message):
                     Either CRLF or LF is an accepted line separator.
     @return: Returns a tuple of (headers, body)
              where headers is a list of (name, value) pairs.
-    The body is a CRLF-separated string.
+    The body is a memoryview over `message`, line endings are left
+    untouched and normalized during canonicalization.
     """
     headers = []
-    lines = re.split(br"\r?\n", message)
-    i = 0
-    while i < len(lines):
-        if len(lines[i]) == 0:
-            # End of headers, return what we have plus the body,
-            # excluding the blank line.
-            i += 1
-            break
-        if lines[i][0] in ("\x09", "\x20", 0x09, 0x20):
-            headers[-1][1] += lines[i] + b"\r\n"
+    # Only the header block is parsed, the body is never copied
+    separator = HEADERS_END.search(message)
+    if separator is None:
+        headers_end, body_start = len(message), len(message)
+    else:
+        headers_end, body_start = separator.start(), separator.end()
+
+    # One match per header field, continuation lines included
+    pos = 0
+    while pos < headers_end:
+        m = HEADER_FIELD.match(message, pos, headers_end)
+        if m is not None:
+            value = m.group(2)
+            if value.endswith(b"\r"):
+                value = value[:-1]
+            if b"\n" in value:
+                value = BARE_LF.sub(b"\r\n", value)
+            headers.append([m.group(1), value + b"\r\n"])
+            pos = m.end() + 1
+            continue
+        line_end = message.find(b"\n", pos, headers_end)
+        if line_end == -1:
+            line_end = headers_end
+        if message.startswith(b"From ", pos):
+            # mbox separator line
+            pos = line_end + 1
         else:
-            m = re.match(br"([\x21-\x7e]+?):", lines[i])
-            if m is not None:
-                headers.append([m.group(1), lines[i][m.end(0):] + b"\r\n"])
-            elif lines[i].startswith(b"From "):
-                pass
-            else:
-                raise MessageFormatError(
-                    "Unexpected characters in RFC822 header: {}".format(
-                        lines[i]))
-        i += 1
-    return (headers, b"\r\n".join(lines[i:]))
+            raise MessageFormatError(
+                "Unexpected characters in RFC822 header: {}".format(
+                    message[pos:line_end]))
+    return (headers, memoryview(message)[body_start:])
+
+
+def iter_body_chunks(body, chunk_size=64 * 1024):
+    """
+    Iterate over a message body given in one of the supported forms.
+
+    @param body: a bytes-like object, a file-like object opened in binary
+                 mode (anything with a read() method) or an iterable of
+                 bytes-like chunks.
+    @param chunk_size: read size used for file-like objects.
+    """
+    if body is None:
+        return
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        yield body
+    elif hasattr(body, 'read'):
+        while True:
+            chunk = body.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    else:
+        for chunk in body:
+            yield chunk
 
 
 def parse_tag_value(tag_list):
@@ -0,0 +1,35 @@
+import logging
+import threading
+
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+
+class Heartbeat(threading.Thread):
+    """
+    Tell routers that this MX worker is alive every `interval` seconds.
+
+    Runs as a greenlet when threading is monkey patched by gevent.
+    """
+    def __init__(self, ip, interval=None):
+        super().__init__(name='mailsend-heartbeat', daemon=True)
+        self.ip = ip
+        self.interval = interval or settings.MAILSEND[
+            'WORKER_HEARTBEAT']['interval']
+        self.stopped = threading.Event()
+
+    def run(self):
+        from ..models import Worker
+
+        while not self.stopped.is_set():
+            try:
+                Worker.objects.send_heartbeat(self.ip)
+            except Exception:
+                log.error(
+                    '[{}] Failed to send heartbeat'.format(self.ip),
+                    exc_info=True)
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
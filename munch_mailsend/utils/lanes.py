@@ -0,0 +1,34 @@
+from django.conf import settings
+
+
+def get_lane(priority):
+    """
+    Return the first PRIORITY_LANES lane whose minimum priority is
+    reached by `priority`, or None for the default lane.
+    """
+    if priority is None:
+        return None
+    for name, min_priority in settings.MAILSEND['PRIORITY_LANES']:
+        if priority >= min_priority:
+            return name
+    return None
+
+
+def get_lanes():
+    """ Every lane name, from the most to the least prioritized (None) """
+    return [name for name, _ in settings.MAILSEND['PRIORITY_LANES']] + [None]
+
+
+def get_lane_queue_name(queue_name, lane=None):
+    """ Queues of the default lane keep their historical names """
+    if lane is None:
+        return queue_name
+    return '{}:{}'.format(queue_name, lane)
+
+
+def get_routing_options(lane=None):
+    """ Return apply_async options publishing route_envelope in `lane` """
+    if lane is None:
+        return {}
+    return {'routing_key': get_lane_queue_name(
+        settings.MAILSEND['ROUTING_QUEUE'], lane)}
@@ -0,0 +1,31 @@
+import os
+import mailbox
+
+
+def iter_messages(path):
+    """
+    Yield (label, raw_message) for every message stored at `path`.
+
+    `path` may be a maildir (directory with cur/, new/ and tmp/), a plain
+    directory of message files (.eml or anything else) or an mbox file.
+    Messages are read one at a time.
+    """
+    if os.path.isdir(path):
+        if all(os.path.isdir(os.path.join(path, d))
+               for d in ('cur', 'new', 'tmp')):
+            box = mailbox.Maildir(path, factory=None, create=False)
+            for key in box.iterkeys():
+                yield '{}:{}'.format(path, key), box.get_bytes(key)
+            return
+        for name in sorted(os.listdir(path)):
+            filename = os.path.join(path, name)
+            if os.path.isfile(filename):
+                with open(filename, 'rb') as f:
+                    yield filename, f.read()
+    else:
+        box = mailbox.mbox(path, factory=None, create=False)
+        try:
+            for index, key in enumerate(box.iterkeys()):
+                yield '{}:{}'.format(path, index), box.get_bytes(key)
+        finally:
+            box.close()
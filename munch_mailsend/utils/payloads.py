@@ -0,0 +1,60 @@
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# Version 1: full headers and the three import paths as task arguments
+# Version 2: routing headers only and a registered backend id
+PAYLOAD_VERSION = 2
+
+TaskBackend = namedtuple('TaskBackend', [
+    'mailstatus_class_path', 'record_status_task_path',
+    'build_envelope_task_path'])
+
+
+def get_backend_id(backend):
+    """ Return registered id of `backend` (a TaskBackend) or None """
+    for backend_id, paths in settings.MAILSEND['TASK_BACKENDS'].items():
+        if TaskBackend(*paths) == backend:
+            return backend_id
+
+
+def get_routing_headers(headers):
+    """ Keep only headers needed for routing and worker policies """
+    names = [
+        'To', settings.MAILSEND['X_POOL_HEADER'],
+        settings.MAILSEND.get('X_USER_ID_HEADER')] + list(
+            settings.MAILSEND['ROUTING_HEADERS'])
+    return {name: headers[name] for name in names if name in headers}
+
+
+def encode_backend(backend):
+    """
+    Return task kwargs describing `backend`. Unregistered backends
+    keep sending their import paths.
+    """
+    backend_id = get_backend_id(backend)
+    if backend_id is None:
+        kwargs = backend._asdict()
+    else:
+        kwargs = {'backend': backend_id}
+    kwargs['version'] = PAYLOAD_VERSION
+    return kwargs
+
+
+def decode_backend(
+        version=1, backend=None, mailstatus_class_path=None,
+        record_status_task_path=None, build_envelope_task_path=None):
+    """ Return the TaskBackend of a task, whatever its payload version """
+    if backend is not None:
+        try:
+            paths = settings.MAILSEND['TASK_BACKENDS'][backend]
+        except KeyError:
+            raise ImproperlyConfigured(
+                'Unknown task backend id "{}" (payload version {}). '
+                'Check "MAILSEND[\'TASK_BACKENDS\']" setting.'.format(
+                    backend, version))
+        return TaskBackend(*paths)
+    return TaskBackend(
+        mailstatus_class_path, record_status_task_path,
+        build_envelope_task_path)
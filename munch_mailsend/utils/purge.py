@@ -0,0 +1,116 @@
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+log = logging.getLogger(__name__)
+
+conn = get_redis_connection('default')
+
+
+def _purge_key(name):
+    return '{}:purge:{}'.format(settings.MAILSEND['CACHE_PREFIX'], name)
+
+
+def mark_for_purge(identifier):
+    """ Queue `identifier` so that its RawMail is detached (and deleted) """
+    return conn.sadd(_purge_key('pending'), identifier)
+
+
+def get_purge_stats():
+    stats = {
+        k.decode('utf-8'): v.decode('utf-8')
+        for k, v in conn.hgetall(_purge_key('stats')).items()}
+    stats['pending'] = conn.scard(_purge_key('pending'))
+    return stats
+
+
+def _record_stats(mails, raw_mails):
+    pipe = conn.pipeline()
+    pipe.hincrby(_purge_key('stats'), 'mails_detached', mails)
+    pipe.hincrby(_purge_key('stats'), 'raw_mails_deleted', raw_mails)
+    pipe.hincrby(_purge_key('stats'), 'batches', 1)
+    pipe.hset(_purge_key('stats'), 'last_batch', timezone.now().isoformat())
+    pipe.execute()
+
+    if settings.STATSD_ENABLED:
+        from statsd.defaults.django import statsd
+        statsd.incr('mailsend.purge.mails_detached', mails)
+        statsd.incr('mailsend.purge.raw_mails_deleted', raw_mails)
+
+
+def _referenced_raw_mails(raw_mail_ids):
+    """ Return ids among `raw_mail_ids` still used by any model """
+    from ..models import RawMail
+    from ..models import RawMailDigest
+
+    referenced = set()
+    for relation in RawMail._meta.related_objects:
+        if relation.related_model is RawMailDigest:
+            continue
+        referenced.update(relation.related_model._base_manager.filter(**{
+            '{}__in'.format(relation.field.name): raw_mail_ids
+        }).values_list(relation.field.attname, flat=True))
+    return referenced
+
+
+def purge_batch(batch_size=None):
+    """
+    Detach RawMail of one batch of finished mails and delete RawMail
+    no longer used by any mail. Returns (mails, raw_mails) counts.
+    """
+    from ..models import Mail
+    from ..models import RawMail
+    from ..models import RawMailDigest
+
+    if batch_size is None:
+        batch_size = settings.MAILSEND['PURGE_BATCH_SIZE']
+    identifiers = [
+        i.decode('utf-8') for i in conn.srandmember(
+            _purge_key('pending'), batch_size)]
+    if not identifiers:
+        return 0, 0
+
+    with transaction.atomic():
+        mails = Mail.objects.filter(
+            identifier__in=identifiers, message__isnull=False)
+        raw_mail_ids = set(mails.values_list('message_id', flat=True))
+        detached = mails.update(message=None)
+
+        deleted = 0
+        if raw_mail_ids:
+            # Deduplication keeps digests locked until the mail using
+            # their raw mail is inserted (and blocks while we hold them):
+            # lock them before looking for references
+            list(RawMailDigest.objects.select_for_update().filter(
+                raw_mail_id__in=raw_mail_ids).order_by('pk').values_list(
+                    'pk', flat=True))
+            raw_mail_ids = set(RawMail.objects.select_for_update().filter(
+                pk__in=raw_mail_ids).values_list('pk', flat=True))
+            orphans = raw_mail_ids - _referenced_raw_mails(raw_mail_ids)
+            if orphans:
+                RawMailDigest.objects.filter(
+                    raw_mail_id__in=orphans).delete()
+                deleted = RawMail.objects.filter(pk__in=orphans).delete()[
+                    1].get(RawMail._meta.label, 0)
+
+    conn.srem(_purge_key('pending'), *identifiers)
+    _record_stats(detached, deleted)
+    log.debug('Purged {} mail(s) and {} raw mail(s)'.format(
+        detached, deleted))
+    return detached, deleted
+
+
+def purge_raw_mails(batch_size=None, max_batches=None):
+    """ Run purge batches until nothing is pending """
+    total_mails, total_raw_mails, batches = 0, 0, 0
+    while max_batches is None or batches < max_batches:
+        mails, raw_mails = purge_batch(batch_size)
+        batches += 1
+        total_mails += mails
+        total_raw_mails += raw_mails
+        if not conn.scard(_purge_key('pending')):
+            break
+    return total_mails, total_raw_mails
@@ -0,0 +1,261 @@
+import os
+import re
+import time
+import pickle
+import logging
+import threading
+
+from django.conf import settings
+from django.db.models.signals import pre_save
+from django.db.models.signals import post_save
+from django.core.exceptions import ObjectDoesNotExist
+
+log = logging.getLogger(__name__)
+
+_sinks = {}
+
+
+class MailStatusSink:
+    """
+    Buffer MailStatus inserts and write them with bulk_create.
+
+    pre_save receivers (final state flag, worker policies) still run
+    synchronously in `add` so routing state in Redis is never late.
+    They get an unsaved `Mail` holding only its identifier: receivers
+    needing other mail fields must store them when the mail is routed.
+
+    Rows are inserted once `batch_size` statuses are pending or the
+    oldest pending one is `flush_interval` milliseconds old: by `add`,
+    or by the flusher thread (see `start`) when the worker is idle. With
+    a `spool_path`, pending statuses are also appended to this file and
+    inserted on next start if the process dies before flushing them.
+
+    Only the model signals are run: a custom `save()` on the MailStatus
+    class is bypassed.
+    """
+    def __init__(
+            self, mailstatus_class, batch_size=100, flush_interval=500,
+            spool_path=None):
+        self.mailstatus_class = mailstatus_class
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_path = spool_path
+        self.pid = os.getpid()
+        self._buffer = []
+        self._lock = threading.RLock()
+        # The spool is rewritten after each write: one flush at a time
+        self._flush_lock = threading.Lock()
+        self._oldest = None
+        self._spool = None
+        self._flusher = None
+        self._stopped = threading.Event()
+        if spool_path:
+            self.recover()
+            self._spool = open(spool_path, 'ab')
+
+    def add(self, mailstatus, identifier):
+        from ..models import Mail
+
+        try:
+            mailstatus.mail
+        except ObjectDoesNotExist:
+            # Actual Mail ids are resolved for the whole batch in write()
+            mailstatus.mail = Mail(identifier=identifier)
+        pre_save.send(
+            sender=self.mailstatus_class, instance=mailstatus, raw=False,
+            using='default', update_fields=None)
+
+        pk_name = self.mailstatus_class._meta.pk.attname
+        record = (identifier, {
+            f.attname: getattr(mailstatus, f.attname)
+            for f in self.mailstatus_class._meta.concrete_fields
+            if f.attname not in (pk_name, 'mail_id')})
+
+        with self._lock:
+            if self._spool:
+                pickle.dump(record, self._spool)
+                self._spool.flush()
+            self._buffer.append(record)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            due = len(self._buffer) >= self.batch_size or self.is_due()
+        if due:
+            self.flush()
+
+    def is_due(self):
+        return (
+            self.flush_interval is not None and self._oldest is not None and
+            time.monotonic() - self._oldest >= self.flush_interval / 1000)
+
+    def start(self):
+        """ Flush pending statuses of an idle worker from a thread """
+        if self.flush_interval and self._flusher is None:
+            self._flusher = threading.Thread(
+                target=self._run_flusher, name='mailstatus-sink',
+                daemon=True)
+            self._flusher.start()
+
+    def stop(self):
+        self._stopped.set()
+        return self.flush()
+
+    def _run_flusher(self):
+        while not self._stopped.wait(self.flush_interval / 1000):
+            with self._lock:
+                due = self.is_due()
+            if due:
+                self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self._lock:
+            records, self._buffer = self._buffer, []
+            oldest, self._oldest = self._oldest, None
+        if not records:
+            return 0
+
+        try:
+            count = self.write(records)
+        except Exception:
+            log.error(
+                'Failed to write {} MailStatus. Will retry on next '
+                'flush.'.format(len(records)), exc_info=True)
+            with self._lock:
+                self._buffer = records + self._buffer
+                self._oldest = oldest
+            return 0
+
+        with self._lock:
+            if self._spool:
+                # Keep statuses added while we were writing
+                self._spool.truncate(0)
+                for record in self._buffer:
+                    pickle.dump(record, self._spool)
+                self._spool.flush()
+        return count
+
+    def write(self, records):
+        from ..models import Mail
+
+        mail_ids = dict(Mail.objects.filter(
+            identifier__in={identifier for identifier, _ in records}
+        ).values_list('identifier', 'pk'))
+
+        instances = []
+        for identifier, fields in records:
+            if identifier not in mail_ids:
+                log.warning(
+                    '[{}] Dropping "{}" status of unknown mail'.format(
+                        identifier, fields.get('status')))
+                continue
+            # post_save receivers (eg. mark_for_purge) use the identifier
+            # without loading every Mail
+            instances.append(self.mailstatus_class(
+                mail=Mail(pk=mail_ids[identifier], identifier=identifier),
+                **fields))
+
+        self.mailstatus_class.objects.bulk_create(instances)
+        for instance in instances:
+            post_save.send(
+                sender=self.mailstatus_class, instance=instance,
+                created=True, raw=False, using='default', update_fields=None)
+        log.debug('Wrote {} MailStatus'.format(len(instances)))
+        return len(instances)
+
+    def recover(self, spool_path=None):
+        """ Insert statuses left in a spool file by a dead process """
+        spool_path = spool_path or self.spool_path
+        if not os.path.exists(spool_path):
+            return 0
+        records = []
+        with open(spool_path, 'rb') as f:
+            while True:
+                try:
+                    records.append(pickle.load(f))
+                except EOFError:
+                    break
+                except pickle.UnpicklingError:
+                    # Last record was partially written
+                    break
+        count = 0
+        if records:
+            log.info('Recovering {} spooled MailStatus from {}'.format(
+                len(records), spool_path))
+            count = self.write(records)
+        os.remove(spool_path)
+        return count
+
+    def recover_dead_spools(self):
+        """
+        Insert statuses of spool files (next to ours) whose process is
+        gone. Each file is renamed before being read so that only one
+        process recovers it.
+        """
+        directory, name = os.path.split(self.spool_path)
+        prefix = re.escape(name.rsplit('.', 2)[0])
+        pattern = re.compile(
+            r'^{}\.(\d+)\.spool(?:\.recovering\.(\d+))?$'.format(prefix))
+        count = 0
+        for filename in os.listdir(directory):
+            match = pattern.match(filename)
+            if not match:
+                continue
+            owner = int(match.group(2) or match.group(1))
+            if owner == self.pid or is_process_alive(owner):
+                continue
+            path = os.path.join(directory, filename)
+            claimed = '{}.recovering.{}'.format(
+                path.split('.recovering.')[0], self.pid)
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                # Claimed by another process
+                continue
+            count += self.recover(claimed)
+        return count
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def get_spool_path(mailstatus_class, spool_dir, pid=None):
+    """ Spool files are per process: forks of a worker never share one """
+    return os.path.join(spool_dir, '{}.{}.{}.spool'.format(
+        mailstatus_class._meta.label_lower,
+        settings.MAILSEND.get('SMTP_WORKER_SRC_ADDR'), pid or os.getpid()))
+
+
+def get_status_sink(mailstatus_class):
+    """ Return the MailStatus sink of this process for `mailstatus_class` """
+    sink = _sinks.get(mailstatus_class)
+    # A forked process never uses the sink (and spool) of its parent
+    if sink is None or sink.pid != os.getpid():
+        options = settings.MAILSEND['STATUS_SINK']
+        spool_path = None
+        if options.get('spool_dir'):
+            os.makedirs(options['spool_dir'], exist_ok=True)
+            spool_path = get_spool_path(
+                mailstatus_class, options['spool_dir'])
+        sink = _sinks[mailstatus_class] = MailStatusSink(
+            mailstatus_class, batch_size=options['batch_size'],
+            flush_interval=options['flush_interval'], spool_path=spool_path)
+        if spool_path:
+            sink.recover_dead_spools()
+        sink.start()
+    return sink
+
+
+def flush_status_sinks():
+    """ Write pending statuses of this process, on shutdown """
+    return sum(
+        sink.stop() for sink in _sinks.values() if sink.pid == os.getpid())
@@ -1,8 +1,12 @@
+import pickle
+import hashlib
 import logging
 from time import sleep
 
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django_redis import get_redis_connection
+from slimta.envelope import Envelope
 
 log = logging.getLogger(__name__)
 
@@ -24,6 +28,40 @@ def release_lock(lock_name):
     return conn.delete(lock_name)
 
 
+def get_final_state_key(identifier):
+    return '{}:final:{}'.format(
+        settings.MAILSEND['CACHE_PREFIX'], identifier)
+
+
+def set_final_state(identifier, status):
+    return conn.set(
+        get_final_state_key(identifier), status,
+        settings.MAILSEND['FINAL_STATE_CACHE_TIMEOUT'])
+
+
+def get_final_state(identifier, mailstatus_class=None):
+    """
+    Return the final (or deleted) status reached by `identifier`
+
+    Without a cached flag (mail finished before flags were recorded, or
+    flag expired), final statuses of `mailstatus_class`, if given, are
+    looked up and the flag is set back from the latest one.
+    """
+    status = conn.get(get_final_state_key(identifier))
+    if status is not None:
+        return status.decode('utf-8')
+    if mailstatus_class is None:
+        return None
+    status = mailstatus_class.objects.filter(
+        mail__identifier=identifier,
+        status__in=[mailstatus_class.DELETED] + list(
+            mailstatus_class.FINAL_STATES)).order_by(
+                '-creation_date').values_list('status', flat=True).first()
+    if status is not None:
+        set_final_state(identifier, status)
+    return status
+
+
 def record_status(mailstatus, identifier, ehlo=None, reply=None):
     from ..models import Mail
 
@@ -38,3 +76,61 @@ def get_envelope(identifier):
     from ..models import Mail
 
     return Mail.objects.get(identifier=identifier).as_envelope()
+
+
+def _envelope_cache_key(identifier):
+    return '{}:envelope:{}'.format(
+        settings.MAILSEND['CACHE_PREFIX'], identifier)
+
+
+def _envelope_body_cache_key(body_hash):
+    return '{}:envelope:body:{}'.format(
+        settings.MAILSEND['CACHE_PREFIX'], body_hash)
+
+
+def cache_envelope(identifier, envelope):
+    """
+    Keep a built envelope (relay policies applied, DKIM signed) so that
+    retries don't have to rebuild it from database.
+
+    Bodies are stored once per content hash and shared between envelopes
+    (eg. every recipient of a campaign).
+    """
+    timeout = settings.MAILSEND['ENVELOPE_CACHE_TIMEOUT']
+    if not timeout or len(envelope.message) > settings.MAILSEND[
+            'ENVELOPE_CACHE_MAX_SIZE']:
+        return False
+    headers_data, message_data = envelope.flatten()
+    body_hash = hashlib.sha256(message_data).hexdigest()
+    body_key = _envelope_body_cache_key(body_hash)
+    # Only send the body if no other envelope already did
+    if not conn.expire(body_key, timeout):
+        conn.set(body_key, message_data, timeout)
+    conn.set(_envelope_cache_key(identifier), pickle.dumps({
+        'sender': envelope.sender,
+        'recipients': list(envelope.recipients),
+        'headers': headers_data,
+        'body_hash': body_hash}), timeout)
+    return True
+
+
+def get_cached_envelope(identifier):
+    """ Return the cached envelope of `identifier` or None """
+    if not settings.MAILSEND['ENVELOPE_CACHE_TIMEOUT']:
+        return None
+    value = conn.get(_envelope_cache_key(identifier))
+    if value is None:
+        return None
+    value = pickle.loads(value)
+    body = conn.get(_envelope_body_cache_key(value['body_hash']))
+    if body is None:
+        return None
+    envelope = Envelope(
+        sender=value['sender'], recipients=value['recipients'])
+    envelope.parse(value['headers'])
+    envelope.message = body
+    return envelope
+
+
+def delete_cached_envelope(identifier):
+    return conn.delete(_envelope_cache_key(identifier))
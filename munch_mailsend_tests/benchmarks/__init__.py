@@ -0,0 +1,19 @@
+"""
+Routing simulation harness
+
+Drives `route_envelope` (and thus `WorkerManager.find_worker` and every
+worker policy) with synthetic traffic. Tasks published by the router go
+to an in-memory broker, sent mails get a reply drawn from a distribution
+(recording their status like MX workers do) and deferred ones, as well
+as those the router put back in the routing queue, are routed again.
+Redis commands and routing lock waits are measured along the way.
+
+Scenarios are in `bench_routing` and are not part of the test suite:
+
+    make benchmark
+
+Set MAILSEND_BENCHMARK_MAILS to change the number of simulated mails and
+MAILSEND_BENCHMARK_FAKEREDIS=1 to run against fakeredis instead of the
+configured Redis (fakeredis has no Lua support, so scenarios using
+scripted policies are skipped).
+"""
@@ -0,0 +1,86 @@
+import os
+import sys
+import copy
+from unittest import skipIf
+
+from django.conf import settings
+from django.test import override_settings
+from django.test import TransactionTestCase
+from django_redis import get_redis_connection
+
+from munch_mailsend.models import MailStatus
+
+from .harness import use_fakeredis
+from .harness import format_report
+from .harness import RoutingSimulation
+
+MAILS = int(os.environ.get('MAILSEND_BENCHMARK_MAILS', 500))
+FAKEREDIS = os.environ.get('MAILSEND_BENCHMARK_FAKEREDIS') == '1'
+
+WARM_UP_SETTINGS = {
+    'warm_up': {
+        'prioritize': 'equal',
+        'domain_warm_up': {
+            'matrix': [50, 100, 300, 500, 1000],
+            'goal': 500, 'step_tolerance': 10, 'max_tolerance': 10},
+        'ip_warm_up': {
+            'enabled': True,
+            'matrix': [50, 100, 300, 500, 1000],
+            'goal': 500, 'step_tolerance': 10, 'max_tolerance': 10}}}
+
+
+def mailsend_settings(**kwargs):
+    return dict(copy.deepcopy(settings.MAILSEND), **kwargs)
+
+
+class RoutingBenchmark(TransactionTestCase):
+    """ Routing pipeline scenarios, each one printing its report """
+    def tearDown(self):
+        if not FAKEREDIS:
+            conn = get_redis_connection()
+            for key in conn.scan_iter('{}:*'.format(
+                    settings.MAILSEND['CACHE_PREFIX'])):
+                conn.delete(key)
+
+    def simulate(self, name, **kwargs):
+        simulation = RoutingSimulation(**kwargs)
+        simulation.setup(MAILS)
+        if FAKEREDIS:
+            with use_fakeredis():
+                report = simulation.run()
+        else:
+            report = simulation.run()
+        sys.stdout.write(format_report(name, report))
+        self.assertGreaterEqual(report['decisions'], MAILS)
+        return report
+
+    def test_default_policies(self):
+        self.simulate('Default policies', workers=8, domains=20)
+
+    def test_pools(self):
+        self.simulate(
+            'Pools', workers=8, domains=20,
+            pools=('default', 'transactional', 'marketing'))
+
+    def test_warm_up(self):
+        self.simulate(
+            'IP and domain warm-up', workers=8, domains=20,
+            worker_settings=WARM_UP_SETTINGS)
+
+    def test_deferrals(self):
+        self.simulate(
+            'Many deferrals', workers=8, domains=5, replies={
+                MailStatus.DELIVERED: 0.6, MailStatus.DELAYED: 0.4})
+
+    def test_concurrent_routers(self):
+        self.simulate(
+            'Concurrent routers', workers=8, domains=20, concurrency=4)
+
+    @skipIf(FAKEREDIS, 'fakeredis has no Lua support')
+    def test_token_bucket(self):
+        policies = [
+            p.replace('rate_limit', 'token_bucket')
+            for p in settings.MAILSEND['WORKER_POLICIES']]
+        with override_settings(MAILSEND=mailsend_settings(
+                WORKER_POLICIES=policies)):
+            self.simulate('Token buckets', workers=8, domains=20)
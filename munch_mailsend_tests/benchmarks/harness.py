@@ -0,0 +1,383 @@
+""" Routing simulation harness (see the package docstring) """
+import sys
+import copy
+import time
+import random
+import bisect
+import threading
+from itertools import accumulate
+from unittest import mock
+from contextlib import ExitStack
+from collections import deque
+from collections import Counter
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection
+from redis.client import Script
+from redis.client import StrictRedis
+from slimta.smtp.reply import Reply
+
+from munch_mailsend import tasks
+from munch_mailsend.models import Mail
+from munch_mailsend.models import Worker
+from munch_mailsend.models import MailStatus
+from munch_mailsend.utils.lanes import get_lanes
+from munch_mailsend.utils.payloads import TaskBackend
+from munch_mailsend.utils.payloads import encode_backend
+
+BACKEND = TaskBackend(
+    'munch_mailsend.models.MailStatus',
+    'munch_mailsend.utils.tasks.record_status',
+    'munch_mailsend.utils.tasks.get_envelope')
+
+REPLIES = {
+    MailStatus.DELIVERED: Reply('250', '2.0.0 Ok: queued'),
+    MailStatus.DELAYED: Reply('421', '4.7.0 Try again later'),
+    MailStatus.BOUNCED: Reply('550', '5.1.1 User unknown')}
+
+
+def weighted_choice(rng, items, weights):
+    cumulative = list(accumulate(weights))
+    return items[bisect.bisect(cumulative, rng.random() * cumulative[-1])]
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(
+        len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+def is_redis_client(value):
+    return isinstance(value, StrictRedis) or \
+        type(value).__module__ == 'fakeredis'
+
+
+def iter_redis_attributes():
+    """
+    Yield (owner, attribute, client) for every Redis client of mailsend
+    modules and of their Lua scripts
+    """
+    for name, module in list(sys.modules.items()):
+        if not name.startswith('munch_mailsend') or module is None:
+            continue
+        for attr, value in list(vars(module).items()):
+            if isinstance(value, Script):
+                yield value, 'registered_client', value.registered_client
+            elif is_redis_client(value):
+                yield module, attr, value
+
+
+def use_fakeredis():
+    """
+    Return a context manager making mailsend modules (and their Lua
+    scripts) use a single fakeredis server
+    """
+    import fakeredis
+
+    server = fakeredis.FakeStrictRedis()
+    stack = ExitStack()
+    for owner, attr, client in iter_redis_attributes():
+        if client is not server:
+            stack.enter_context(mock.patch.object(owner, attr, server))
+    return stack
+
+
+class CountedClient:
+    """
+    Proxy to a Redis (or fakeredis) client counting each command as a
+    round trip, and pipelined commands as one round trip on execute
+    """
+    def __init__(self, client, counter):
+        self._client = client
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        if name == 'pipeline':
+            return self._pipeline
+        counter = self._counter
+
+        def counted(*args, **kwargs):
+            counter.add(1)
+            return attr(*args, **kwargs)
+        return counted
+
+    def _pipeline(self, *args, **kwargs):
+        pipe = self._client.pipeline(*args, **kwargs)
+        execute = pipe.execute
+        counter = self._counter
+
+        def counted_execute(*args, **kwargs):
+            # redis-py and fakeredis pipelines buffer commands differently
+            commands = len(
+                getattr(pipe, 'command_stack', None) or
+                getattr(pipe, 'commands', None) or [])
+            if commands:
+                counter.add(commands)
+            return execute(*args, **kwargs)
+        pipe.execute = counted_execute
+        return pipe
+
+
+class RedisCounter:
+    """ Count Redis commands and round trips of mailsend clients """
+    def __init__(self):
+        self.commands = 0
+        self.round_trips = 0
+        self.active = False
+        self._lock = threading.Lock()
+        self._stack = None
+
+    def add(self, commands):
+        if self.active:
+            with self._lock:
+                self.commands += commands
+                self.round_trips += 1
+
+    def __enter__(self):
+        # Patch the clients actually in use (which may be fakeredis ones,
+        # whose classes don't derive from redis-py's)
+        proxies = {}
+        self._stack = ExitStack()
+        for owner, attr, client in iter_redis_attributes():
+            if id(client) not in proxies:
+                proxies[id(client)] = CountedClient(client, self)
+            self._stack.enter_context(
+                mock.patch.object(owner, attr, proxies[id(client)]))
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stack.close()
+
+
+class InMemoryBroker:
+    """ Keep tasks published by the router, by routing key """
+    def __init__(self):
+        self.queues = defaultdict(deque)
+        self._lock = threading.Lock()
+        self._patch = mock.patch.object(tasks, 'delay_task', self.publish)
+
+    def publish(self, task, args=(), kwargs=None, countdown=0, **options):
+        with self._lock:
+            self.queues[options.get('routing_key')].append({
+                'task': task.name, 'args': list(args),
+                'kwargs': dict(kwargs or {}), 'countdown': countdown})
+        return None
+
+    def consume(self):
+        """ Pop every queued message as (routing_key, message) """
+        with self._lock:
+            for routing_key, queue in self.queues.items():
+                while queue:
+                    yield routing_key, queue.popleft()
+
+    def __enter__(self):
+        self._patch.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._patch.stop()
+
+
+class RoutingSimulation:
+    """
+    Synthetic traffic for the routing pipeline.
+
+    `workers` MX workers serve `pools` (round-robin) with
+    `worker_settings` policies settings (eg. warm-up matrices) on top of
+    WORKER_POLICIES_SETTINGS. Mails go to `domains` destination domains
+    and come from `users` users, both skewed (a few big domains and
+    senders). `replies` maps statuses to their probability. Mails are
+    routed by `concurrency` threads.
+    """
+    def __init__(
+            self, workers=4, domains=10, pools=('default', ), users=5,
+            replies=None, worker_settings=None, concurrency=1,
+            max_rounds=5, seed=42):
+        self.workers = workers
+        self.domains = domains
+        self.pools = pools
+        self.users = users
+        self.replies = replies or {
+            MailStatus.DELIVERED: 0.9, MailStatus.DELAYED: 0.08,
+            MailStatus.BOUNCED: 0.02}
+        self.worker_settings = worker_settings or {}
+        self.concurrency = concurrency
+        self.max_rounds = max_rounds
+        self.random = random.Random(seed)
+        self.backend_kwargs = encode_backend(BACKEND)
+
+        self.mails = []
+        self.mail_ids = {}
+        self.decision_times = []
+        self.lock_waits = []
+        self.outcomes = Counter()
+        self.elapsed = 0
+        self._lock = threading.Lock()
+
+    def skewed_choice(self, prefix, count):
+        index = weighted_choice(
+            self.random, range(count), [1 / (i + 1) for i in range(count)])
+        return '{}{}'.format(prefix, index)
+
+    def setup(self, mails):
+        for index in range(self.workers):
+            policies_settings = copy.deepcopy(
+                settings.MAILSEND.get('WORKER_POLICIES_SETTINGS', {}))
+            policies_settings.update(copy.deepcopy(self.worker_settings))
+            policies_settings['pool'] = {
+                'pools': [self.pools[index % len(self.pools)]]}
+            Worker.objects.create(
+                name='worker_{:02}'.format(index),
+                ip='10.0.{}.{}'.format(index // 250, index % 250 + 1),
+                policies_settings=policies_settings)
+
+        for index in range(mails):
+            domain = self.skewed_choice('domain', self.domains)
+            self.mails.append(Mail(
+                identifier='bench{:06}'.format(index),
+                recipient='rcpt{}@{}.example'.format(index, domain),
+                headers={
+                    'To': 'rcpt{}@{}.example'.format(index, domain),
+                    settings.MAILSEND['X_POOL_HEADER']: self.random.choice(
+                        self.pools),
+                    settings.MAILSEND['X_USER_ID_HEADER']:
+                        self.skewed_choice('', self.users)}))
+        Mail.objects.bulk_create(self.mails)
+        self.mail_ids = dict(Mail.objects.filter(
+            identifier__startswith='bench').values_list('identifier', 'pk'))
+        self.workers_by_queue = {}
+        for worker in Worker.objects.all():
+            for lane in get_lanes():
+                for retry in (False, True):
+                    self.workers_by_queue[worker.get_queue_name(
+                        retry=retry, lane=lane)] = worker
+
+    def timed_acquire_lock(self, *args, **kwargs):
+        started = time.perf_counter()
+        lock = self._acquire_lock(*args, **kwargs)
+        with self._lock:
+            self.lock_waits.append(time.perf_counter() - started)
+        return lock
+
+    def route(self, envelopes):
+        """ Route (identifier, headers, attempts, kwargs) envelopes """
+        def run(chunk):
+            try:
+                for identifier, headers, attempts, kwargs in chunk:
+                    started = time.perf_counter()
+                    tasks.route_envelope(
+                        identifier, headers, attempts,
+                        **dict(self.backend_kwargs, **kwargs))
+                    with self._lock:
+                        self.decision_times.append(
+                            time.perf_counter() - started)
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        if self.concurrency > 1:
+            threads = [
+                threading.Thread(target=run, args=(
+                    envelopes[i::self.concurrency], ))
+                for i in range(self.concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        else:
+            run(envelopes)
+        self.elapsed += time.perf_counter() - started
+
+    def deliver(self, broker):
+        """
+        Record a reply for every mail handed to a worker and return
+        envelopes to route again: delayed ones and those put back in the
+        routing queue by the router
+        """
+        statuses, replies = zip(*self.replies.items())
+        envelopes = []
+        for routing_key, message in list(broker.consume()):
+            identifier, headers, attempts = message['args'][:3]
+            worker = self.workers_by_queue.get(routing_key)
+            if worker is None:
+                # No worker available (or lock timeout): the router put
+                # it back in the routing queue
+                self.outcomes['rerouted'] += 1
+                envelopes.append(
+                    (identifier, headers, attempts, message['kwargs']))
+                continue
+            self.outcomes['scheduled'] += 1
+            status = weighted_choice(self.random, statuses, replies)
+            reply = REPLIES[status]
+            self.outcomes[status] += 1
+            MailStatus.objects.create(
+                mail_id=self.mail_ids[identifier], status=status,
+                source_ip=worker.ip,
+                destination_domain=headers['To'].split('@')[-1],
+                raw_msg='{} {}'.format(reply.code, reply.message),
+                status_code=reply.enhanced_status_code)
+            if status == MailStatus.DELAYED:
+                envelopes.append(
+                    (identifier, headers, attempts + 1, {'reply': reply}))
+        return envelopes
+
+    def run(self):
+        envelopes = [
+            (mail.identifier, mail.headers, 0, {}) for mail in self.mails]
+        self._acquire_lock = tasks.acquire_lock
+        with ExitStack() as stack:
+            broker = stack.enter_context(InMemoryBroker())
+            counter = stack.enter_context(RedisCounter())
+            stack.enter_context(mock.patch.object(
+                tasks, 'acquire_lock', self.timed_acquire_lock))
+            for _ in range(self.max_rounds):
+                if not envelopes:
+                    break
+                counter.active = True
+                self.route(envelopes)
+                counter.active = False
+                envelopes = self.deliver(broker)
+        return self.report(counter)
+
+    def report(self, counter):
+        decisions = len(self.decision_times)
+        return {
+            'decisions': decisions,
+            'elapsed': self.elapsed,
+            'decisions_per_second': decisions / (self.elapsed or 1),
+            'decision_p50': percentile(self.decision_times, 50),
+            'decision_p99': percentile(self.decision_times, 99),
+            'lock_wait_p50': percentile(self.lock_waits, 50),
+            'lock_wait_p99': percentile(self.lock_waits, 99),
+            'redis_commands_per_decision': counter.commands / (
+                decisions or 1),
+            'redis_round_trips_per_decision': counter.round_trips / (
+                decisions or 1),
+            'outcomes': dict(self.outcomes)}
+
+
+def format_report(name, report):
+    lines = [
+        '',
+        name,
+        '  decisions            : {decisions} in {elapsed:.2f}s '
+        '({decisions_per_second:.1f}/s)',
+        '  decision p50 / p99   : {decision_p50_ms:.2f}ms / '
+        '{decision_p99_ms:.2f}ms',
+        '  lock wait p50 / p99  : {lock_wait_p50_ms:.2f}ms / '
+        '{lock_wait_p99_ms:.2f}ms',
+        '  redis per decision   : {redis_commands_per_decision:.1f} '
+        'commands, {redis_round_trips_per_decision:.1f} round trips',
+        '  outcomes             : {outcomes}',
+        '']
+    values = dict(report, **{
+        '{}_ms'.format(key): report[key] * 1000 for key in (
+            'decision_p50', 'decision_p99', 'lock_wait_p50',
+            'lock_wait_p99')})
+    return '\n'.join(lines).format(**values)
@@ -0,0 +1,106 @@
+from django.conf import settings
+from django.test import override_settings
+from libfaketime import fake_time
+from django_redis import get_redis_connection
+
+from munch_mailsend.models import Mail
+from munch_mailsend.models import Worker
+from munch_mailsend.models import MailStatus
+from munch_mailsend.policies.mx import First
+from munch_mailsend.policies.mx import adaptive
+
+from . import MailSendTestCase
+
+conn = get_redis_connection('default')
+
+ADAPTIVE_SETTINGS = {
+    'initial_interval': 10, 'min_interval': 5, 'max_interval': 80,
+    'decrease_factor': 2, 'increase_step': 0.1, 'max_queued': 60}
+
+MAILSEND = dict(
+    settings.MAILSEND,
+    WORKER_POLICIES=settings.MAILSEND['WORKER_POLICIES'] + [
+        'munch_mailsend.policies.mx.adaptive.Policy'],
+    WORKER_POLICIES_SETTINGS=dict(
+        settings.MAILSEND['WORKER_POLICIES_SETTINGS'],
+        adaptive=ADAPTIVE_SETTINGS))
+
+
+@override_settings(MAILSEND=MAILSEND)
+class AdaptivePolicyTestCase(MailSendTestCase):
+    def setUp(self):
+        super().setUp()
+        self.worker = Worker.objects.create(
+            name='worker_01', ip='10.0.0.1',
+            policies_settings={'adaptive': ADAPTIVE_SETTINGS})
+        self.mail = Mail.objects.create(
+            identifier='0001', headers={'To': 'you@example.com'},
+            recipient='you@example.com')
+        self.key = adaptive.Policy.get_key('10.0.0.1', 'example.com')
+
+    def create_status(self, status, source_ip='10.0.0.1', **kwargs):
+        MailStatus.objects.create(
+            destination_domain='example.com', mail=self.mail,
+            source_ip=source_ip, status=status, **kwargs)
+
+    def get_interval(self, key=None):
+        return float(conn.hget(key or self.key, 'interval'))
+
+    def get_policy(self):
+        return adaptive.Policy('0002', {'To': 'you@example.com'}, MailStatus)
+
+    def apply(self):
+        workers = First().apply({'To': 'you@example.com'})
+        return self.get_policy().apply(workers)
+
+    def test_reserve(self):
+        with fake_time('2016-10-10 08:00:00'):
+            for expected in ('08:00:00', '08:00:10'):
+                policy = self.get_policy()
+                worker = policy.apply(
+                    First().apply({'To': 'you@example.com'}))[0]
+                # The mail is sent at its reserved slot
+                self.assertEqual(
+                    policy.reserve(
+                        worker, worker['next_available']).isoformat(),
+                    '2016-10-10T{}+00:00'.format(expected))
+            worker = self.apply()[0]
+        self.assertEqual(
+            worker['next_available'].isoformat(), '2016-10-10T08:00:20+00:00')
+
+    def test_aimd(self):
+        self.create_status(
+            MailStatus.DELAYED, raw_msg='421 4.7.0 Try again later',
+            status_code='4.7.0')
+        self.assertEqual(self.get_interval(), 20)
+        # Not a rate related deferral
+        self.create_status(
+            MailStatus.DELAYED, raw_msg='452 4.2.2 Mailbox full',
+            status_code='4.2.2')
+        self.assertEqual(self.get_interval(), 20)
+
+        # 1 / (1 / 20 + 0.1)
+        self.create_status(MailStatus.DELIVERED)
+        self.assertAlmostEqual(self.get_interval(), 6.666, places=2)
+        self.create_status(MailStatus.DELIVERED)
+        self.assertEqual(self.get_interval(), 5)
+
+    def test_worker_settings(self):
+        Worker.objects.create(
+            name='worker_02', ip='10.0.0.2',
+            policies_settings={'adaptive': dict(
+                ADAPTIVE_SETTINGS, initial_interval=30, max_interval=300)})
+        self.create_status(
+            MailStatus.DELAYED, source_ip='10.0.0.2',
+            raw_msg='421 4.7.0 Try again later', status_code='4.7.0')
+        # Updated with the settings apply() uses for this worker
+        self.assertEqual(self.get_interval(adaptive.Policy.get_key(
+            '10.0.0.2', 'example.com')), 60)
+
+    def test_too_slow(self):
+        conn.hmset(self.key, {'interval': 80, 'next_slot': 0})
+        with fake_time('2016-10-10 08:00:00'):
+            policy = self.get_policy()
+            worker = policy.apply(First().apply({'To': 'you@example.com'}))[0]
+            policy.reserve(worker, worker['next_available'])
+            self.assertEqual(self.apply(), [])
@@ -0,0 +1,69 @@
+from django.core.mail import EmailMessage
+from django.db.models.signals import pre_save
+from django.db.models.signals import post_save
+from slimta.envelope import Envelope
+
+from munch_mailsend.models import Mail
+from munch_mailsend.models import MailStatus
+from munch_mailsend.models import RawMailDigest
+from munch_mailsend.backend import Backend
+
+from . import MailSendTestCase
+
+
+class BackendTestCase(MailSendTestCase):
+    def setUp(self):
+        super().setUp()
+        self.backend = Backend(
+            build_envelope_task_path='munch_mailsend.utils.tasks.get_envelope',
+            mailstatus_class_path='munch_mailsend.models.MailStatus',
+            record_status_task_path='munch_mailsend.utils.tasks.record_status')
+
+    def build_envelope(self, recipient, body):
+        envelope = Envelope(
+            sender='sender@example.com', recipients=[recipient])
+        envelope.parse(
+            'From: sender@example.com\r\nTo: {}\r\nSubject: Hi\r\n'
+            '\r\n{}'.format(recipient, body).encode('utf-8'))
+        return envelope
+
+    def test_send_envelopes_bulk(self):
+        envelopes = [
+            self.build_envelope('you+{}@example.com'.format(i), body)
+            for i, body in enumerate(['My Body\n', 'My Body\r\n', 'Other'])]
+        self.assertEqual(
+            self.backend.send_envelopes_bulk(envelopes, chunk_size=2), 3)
+
+        self.assertEqual(Mail.objects.count(), 3)
+        # Bodies are normalized before being deduplicated
+        self.assertEqual(RawMailDigest.objects.count(), 2)
+        self.assertEqual(MailStatus.objects.filter(
+            status=MailStatus.QUEUED,
+            destination_domain='example.com').count(), 3)
+        for mail in Mail.objects.all():
+            self.assertEqual(mail.headers['To'], mail.recipient)
+
+    def test_send_messages_fires_signals(self):
+        signals = []
+
+        def receiver(sender, instance, signal, **kwargs):
+            signals.append((signal, instance.mail.identifier))
+
+        pre_save.connect(receiver, sender=MailStatus)
+        post_save.connect(receiver, sender=MailStatus)
+        try:
+            self.assertEqual(self.backend.send_messages([
+                EmailMessage(
+                    'Hi', 'My Body', 'sender@example.com',
+                    ['you+{}@example.com'.format(i)])
+                for i in range(2)]), 2)
+        finally:
+            pre_save.disconnect(receiver, sender=MailStatus)
+            post_save.disconnect(receiver, sender=MailStatus)
+
+        identifiers = set(Mail.objects.values_list('identifier', flat=True))
+        self.assertEqual(len(identifiers), 2)
+        # Statuses of every message went through model signals
+        for signal in (pre_save, post_save):
+            self.assertEqual(
+                {i for s, i in signals if s is signal}, identifiers)
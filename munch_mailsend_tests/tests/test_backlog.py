@@ -0,0 +1,37 @@
+from munch_mailsend.models import Worker
+from munch_mailsend.models import MailStatus
+from munch_mailsend.policies.mx import First
+from munch_mailsend.policies.mx import backlog
+
+from . import MailSendTestCase
+
+
+class BacklogPolicyTestCase(MailSendTestCase):
+    def setUp(self):
+        super().setUp()
+        policies_settings = {
+            'backlog': {'penalty': 0.5, 'threshold': 1000, 'max_queued': 5000}}
+        for i in range(1, 4):
+            Worker.objects.create(
+                name='worker_0{}'.format(i), ip='10.0.0.{}'.format(i),
+                policies_settings=policies_settings)
+
+    def apply(self):
+        workers = First().apply({'To': 'you@example.com'})
+        return {
+            w['ip']: w['score'] for w in backlog.Policy(
+                '0001', {'To': 'you@example.com'}, MailStatus).apply(workers)}
+
+    def test_no_queue_sizes(self):
+        self.assertEqual(
+            self.apply(), {'10.0.0.1': 0, '10.0.0.2': 0, '10.0.0.3': 0})
+
+    def test_penalize_backlog(self):
+        Worker.objects.set_queue_sizes({
+            '10.0.0.1': 0, '10.0.0.2': 2000, '10.0.0.3': 8000})
+        self.assertEqual(self.apply(), {'10.0.0.1': 0, '10.0.0.2': -1})
+
+    def test_all_workers_backlogged(self):
+        Worker.objects.set_queue_sizes({
+            '10.0.0.1': 9000, '10.0.0.2': 9000, '10.0.0.3': 9000})
+        self.assertEqual(len(self.apply()), 3)
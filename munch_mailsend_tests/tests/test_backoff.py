@@ -0,0 +1,90 @@
+import math
+
+from slimta.smtp.reply import Reply
+
+from munch_mailsend.utils.backoff import get_backoff
+from munch_mailsend.utils.backoff import get_retry_policy
+from munch_mailsend.utils.backoff import ExponentialBackOff
+
+from . import MailSendTestCase
+
+POLICY = {
+    'min_retry_interval': 600,
+    'max_retry_interval': 3600,
+    'time_before_drop': 2 * 24 * 3600}
+
+
+def reference_backoff(attempts, policy=POLICY):
+    """ Previous implementation, summing delays on each call """
+    base = min(250, policy['min_retry_interval'] - 1)
+    A = (policy['min_retry_interval'] - base) / math.e
+
+    def delay(n):
+        return min(A * math.e**n + base, policy['max_retry_interval'])
+
+    if sum(delay(n) for n in range(attempts)) <= policy['time_before_drop']:
+        return int(delay(attempts))
+    return None
+
+
+class ExponentialBackOffTestCase(MailSendTestCase):
+    def test_same_schedule(self):
+        backoff = ExponentialBackOff(POLICY)
+        for attempts in range(100):
+            self.assertEqual(backoff(attempts), reference_backoff(attempts))
+
+    def test_small_min_interval(self):
+        policy = dict(POLICY, min_retry_interval=10, time_before_drop=600)
+        backoff = ExponentialBackOff(policy)
+        for attempts in range(100):
+            self.assertEqual(
+                backoff(attempts), reference_backoff(attempts, policy))
+
+    def test_jitter(self):
+        backoff = ExponentialBackOff(dict(POLICY, jitter=0.1))
+        delays = {backoff(4) for _ in range(50)}
+        self.assertGreater(len(delays), 1)
+        for delay in delays:
+            self.assertTrue(3240 <= delay <= 3960)
+        self.assertIsNone(backoff(1000))
+
+    def test_missing_key(self):
+        with self.assertRaises(KeyError):
+            ExponentialBackOff({'min_retry_interval': 600})
+
+    def test_shared_backoff(self):
+        self.assertIs(get_backoff(POLICY), get_backoff(dict(POLICY)))
+        self.assertIsNot(
+            get_backoff(POLICY), get_backoff(dict(POLICY, jitter=0.1)))
+        # Matching keys are not part of the schedule
+        self.assertIs(
+            get_backoff(POLICY), get_backoff(dict(POLICY, domains='.*')))
+
+
+class RetryPolicyTestCase(MailSendTestCase):
+    def setUp(self):
+        super().setUp()
+        self.throttled = dict(POLICY, reply_codes=['421', '4.7.'])
+        self.example = dict(POLICY, domains=r'example\.com$')
+        self.policies = [self.throttled, self.example]
+
+    def test_default(self):
+        self.assertIs(get_retry_policy(
+            self.policies, POLICY, domain='foo.com',
+            reply=Reply('450', '4.2.0 Mailbox busy')), POLICY)
+        self.assertIs(get_retry_policy([], POLICY), POLICY)
+
+    def test_reply_code(self):
+        self.assertIs(get_retry_policy(
+            self.policies, POLICY, domain='example.com',
+            reply=Reply('421', 'Too many connections')), self.throttled)
+        self.assertIs(get_retry_policy(
+            self.policies, POLICY, domain='foo.com',
+            reply=Reply('450', '4.7.1 Rate limited')), self.throttled)
+
+    def test_domain(self):
+        self.assertIs(get_retry_policy(
+            self.policies, POLICY, domain='example.com',
+            reply=Reply('450', '4.2.0 Mailbox busy')), self.example)
+        self.assertIs(get_retry_policy(
+            self.policies, POLICY, domain='example.com'), self.example)
@@ -0,0 +1,38 @@
+from munch_mailsend.tasks import CLAIM_OK
+from munch_mailsend.tasks import CLAIM_FINAL
+from munch_mailsend.tasks import CLAIM_STALE
+from munch_mailsend.tasks import CLAIM_NO_TOKEN
+from munch_mailsend.tasks import CLAIM_IN_FLIGHT
+from munch_mailsend.tasks import claim_envelope
+from munch_mailsend.tasks import set_envelope_token
+from munch_mailsend.tasks import release_envelope_claim
+from munch_mailsend.utils.tasks import set_final_state
+
+from . import MailSendTestCase
+from ..models import MailStatus
+
+
+class ClaimEnvelopeTestCase(MailSendTestCase):
+    def test_claim(self):
+        self.assertEqual(claim_envelope('0001', 'token'), CLAIM_NO_TOKEN)
+
+        token = set_envelope_token('0001')
+        self.assertEqual(claim_envelope('0001', 'stale'), CLAIM_STALE)
+        self.assertEqual(claim_envelope('0001', token), CLAIM_OK)
+        self.assertEqual(claim_envelope('0001', token), CLAIM_IN_FLIGHT)
+
+        release_envelope_claim('0001', token)
+        self.assertEqual(claim_envelope('0001', token), CLAIM_OK)
+
+    def test_new_token(self):
+        token = set_envelope_token('0001')
+        self.assertEqual(claim_envelope('0001', token), CLAIM_OK)
+        # Re-routed while the previous attempt is still marked in flight
+        new_token = set_envelope_token('0001')
+        self.assertEqual(claim_envelope('0001', new_token), CLAIM_OK)
+        self.assertEqual(claim_envelope('0001', token), CLAIM_STALE)
+
+    def test_final_state(self):
+        token = set_envelope_token('0001')
+        set_final_state('0001', MailStatus.DELIVERED)
+        self.assertEqual(claim_envelope('0001', token), CLAIM_FINAL)
@@ -0,0 +1,86 @@
+import pickle
+from unittest import mock
+from itertools import count
+
+from django.conf import settings
+from django.test import override_settings
+from libfaketime import fake_time
+from django_redis import get_redis_connection
+
+from munch_mailsend.tasks import route_envelope
+from munch_mailsend.utils import delay
+from munch_mailsend.utils.delay import delay_task
+from munch_mailsend.utils.delay import publish_due_tasks
+from munch_mailsend.utils.delay import get_delay_queue_key
+from munch_mailsend.utils.delay import count_delayed_tasks
+
+from . import MailSendTestCase
+
+conn = get_redis_connection('default')
+
+
+@override_settings(MAILSEND=dict(settings.MAILSEND, DELAY_QUEUE_ENABLED=True))
+class DelayQueueTestCase(MailSendTestCase):
+    def test_delay_task(self):
+        with fake_time('2016-10-10 08:00:00'):
+            task_id = delay_task(
+                route_envelope, ('0001', {}, 0), {'version': 2},
+                countdown=60)
+        self.assertEqual(count_delayed_tasks(), 1)
+        name, args, kwargs, options = pickle.loads(
+            conn.zrange(get_delay_queue_key(), 0, -1)[0])
+        self.assertEqual(name, route_envelope.name)
+        self.assertEqual(args, ('0001', {}, 0))
+        self.assertEqual(kwargs, {'version': 2})
+        self.assertEqual(options, {'task_id': task_id})
+
+    @mock.patch('munch_mailsend.utils.delay.current_app')
+    def test_publish_due_tasks(self, app):
+        with fake_time('2016-10-10 08:00:00'):
+            delay_task(route_envelope, ('0001', {}, 0), countdown=60)
+            delay_task(route_envelope, ('0002', {}, 0), countdown=120)
+
+        with fake_time('2016-10-10 08:00:30'):
+            self.assertEqual(publish_due_tasks(), 0)
+        with fake_time('2016-10-10 08:01:30'):
+            self.assertEqual(publish_due_tasks(), 1)
+        self.assertEqual(count_delayed_tasks(), 1)
+        self.assertEqual(app.send_task.call_count, 1)
+        self.assertEqual(
+            app.send_task.call_args[0][:2],
+            (route_envelope.name, ('0001', {}, 0)))
+
+        with fake_time('2016-10-10 08:02:30'):
+            self.assertEqual(publish_due_tasks(), 1)
+        self.assertEqual(count_delayed_tasks(), 0)
+
+    def get_lock_name(self):
+        return '{}:lock:delayed'.format(settings.MAILSEND['CACHE_PREFIX'])
+
+    @mock.patch('munch_mailsend.utils.delay.current_app')
+    def test_lock_of_another_scheduler_is_kept(self, app):
+        delay_task(route_envelope, ('0001', {}, 0), countdown=-1)
+        conn.set(self.get_lock_name(), 'other', ex=60)
+        self.assertEqual(publish_due_tasks(), 0)
+        self.assertEqual(conn.get(self.get_lock_name()), b'other')
+
+        conn.delete(self.get_lock_name())
+
+        def send_task(*args, **kwargs):
+            # Our lock expired and another scheduler took it
+            conn.set(self.get_lock_name(), 'other', ex=60)
+
+        app.send_task.side_effect = send_task
+        self.assertEqual(publish_due_tasks(), 1)
+        self.assertEqual(conn.get(self.get_lock_name()), b'other')
+
+    @mock.patch('munch_mailsend.utils.delay.current_app')
+    def test_run_stops_before_lock_expires(self, app):
+        for identifier in ('0001', '0002', '0003'):
+            delay_task(route_envelope, (identifier, {}, 0), countdown=-1)
+        clock = count(0, delay.LOCK_TIMEOUT / 3)
+        with mock.patch.object(
+                delay.time, 'monotonic', lambda: next(clock)):
+            self.assertEqual(publish_due_tasks(batch_size=1), 1)
+        self.assertEqual(count_delayed_tasks(), 2)
+        self.assertIsNone(conn.get(self.get_lock_name()))
@@ -1,31 +1,258 @@
+import io
+import re
+import hashlib
 import unittest
+import threading
+
+from django.conf import settings
 
 from munch_mailsend.models import Mail
+from munch_mailsend.models import RawMail
+from munch_mailsend.utils.dkim import sign
 from munch_mailsend.utils.dkim import verify
+from munch_mailsend.utils.dkim import sign_stream
+from munch_mailsend.utils.dkim.utils import RE_BTAG
+from munch_mailsend.utils.dkim.utils import rfc822_parse
+from munch_mailsend.utils.dkim.utils import index_headers
+from munch_mailsend.utils.dkim.utils import select_headers
+from munch_mailsend.utils.dkim.dnscache import TXTCache
+from munch_mailsend.utils.dkim.canonicalization import Simple
+from munch_mailsend.utils.dkim.canonicalization import Relaxed
+from munch_mailsend.utils.dkim.canonicalization import BodyCanonicalizer
 from munch_mailsend.policies.relay import dkim
 
 from . import MailSendTestCase
 
+# Public half of settings.MAILSEND['DKIM_PRIVATE_KEY']
 DNS_TXT = (
-    'v=DKIM1;t=s;p=MIGfMA0GCSqGSIb3DQEBAQUAA4GNADCBiQKBgQDt7Nt5JM5cu/uh8izxLyT'
-    'xYf5HhgGDOE20S4XxpgGOX14DetiDhTX4ziyELgip6sC4vOQWVx+uVkz2uuwd8QgY8N3MhJDc'
-    'eyPpgXi73Er91d8WckY5Gh1exSkg5dCmz9GYzd1Ci1PXlX5mTN+90s5uYsLK1DLGhpsXFNdM5'
-    'atGsQIDAQAB')
+    b'v=DKIM1; k=rsa; p=MIGfMA0GCSqGSIb3DQEBAQUAA4GNADCBiQKBgQC1Lgr+47aZ+dWF'
+    b'yfq/pRrgC0eL4dR4KwX19JvrTuYtS+Wp4Pw2Oov40V37EHOLPQIXUhdVGanvsTHAsBpIG4W8'
+    b'Uf9cUq6zRpljcirHZ4rv+8lGcb1nQYB9YEqepEQli6/kgDIw+stDAfZTY/jLzweaIgj9nyLo'
+    b'CpYcZ5jBRpzTcwIDAQAB')
+DNS_NAME = 'tests._domainkey.mailsend-test.com.'
+
+
+def get_txt(name):
+    return DNS_TXT if name == DNS_NAME else None
 
 
-@unittest.skip('Must fix dkimpy to verify dkim signature')
 class DKIMPolicyTestCase(MailSendTestCase):
-    def test_dkim_verify(self):
+    def sign(self):
+        raw_mail, _ = RawMail.objects.get_or_create(content='My Body')
         mail = Mail.objects.create(
-            identifier='0001', message="My Body",
+            identifier='0001', message=raw_mail,
             headers={
                 'To': 'test-to@example.com',
                 'From': 'test-from@mailsend-test.com',
                 'Subject': 'My Subject'})
         envelope = mail.as_envelope()
-        signer = dkim.Sign()
-        signer.apply(envelope)
+        dkim.Sign().apply(envelope)
+        self.assertIn('DKIM-Signature', envelope.headers)
         headers_data, message_data = envelope.flatten()
+        return headers_data.rstrip(b'\r\n') + b'\r\n\r\n', message_data
+
+    def test_dkim_verify(self):
+        headers_data, message_data = self.sign()
         self.assertTrue(verify(
-            headers_data + b'\r\n' + message_data,
-            dnsfunc=lambda name: DNS_TXT))
+            headers_data + message_data, dnsfunc=get_txt))
+
+    def test_dkim_verify_tampered_body(self):
+        headers_data, message_data = self.sign()
+        self.assertFalse(verify(
+            headers_data + message_data.replace(b'Body', b'B0dy'),
+            dnsfunc=get_txt))
+
+    def test_dkim_verify_tampered_header(self):
+        headers_data, message_data = self.sign()
+        self.assertFalse(verify(
+            headers_data.replace(b'My Subject', b'My Subjekt') +
+            message_data, dnsfunc=get_txt))
+
+
+class SignVerifyTestCase(unittest.TestCase):
+    message = (
+        b'From: test-from@mailsend-test.com\r\n'
+        b'To: test-to@example.com\r\n'
+        b'Subject: My Subject\r\n'
+        b'\r\n'
+        b'My Body\r\n')
+
+    def sign(self):
+        return sign(
+            self.message, b'tests', b'mailsend-test.com',
+            settings.MAILSEND['DKIM_PRIVATE_KEY'].encode('utf-8'),
+            include_headers=[b'From', b'To', b'Subject'])
+
+    def test_btag_blanked(self):
+        self.assertEqual(
+            RE_BTAG.sub(b'\\1', b' v=1; b=ab\r\n\tcd+/=; bh=x'),
+            b' v=1; b=; bh=x')
+        self.assertEqual(
+            RE_BTAG.sub(b'\\1', b' v=1; bh=x;\r\n b = ab\r\n cd==\r\n'),
+            b' v=1; bh=x;\r\n b =')
+
+    def test_round_trip(self):
+        signature = self.sign()
+        self.assertTrue(verify(
+            signature + b'\r\n' + self.message, dnsfunc=get_txt))
+
+    def test_round_trip_folded_signature(self):
+        signature = self.sign()
+        # Folding whitespace in the b= tag is ignored once it is blanked
+        index = signature.rindex(b'b=') + 40
+        signature = signature[:index] + b'\r\n\t' + signature[index:]
+        self.assertTrue(verify(
+            signature + b'\r\n' + self.message, dnsfunc=get_txt))
+
+    def test_tampered_message(self):
+        signature = self.sign()
+        self.assertFalse(verify(
+            signature + b'\r\n' + self.message.replace(b'Body', b'B0dy'),
+            dnsfunc=get_txt))
+        self.assertFalse(verify(
+            signature + b'\r\n' +
+            self.message.replace(b'My Subject', b'My Subjekt'),
+            dnsfunc=get_txt))
+
+
+class BodyCanonicalizationTestCase(unittest.TestCase):
+    def test_simple_body(self):
+        self.assertEqual(Simple.canonicalize_body(b''), b'\r\n')
+        self.assertEqual(Simple.canonicalize_body(b'a \n\n'), b'a \r\n')
+        self.assertEqual(
+            Simple.canonicalize_body(b'a\r\n\r\nb\r\n\r\n\r\n'),
+            b'a\r\n\r\nb\r\n')
+
+    def test_relaxed_body(self):
+        self.assertEqual(Relaxed.canonicalize_body(b''), b'')
+        self.assertEqual(Relaxed.canonicalize_body(b' \t\r\n\r\n'), b'')
+        self.assertEqual(
+            Relaxed.canonicalize_body(b'a \t b \r\n\n\tc\t\r\n\r\n'),
+            b'a b\r\n\r\n c\r\n')
+
+    def test_chunked_body(self):
+        body = b'Hello  world \r\n\r\nsecond\tline\nthird\r\n\r\n'
+        for algorithm in (Simple, Relaxed):
+            h = hashlib.sha256()
+            canonicalizer = algorithm.body_canonicalizer(h)
+            for i in range(0, len(body), 3):
+                canonicalizer.update(memoryview(body)[i:i + 3])
+            canonicalizer.finish()
+            self.assertEqual(
+                h.digest(),
+                hashlib.sha256(algorithm.canonicalize_body(body)).digest())
+
+    def test_body_length_limit(self):
+        h = hashlib.sha256()
+        canonicalizer = BodyCanonicalizer(h, limit=4)
+        canonicalizer.update(b'abcdef\r\n\r\n')
+        self.assertEqual(canonicalizer.finish(), 8)
+        self.assertEqual(h.digest(), hashlib.sha256(b'abcd').digest())
+
+
+class StreamSignTestCase(unittest.TestCase):
+    def test_sign_stream_matches_sign(self):
+        headers_data = (
+            b'From: test-from@mailsend-test.com\r\n'
+            b'To: test-to@example.com\r\n'
+            b'Subject: My  Subject\r\n')
+        body = b'My Body\r\n' * 1000 + b'\r\n\r\n'
+        headers, _ = rfc822_parse(headers_data)
+        kwargs = {
+            'selector': b'tests', 'domain': b'mailsend-test.com',
+            'privkey': settings.MAILSEND['DKIM_PRIVATE_KEY'].encode('utf-8'),
+            'include_headers': [b'From', b'To', b'Subject'], 'length': True}
+
+        expected = sign(headers_data + b'\r\n' + body, **kwargs)
+        for streamed_body in (
+                body, io.BytesIO(body),
+                (body[i:i + 100] for i in range(0, len(body), 100))):
+            signature = sign_stream(headers, streamed_body, **kwargs)
+            # Ignore timestamps
+            self.assertEqual(
+                re.sub(br't=\d+;', b'', signature),
+                re.sub(br't=\d+;', b'', expected))
+
+
+class TXTCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.lookups = []
+        self.records = {'tests._domainkey.example.com.': DNS_TXT}
+
+        def resolver(name):
+            self.lookups.append(name)
+            return self.records.get(name)
+
+        self.cache = TXTCache(
+            resolver, ttl=60, negative_ttl=10, clock=lambda: self.now)
+
+    def test_positive_cache(self):
+        name = 'tests._domainkey.example.com.'
+        self.assertEqual(self.cache(name), DNS_TXT)
+        self.assertEqual(self.cache(name), DNS_TXT)
+        self.assertEqual(self.lookups, [name])
+        self.now = 61
+        self.assertEqual(self.cache(name), DNS_TXT)
+        self.assertEqual(self.lookups, [name, name])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_negative_cache(self):
+        name = 'missing._domainkey.example.com.'
+        self.assertIsNone(self.cache(name))
+        self.assertIsNone(self.cache(name))
+        self.assertEqual(len(self.lookups), 1)
+        self.now = 11
+        self.assertIsNone(self.cache(name))
+        self.assertEqual(len(self.lookups), 2)
+
+    def test_max_entries(self):
+        self.cache.max_entries = 2
+        for name in ('a.', 'b.', 'c.'):
+            self.cache(name)
+        self.assertNotIn('a.', self.cache)
+        self.assertIn('c.', self.cache)
+
+    def test_concurrent_lookups(self):
+        names = ['{}.'.format(i) for i in range(50)]
+        self.cache.max_entries = 20
+
+        def lookup():
+            for name in names * 10:
+                self.cache(name)
+
+        threads = [threading.Thread(target=lookup) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.cache.hits + self.cache.misses, 8 * 500)
+        self.assertLessEqual(len(self.cache._entries), 20)
+
+
+class HeadersParsingTestCase(unittest.TestCase):
+    def test_rfc822_parse(self):
+        for eol in (b'\r\n', b'\n'):
+            message = eol.join([
+                b'From a@example.com Mon Jan 1 00:00:00 2016',
+                b'From: a@example.com', b'Subject: folded', b'\tsubject',
+                b'To: b@example.com', b'', b'Body', b''])
+            headers, body = rfc822_parse(message)
+            self.assertEqual(headers, [
+                [b'From', b' a@example.com\r\n'],
+                [b'Subject', b' folded\r\n\tsubject\r\n'],
+                [b'To', b' b@example.com\r\n']])
+            self.assertEqual(bytes(body), b'Body' + eol)
+
+    def test_select_headers(self):
+        headers = [
+            (b'Received', b'1'), (b'From', b'a'),
+            (b'received', b'2'), (b'Subject', b'b')]
+        index = index_headers(headers)
+        self.assertEqual(index, {
+            b'received': [0, 2], b'from': [1], b'subject': [3]})
+        self.assertEqual(
+            select_headers(
+                headers, [b'received', b'from', b'received', b'received'],
+                index=index),
+            [(b'received', b'2'), (b'From', b'a'), (b'Received', b'1')])
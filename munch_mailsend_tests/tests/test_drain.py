@@ -0,0 +1,68 @@
+from django.test import TestCase
+
+from munch_mailsend.amqp import drain_queue
+from munch_mailsend.amqp import get_task_signature
+
+
+class FakeMessage:
+    def __init__(self, delivery_tag, payload):
+        self.delivery_tag = delivery_tag
+        self.payload = payload
+
+
+class FakeQueue:
+    def __init__(self, payloads):
+        self.messages = [
+            FakeMessage(tag, payload)
+            for tag, payload in enumerate(payloads, 1)]
+
+    def bind(self, channel):
+        return self
+
+    def get(self, no_ack=False):
+        if self.messages:
+            return self.messages.pop(0)
+
+
+class FakeChannel:
+    def __init__(self):
+        self.acks = []
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acks.append((delivery_tag, multiple))
+
+
+class FakeApp:
+    class amqp:
+        @staticmethod
+        def TaskProducer(channel):
+            return 'producer'
+
+
+class DrainQueueTestCase(TestCase):
+    def test_drain_in_batches(self):
+        payloads = [
+            {'args': ['000{}'.format(i), {}, 0], 'kwargs': {'token': 't'}}
+            for i in range(5)]
+        channel = FakeChannel()
+        republished = []
+
+        def republish(producer, body):
+            republished.append((producer, body))
+
+        moved = drain_queue(
+            FakeApp, channel, FakeQueue(payloads), republish, batch_size=2)
+        self.assertEqual(moved, 5)
+        self.assertEqual(
+            [body for _, body in republished], payloads)
+        # One ack per batch
+        self.assertEqual(channel.acks, [(2, True), (4, True), (5, True)])
+
+    def test_task_signature(self):
+        self.assertEqual(
+            get_task_signature({
+                'args': ('0001', {}, 1), 'kwargs': {'version': 2}}),
+            (['0001', {}, 1], {'version': 2}))
+        self.assertEqual(
+            get_task_signature([('0001', {}, 1), {'version': 2}, {}]),
+            (['0001', {}, 1], {'version': 2}))
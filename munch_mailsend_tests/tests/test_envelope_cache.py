@@ -0,0 +1,46 @@
+from django.test import override_settings
+
+from munch_mailsend.models import Mail
+from munch_mailsend.models import RawMail
+from munch_mailsend.utils.tasks import cache_envelope
+from munch_mailsend.utils.tasks import get_cached_envelope
+from munch_mailsend.utils.tasks import delete_cached_envelope
+
+from . import MailSendTestCase
+
+
+class EnvelopeCacheTestCase(MailSendTestCase):
+    def create_mail(self, identifier):
+        raw_mail, _ = RawMail.objects.get_or_create(content='My Body\r\n')
+        return Mail.objects.create(
+            identifier=identifier, message=raw_mail,
+            sender='sender@example.com', recipient='you@example.com',
+            headers={
+                'To': 'you@example.com', 'From': 'sender@example.com',
+                'Subject': 'My Subject'})
+
+    def test_cache_envelope(self):
+        envelope = self.create_mail('0001').as_envelope()
+        self.assertIsNone(get_cached_envelope('0001'))
+        self.assertTrue(cache_envelope('0001', envelope))
+
+        cached = get_cached_envelope('0001')
+        self.assertEqual(cached.sender, envelope.sender)
+        self.assertEqual(cached.recipients, envelope.recipients)
+        self.assertEqual(cached.headers['Subject'], 'My Subject')
+        self.assertEqual(cached.message, envelope.message)
+
+        delete_cached_envelope('0001')
+        self.assertIsNone(get_cached_envelope('0001'))
+
+    def test_shared_body(self):
+        cache_envelope('0001', self.create_mail('0001').as_envelope())
+        cache_envelope('0002', self.create_mail('0002').as_envelope())
+        delete_cached_envelope('0001')
+        self.assertEqual(get_cached_envelope('0002').message, b'My Body\r\n')
+
+    def test_disabled(self):
+        envelope = self.create_mail('0001').as_envelope()
+        with override_settings(MAILSEND={'ENVELOPE_CACHE_TIMEOUT': 0}):
+            self.assertFalse(cache_envelope('0001', envelope))
+            self.assertIsNone(get_cached_envelope('0001'))
@@ -0,0 +1,110 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.test import override_settings
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from munch_mailsend.models import Mail
+from munch_mailsend.models import Worker
+from munch_mailsend.models import MailStatus
+from munch_mailsend.policies.mx import First
+from munch_mailsend.policies.mx import fair_share
+
+from . import MailSendTestCase
+
+conn = get_redis_connection('default')
+
+FAIR_SHARE_SETTINGS = {'max_queued': 600, 'min_queued': 60}
+
+MAILSEND = dict(
+    settings.MAILSEND,
+    WORKER_POLICIES=settings.MAILSEND['WORKER_POLICIES'] + [
+        'munch_mailsend.policies.mx.fair_share.Policy'],
+    WORKER_POLICIES_SETTINGS=dict(
+        settings.MAILSEND['WORKER_POLICIES_SETTINGS'],
+        fair_share=FAIR_SHARE_SETTINGS))
+
+USER_HEADER = settings.MAILSEND['X_USER_ID_HEADER']
+
+
+@override_settings(MAILSEND=MAILSEND)
+class FairSharePolicyTestCase(MailSendTestCase):
+    def setUp(self):
+        super().setUp()
+        Worker.objects.create(
+            name='worker_01', ip='10.0.0.1',
+            policies_settings={'fair_share': FAIR_SHARE_SETTINGS})
+        self.mails = []
+
+    def send(
+            self, user, status=MailStatus.SENDING, mail=None,
+            source_ip='10.0.0.1'):
+        if mail is None:
+            mail = Mail.objects.create(
+                identifier='{:04}'.format(len(self.mails)),
+                headers={'To': 'you@example.com', USER_HEADER: user},
+                recipient='you@example.com')
+            self.mails.append(mail)
+        MailStatus.objects.create(
+            destination_domain='example.com', mail=mail,
+            source_ip=source_ip, status=status)
+        return mail
+
+    def apply(self, user, minutes, weights=None):
+        headers = {'To': 'you@example.com', USER_HEADER: user}
+        workers = First().apply(
+            headers, not_before=timezone.now() + timedelta(minutes=minutes))
+        if weights:
+            for worker in workers:
+                worker['policies_settings']['fair_share'] = dict(
+                    FAIR_SHARE_SETTINGS, weights=weights)
+        return fair_share.Policy(
+            '9999', headers, MailStatus).apply(workers)
+
+    def test_single_user(self):
+        for _ in range(3):
+            self.send('1')
+        self.assertEqual(len(self.apply('1', 9)), 1)
+
+    def test_share(self):
+        for _ in range(3):
+            self.send('1')
+        self.send('2')
+        # User 1 holds 3 of 4 mails, more than its half
+        self.assertEqual(len(self.apply('1', 9)), 0)
+        self.assertEqual(len(self.apply('1', 2)), 1)
+        self.assertEqual(len(self.apply('2', 9)), 1)
+        # A new user is below its share
+        self.assertEqual(len(self.apply('3', 9)), 1)
+
+    def test_weights(self):
+        for _ in range(3):
+            self.send('1')
+        self.send('2')
+        self.assertEqual(len(self.apply('1', 9, weights={'1': 3})), 1)
+
+    def test_sent_mails(self):
+        mails = [self.send('1') for _ in range(3)]
+        self.send('2')
+        self.send('1', MailStatus.DELIVERED, mail=mails[0])
+        self.send('1', MailStatus.DELAYED, mail=mails[1])
+        self.assertEqual(len(self.apply('1', 9)), 1)
+
+    def test_worker_inflight_timeout(self):
+        Worker.objects.create(
+            name='worker_02', ip='10.0.0.2', policies_settings={
+                'fair_share': dict(
+                    FAIR_SHARE_SETTINGS, inflight_timeout=30)})
+        first = self.send('1')
+        second = self.send('1', source_ip='10.0.0.2')
+        key = fair_share.Policy.get_inflight_key('example.com', '1')
+        statuses = {
+            s.mail_id: s.creation_date.timestamp()
+            for s in MailStatus.objects.filter(status=MailStatus.SENDING)}
+        self.assertAlmostEqual(
+            conn.zscore(key, first.identifier) - statuses[first.id],
+            60 * 60, places=2)
+        self.assertAlmostEqual(
+            conn.zscore(key, second.identifier) - statuses[second.id],
+            30, places=2)
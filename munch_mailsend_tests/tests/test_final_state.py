@@ -0,0 +1,52 @@
+from django_redis import get_redis_connection
+
+from munch_mailsend.models import Mail
+from munch_mailsend.utils.tasks import get_final_state
+from munch_mailsend.utils.tasks import get_final_state_key
+
+from . import MailSendTestCase
+from ..models import MailStatus
+
+conn = get_redis_connection('default')
+
+
+class FinalStateTestCase(MailSendTestCase):
+    def create_status(self, mail, status):
+        return MailStatus.objects.create(
+            destination_domain='example.com', mail=mail,
+            source_ip='10.0.0.1', status=status)
+
+    def test_final_state(self):
+        mail = Mail.objects.create(
+            identifier='0001', headers={'To': 'you@example.com'},
+            recipient='you@example.com')
+        self.create_status(mail, MailStatus.QUEUED)
+        self.create_status(mail, MailStatus.SENDING)
+        self.assertIsNone(get_final_state('0001'))
+
+        self.create_status(mail, MailStatus.DELIVERED)
+        self.assertEqual(get_final_state('0001'), MailStatus.DELIVERED)
+
+    def test_deleted(self):
+        mail = Mail.objects.create(
+            identifier='0002', headers={'To': 'you@example.com'},
+            recipient='you@example.com')
+        self.create_status(mail, MailStatus.DELETED)
+        self.assertEqual(get_final_state('0002'), MailStatus.DELETED)
+
+    def test_missing_flag(self):
+        mail = Mail.objects.create(
+            identifier='0003', headers={'To': 'you@example.com'},
+            recipient='you@example.com')
+        self.create_status(mail, MailStatus.SENDING)
+        self.assertIsNone(get_final_state('0003', MailStatus))
+        self.create_status(mail, MailStatus.DELIVERED)
+        # Flag expired or never recorded
+        conn.delete(get_final_state_key('0003'))
+        self.assertIsNone(get_final_state('0003'))
+        self.assertEqual(
+            get_final_state('0003', MailStatus), MailStatus.DELIVERED)
+        # Flag is set back
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                get_final_state('0003', MailStatus), MailStatus.DELIVERED)
@@ -0,0 +1,84 @@
+from unittest import mock
+
+from django.test import override_settings
+from django.conf import settings
+
+from munch_mailsend.models import Mail
+from munch_mailsend.models import Worker
+from munch_mailsend.tasks import send_email
+from munch_mailsend.tasks import reroute_task
+from munch_mailsend.tasks import set_envelope_token
+from munch_mailsend.utils.lanes import get_lane
+from munch_mailsend.utils.lanes import get_lanes
+from munch_mailsend.utils.lanes import get_routing_options
+
+from . import MailSendTestCase
+
+LANES = [('system', 100), ('transactional', 60)]
+
+
+def mailsend_settings(**kwargs):
+    return dict(settings.MAILSEND, **kwargs)
+
+
+class PriorityLanesTestCase(MailSendTestCase):
+    def test_no_lanes(self):
+        self.assertIsNone(get_lane(100))
+        self.assertEqual(get_lanes(), [None])
+        self.assertEqual(get_routing_options(get_lane(100)), {})
+
+    def test_lanes(self):
+        with override_settings(MAILSEND=mailsend_settings(
+                PRIORITY_LANES=LANES)):
+            self.assertEqual(get_lane(100), 'system')
+            self.assertEqual(get_lane(60), 'transactional')
+            self.assertIsNone(get_lane(50))
+            self.assertIsNone(get_lane(None))
+            self.assertEqual(get_lanes(), ['system', 'transactional', None])
+            self.assertEqual(get_routing_options('transactional'), {
+                'routing_key': '{}:transactional'.format(
+                    settings.MAILSEND['ROUTING_QUEUE'])})
+
+    def test_worker_queue_names(self):
+        worker = Worker(name='worker_01', ip='10.0.0.1')
+        self.assertEqual(
+            worker.get_queue_name(),
+            settings.MAILSEND['MX_WORKER_QUEUE_PREFIX'].format(
+                ip='10.0.0.1'))
+        self.assertEqual(
+            worker.get_queue_name(retry=True, lane='system'),
+            '{}:system'.format(
+                settings.MAILSEND['MX_WORKER_QUEUE_RETRY_PREFIX'].format(
+                    ip='10.0.0.1')))
+
+    def test_reroute_keeps_lane(self):
+        with override_settings(MAILSEND=mailsend_settings(
+                PRIORITY_LANES=LANES)), mock.patch(
+                'munch_mailsend.tasks.route_envelope') as route_envelope:
+            reroute_task('producer', {
+                'args': ['0001', {}, 1],
+                'kwargs': {'token': 't', 'lane': 'system'}})
+        route_envelope.apply_async.assert_called_once_with(
+            ['0001', {}, 1], {'lane': 'system'}, producer='producer',
+            routing_key='{}:system'.format(
+                settings.MAILSEND['ROUTING_QUEUE']))
+
+    def test_send_email_on_non_mx_worker_keeps_lane(self):
+        Mail.objects.create(
+            identifier='0001', headers={'To': 'you@example.com'},
+            recipient='you@example.com')
+        with override_settings(MAILSEND=mailsend_settings(
+                PRIORITY_LANES=LANES)), mock.patch(
+                'munch_mailsend.tasks.worker_types', ['router']), mock.patch(
+                'munch_mailsend.tasks.delay_task') as delay_task:
+            send_email(
+                '0001', {'To': 'you@example.com'}, 0,
+                'munch_mailsend.models.MailStatus',
+                'munch_mailsend.utils.tasks.record_status',
+                'munch_mailsend.utils.tasks.get_envelope',
+                token=set_envelope_token('0001'), lane='system')
+        self.assertEqual(delay_task.call_count, 1)
+        args, kwargs = delay_task.call_args
+        self.assertEqual(args[2]['lane'], 'system')
+        self.assertEqual(kwargs['routing_key'], '{}:system'.format(
+            settings.MAILSEND['ROUTING_QUEUE']))
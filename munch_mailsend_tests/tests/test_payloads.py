@@ -0,0 +1,58 @@
+from django.test import override_settings
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from munch_mailsend.utils.payloads import TaskBackend
+from munch_mailsend.utils.payloads import PAYLOAD_VERSION
+from munch_mailsend.utils.payloads import encode_backend
+from munch_mailsend.utils.payloads import decode_backend
+from munch_mailsend.utils.payloads import get_routing_headers
+
+from . import MailSendTestCase
+
+BACKEND = TaskBackend(
+    'munch_mailsend.models.MailStatus',
+    'munch_mailsend.utils.tasks.record_status',
+    'munch_mailsend.utils.tasks.get_envelope')
+
+
+def mailsend_settings(**kwargs):
+    return dict(settings.MAILSEND, **kwargs)
+
+
+class TaskPayloadTestCase(MailSendTestCase):
+    def test_registered_backend(self):
+        with override_settings(MAILSEND=mailsend_settings(
+                TASK_BACKENDS={1: tuple(BACKEND)})):
+            kwargs = encode_backend(BACKEND)
+            self.assertEqual(
+                kwargs, {'backend': 1, 'version': PAYLOAD_VERSION})
+            self.assertEqual(decode_backend(**kwargs), BACKEND)
+
+    def test_unregistered_backend(self):
+        kwargs = encode_backend(BACKEND)
+        self.assertEqual(
+            kwargs['mailstatus_class_path'], BACKEND.mailstatus_class_path)
+        self.assertEqual(decode_backend(**kwargs), BACKEND)
+
+    def test_legacy_payload(self):
+        self.assertEqual(decode_backend(1, None, *BACKEND), BACKEND)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ImproperlyConfigured):
+            decode_backend(PAYLOAD_VERSION, 42)
+
+    def test_routing_headers(self):
+        pool_header = settings.MAILSEND['X_POOL_HEADER']
+        headers = {
+            'To': 'you@example.com', 'From': 'me@example.com',
+            'Subject': 'Hello', pool_header: 'default'}
+        self.assertEqual(
+            get_routing_headers(headers),
+            {'To': 'you@example.com', pool_header: 'default'})
+
+    def test_user_header(self):
+        user_header = settings.MAILSEND['X_USER_ID_HEADER']
+        self.assertEqual(
+            get_routing_headers({'To': 'you@example.com', user_header: '42'}),
+            {'To': 'you@example.com', user_header: '42'})
@@ -0,0 +1,111 @@
+import time
+import threading
+from unittest import mock
+
+from django.db import connection
+from django.db import transaction
+from django.test import TransactionTestCase
+
+from munch_mailsend.models import Mail
+from munch_mailsend.models import RawMail
+from munch_mailsend.models import RawMailDigest
+from munch_mailsend.utils.purge import purge_batch
+from munch_mailsend.utils.purge import get_purge_stats
+from munch_mailsend.utils.purge import _referenced_raw_mails
+
+from . import MailSendTestCase
+from ..models import MailStatus
+
+
+class PurgeRawMailTestCase(MailSendTestCase):
+    def create_mail(self, identifier, content):
+        with transaction.atomic():
+            raw_mail, _ = RawMailDigest.objects.get_or_create_raw_mail(
+                content)
+            return Mail.objects.create(
+                identifier=identifier, message=raw_mail,
+                headers={'To': 'you@example.com'},
+                recipient='you@example.com')
+
+    def set_status(self, mail, status):
+        MailStatus.objects.create(
+            destination_domain='example.com', mail=mail,
+            source_ip='10.0.0.1', status=status)
+
+    def test_purge(self):
+        mail_01 = self.create_mail('0001', 'My Body')
+        mail_02 = self.create_mail('0002', 'My Body')
+        mail_03 = self.create_mail('0003', 'My Other Body')
+
+        self.set_status(mail_01, MailStatus.DELIVERED)
+        self.set_status(mail_03, MailStatus.BOUNCED)
+        # Delivery path doesn't touch Mail rows anymore
+        mail_01.refresh_from_db()
+        self.assertIsNotNone(mail_01.message)
+        self.assertEqual(get_purge_stats()['pending'], 2)
+
+        self.assertEqual(purge_batch(), (2, 1))
+        mail_01.refresh_from_db()
+        mail_02.refresh_from_db()
+        self.assertIsNone(mail_01.message)
+        # Shared body is kept as long as a mail uses it
+        self.assertIsNotNone(mail_02.message)
+        self.assertEqual(RawMail.objects.count(), 1)
+        self.assertEqual(RawMailDigest.objects.count(), 1)
+
+        self.set_status(mail_02, MailStatus.DROPPED)
+        self.assertEqual(purge_batch(), (1, 1))
+        self.assertEqual(RawMail.objects.count(), 0)
+
+        stats = get_purge_stats()
+        self.assertEqual(stats['pending'], 0)
+        self.assertEqual(stats['mails_detached'], '3')
+        self.assertEqual(stats['raw_mails_deleted'], '2')
+
+    def test_nothing_to_purge(self):
+        self.create_mail('0001', 'My Body')
+        self.assertEqual(purge_batch(), (0, 0))
+
+
+class ConcurrentPurgeTestCase(TransactionTestCase):
+    tearDown = MailSendTestCase.tearDown
+    create_mail = PurgeRawMailTestCase.create_mail
+    set_status = PurgeRawMailTestCase.set_status
+
+    def test_reingest_during_purge(self):
+        self.set_status(
+            self.create_mail('0001', 'My Body'), MailStatus.DELIVERED)
+        locked = threading.Event()
+        results = {}
+
+        def referenced_raw_mails(raw_mail_ids):
+            locked.set()
+            # Let the re-ingest reach the locked digest
+            time.sleep(0.5)
+            return _referenced_raw_mails(raw_mail_ids)
+
+        def run(name, func, *args):
+            try:
+                results[name] = func(*args)
+            finally:
+                connection.close()
+
+        with mock.patch(
+                'munch_mailsend.utils.purge._referenced_raw_mails',
+                referenced_raw_mails):
+            purge = threading.Thread(
+                target=run, args=('purge', purge_batch))
+            purge.start()
+            self.assertTrue(locked.wait(5))
+            ingest = threading.Thread(target=run, args=(
+                'ingest', self.create_mail, '0002', 'My Body'))
+            ingest.start()
+            purge.join()
+            ingest.join()
+
+        self.assertEqual(results['purge'], (1, 1))
+        # Waited for the purge and stored the body again
+        mail = Mail.objects.get(identifier='0002')
+        self.assertEqual(RawMail.objects.count(), 1)
+        self.assertEqual(
+            RawMailDigest.objects.get().raw_mail_id, mail.message_id)
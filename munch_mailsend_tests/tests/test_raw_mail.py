@@ -0,0 +1,25 @@
+from munch_mailsend.models import RawMailDigest
+
+from . import MailSendTestCase
+
+
+class RawMailDigestTestCase(MailSendTestCase):
+    def test_deduplicate_content(self):
+        raw_mail_01, created = RawMailDigest.objects.get_or_create_raw_mail(
+            'My Body')
+        self.assertTrue(created)
+        raw_mail_02, created = RawMailDigest.objects.get_or_create_raw_mail(
+            'My Body')
+        self.assertFalse(created)
+        self.assertEqual(raw_mail_01.pk, raw_mail_02.pk)
+
+        raw_mail_03, created = RawMailDigest.objects.get_or_create_raw_mail(
+            'My Other Body')
+        self.assertTrue(created)
+        self.assertNotEqual(raw_mail_01.pk, raw_mail_03.pk)
+        self.assertEqual(RawMailDigest.objects.count(), 2)
+
+    def test_bytes_and_str_digest(self):
+        self.assertEqual(
+            RawMailDigest.objects.get_digest('My Body'),
+            RawMailDigest.objects.get_digest(b'My Body'))
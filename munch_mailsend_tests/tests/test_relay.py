@@ -1,6 +1,7 @@
 from django.test import override_settings
 
 from munch_mailsend.relay import MxSmtpRelay
+from munch_mailsend.utils import normalize_line_endings
 
 from . import MailSendTestCase
 
@@ -15,3 +16,14 @@ class RelayTestCase(MailSendTestCase):
     def test_override_relay_ehlo(self):
         relay = MxSmtpRelay()
         self.assertEqual(relay._client_kwargs['ehlo_as'], 'test12')
+
+
+class NormalizeLineEndingsTestCase(MailSendTestCase):
+    def test_bare_lf(self):
+        self.assertEqual(
+            normalize_line_endings(b'a\nb\r\nc\n\n'),
+            b'a\r\nb\r\nc\r\n\r\n')
+
+    def test_already_normalized(self):
+        message = b'a\r\nb\r\n\xe9\r\n'
+        self.assertIs(normalize_line_endings(message), message)
@@ -0,0 +1,159 @@
+import os
+import shutil
+import tempfile
+import threading
+import subprocess
+from unittest import mock
+
+from django.db.models.signals import post_save
+
+from munch_mailsend.models import Mail
+from munch_mailsend.utils.sink import MailStatusSink
+from munch_mailsend.utils.sink import get_spool_path
+from munch_mailsend.utils.tasks import get_final_state
+
+from . import MailSendTestCase
+from ..models import MailStatus
+
+
+class MailStatusSinkTestCase(MailSendTestCase):
+    def setUp(self):
+        super().setUp()
+        self.spool_dir = tempfile.mkdtemp()
+        self.spool_path = os.path.join(self.spool_dir, 'statuses.spool')
+        for identifier in ('0001', '0002'):
+            Mail.objects.create(
+                identifier=identifier, headers={'To': 'you@example.com'},
+                recipient='you@example.com')
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+        super().tearDown()
+
+    def add(self, sink, identifier, status):
+        sink.add(MailStatus(
+            status=status, destination_domain='example.com'), identifier)
+
+    def test_batch(self):
+        sink = MailStatusSink(
+            MailStatus, batch_size=2, flush_interval=None)
+        self.add(sink, '0001', MailStatus.DELIVERED)
+        # Redis state is up to date before the database
+        self.assertEqual(get_final_state('0001'), MailStatus.DELIVERED)
+        self.assertEqual(MailStatus.objects.count(), 0)
+
+        self.add(sink, '0002', MailStatus.DELAYED)
+        self.assertEqual(MailStatus.objects.count(), 2)
+        self.assertEqual(
+            MailStatus.objects.get(mail__identifier='0001').status,
+            MailStatus.DELIVERED)
+
+    def test_flush(self):
+        sink = MailStatusSink(
+            MailStatus, batch_size=10, flush_interval=None)
+        self.add(sink, '0001', MailStatus.DELAYED)
+        self.add(sink, 'unknown', MailStatus.DELAYED)
+        self.assertEqual(sink.flush(), 1)
+        self.assertEqual(sink.flush(), 0)
+        self.assertEqual(MailStatus.objects.count(), 1)
+
+    def test_spool_recovery(self):
+        sink = MailStatusSink(
+            MailStatus, batch_size=10, flush_interval=None,
+            spool_path=self.spool_path)
+        self.add(sink, '0001', MailStatus.DELAYED)
+        self.add(sink, '0002', MailStatus.DELAYED)
+        self.assertEqual(MailStatus.objects.count(), 0)
+
+        # Process died before flushing
+        MailStatusSink(
+            MailStatus, batch_size=10, flush_interval=None,
+            spool_path=self.spool_path)
+        self.assertEqual(MailStatus.objects.count(), 2)
+
+    def test_spool_truncated_after_flush(self):
+        sink = MailStatusSink(
+            MailStatus, batch_size=10, flush_interval=None,
+            spool_path=self.spool_path)
+        self.add(sink, '0001', MailStatus.DELAYED)
+        sink.flush()
+        self.assertEqual(os.path.getsize(self.spool_path), 0)
+
+    def test_flush_interval(self):
+        sink = MailStatusSink(MailStatus, batch_size=10, flush_interval=500)
+        with mock.patch(
+                'munch_mailsend.utils.sink.time.monotonic',
+                side_effect=[100, 100, 100.6]):
+            self.add(sink, '0001', MailStatus.DELAYED)
+            self.assertEqual(MailStatus.objects.count(), 0)
+            # Flushed by the next status, no background thread involved
+            self.add(sink, '0002', MailStatus.DELAYED)
+            self.assertEqual(MailStatus.objects.count(), 2)
+
+    def test_post_save_mail(self):
+        instances = []
+
+        def receiver(sender, instance, **kwargs):
+            instances.append(instance)
+
+        post_save.connect(receiver, sender=MailStatus)
+        self.addCleanup(post_save.disconnect, receiver, sender=MailStatus)
+        sink = MailStatusSink(MailStatus, batch_size=10, flush_interval=None)
+        self.add(sink, '0001', MailStatus.DELIVERED)
+        self.add(sink, '0002', MailStatus.BOUNCED)
+        sink.flush()
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [i.mail.identifier for i in instances], ['0001', '0002'])
+        self.assertEqual(
+            [i.mail_id for i in instances], [
+                Mail.objects.get(identifier=identifier).pk
+                for identifier in ('0001', '0002')])
+
+    def test_flusher_thread(self):
+        sink = MailStatusSink(MailStatus, batch_size=10, flush_interval=10)
+        flushed = threading.Event()
+
+        def flush():
+            if threading.current_thread().name == 'mailstatus-sink':
+                flushed.set()
+
+        with mock.patch.object(sink, 'flush', side_effect=flush):
+            self.add(sink, '0001', MailStatus.DELAYED)
+            sink.start()
+            # An idle worker still writes its pending statuses
+            self.assertTrue(flushed.wait(5))
+            sink.stop()
+        sink._flusher.join(5)
+        self.assertFalse(sink._flusher.is_alive())
+
+    def test_dead_process_spool_recovery(self):
+        process = subprocess.Popen(['true'])
+        process.wait()
+        dead_path = get_spool_path(MailStatus, self.spool_dir, process.pid)
+        sink = MailStatusSink(
+            MailStatus, batch_size=10, flush_interval=None,
+            spool_path=dead_path)
+        self.add(sink, '0001', MailStatus.DELAYED)
+        self.add(sink, '0002', MailStatus.DELAYED)
+
+        sink = MailStatusSink(
+            MailStatus, batch_size=10, flush_interval=None,
+            spool_path=get_spool_path(MailStatus, self.spool_dir))
+        self.assertEqual(sink.recover_dead_spools(), 2)
+        self.assertEqual(MailStatus.objects.count(), 2)
+        self.assertFalse(os.path.exists(dead_path))
+
+    def test_live_process_spool_ignored(self):
+        live_path = get_spool_path(MailStatus, self.spool_dir, os.getppid())
+        sink = MailStatusSink(
+            MailStatus, batch_size=10, flush_interval=None,
+            spool_path=live_path)
+        self.add(sink, '0001', MailStatus.DELAYED)
+
+        sink = MailStatusSink(
+            MailStatus, batch_size=10, flush_interval=None,
+            spool_path=get_spool_path(MailStatus, self.spool_dir))
+        self.assertEqual(sink.recover_dead_spools(), 0)
+        self.assertEqual(MailStatus.objects.count(), 0)
+        self.assertTrue(os.path.exists(live_path))
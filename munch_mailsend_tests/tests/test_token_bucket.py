@@ -0,0 +1,209 @@
+from unittest import mock
+
+import dns.resolver
+from django.conf import settings
+from django.test import override_settings
+from libfaketime import fake_time
+from django_redis import get_redis_connection
+
+from munch_mailsend.models import Worker
+from munch_mailsend.models import MailStatus
+from munch_mailsend.policies.mx import First
+from munch_mailsend.policies.mx import token_bucket
+from munch_mailsend.utils.buckets import get_windows
+from munch_mailsend.utils.buckets import bucket_call
+from munch_mailsend.policies.mx.token_bucket import get_mx_host
+
+from . import MailSendTestCase
+
+conn = get_redis_connection('default')
+
+TOKEN_BUCKET_SETTINGS = {
+    'domains': [
+        (r'.*example\.com', [(1, 10, 2), (3, 60 * 60)]),
+        (r'.*', [(1, 1)])],
+    'max_queued': 60}
+
+MAILSEND = dict(
+    settings.MAILSEND,
+    WORKER_POLICIES=['munch_mailsend.policies.mx.token_bucket.Policy'],
+    WORKER_POLICIES_SETTINGS={'token_bucket': TOKEN_BUCKET_SETTINGS})
+
+
+class BucketsTestCase(MailSendTestCase):
+    def test_get_windows(self):
+        domains = TOKEN_BUCKET_SETTINGS['domains']
+        self.assertEqual(
+            get_windows(domains, 'example.com'), [(1, 10, 2), (3, 3600)])
+        self.assertEqual(get_windows(domains, 'example.org'), [(1, 1)])
+        self.assertEqual(get_windows([], 'example.org'), [])
+
+    def test_burst(self):
+        windows = [(1, 10, 2)]
+        for _ in range(2):
+            self.assertEqual(float(bucket_call(
+                [('ms:test', windows)], 1000, reserve=True)), 1000)
+        self.assertEqual(
+            float(bucket_call([('ms:test', windows)], 1000)), 1010)
+        self.assertEqual(
+            float(bucket_call([('ms:test', windows)], 1015)), 1015)
+
+    def test_stacked_windows(self):
+        buckets = [('ms:test', [(1, 1), (2, 60)])]
+        self.assertEqual(
+            float(bucket_call(buckets, 1000, reserve=True)), 1000)
+        self.assertEqual(
+            float(bucket_call(buckets, 1000, reserve=True)), 1001)
+        # Second window is now empty until a token comes back
+        self.assertEqual(float(bucket_call(buckets, 1002)), 1030)
+
+    def test_windows_of_same_period(self):
+        buckets = [('ms:test', [(10, 60), (1, 60)])]
+        self.assertEqual(
+            float(bucket_call(buckets, 1000, reserve=True)), 1000)
+        # Each window has its own state despite sharing their period
+        self.assertEqual(float(bucket_call(buckets, 1000)), 1060)
+
+    def test_stacked_buckets(self):
+        buckets = [('ms:test:ip1', [(1, 1)]), ('ms:test:global', [(1, 10)])]
+        self.assertEqual(
+            float(bucket_call(buckets, 1000, reserve=True)), 1000)
+        # Another IP shares the global bucket
+        self.assertEqual(float(bucket_call(
+            [('ms:test:ip2', [(1, 1)]), ('ms:test:global', [(1, 10)])],
+            1000)), 1010)
+
+
+def find_worker(to):
+    return Worker.objects.find_worker('0001', {'To': to}, MailStatus)[:2]
+
+
+@override_settings(MAILSEND=MAILSEND)
+class TokenBucketPolicyTestCase(MailSendTestCase):
+    def test_policy(self):
+        Worker.objects.create(
+            name='worker_01', ip='10.0.0.1',
+            policies_settings={'token_bucket': TOKEN_BUCKET_SETTINGS})
+
+        with fake_time('2016-10-10 08:00:00'):
+            # Tokens are reserved when routing, in burst then every 10s
+            for expected in ('08:00:00', '08:00:00', '08:00:10'):
+                worker, next_available = find_worker('you@example.com')
+                self.assertEqual(worker.ip, '10.0.0.1')
+                self.assertEqual(
+                    next_available.isoformat(),
+                    '2016-10-10T{}+00:00'.format(expected))
+            # Hourly window is exhausted, too far for max_queued
+            self.assertEqual(
+                find_worker('you@example.com'), (None, None))
+
+    def test_peek(self):
+        Worker.objects.create(
+            name='worker_01', ip='10.0.0.1',
+            policies_settings={'token_bucket': TOKEN_BUCKET_SETTINGS})
+        with fake_time('2016-10-10 08:00:00'):
+            for _ in range(3):
+                worker = token_bucket.Policy(
+                    '0002', {'To': 'you@example.com'}, MailStatus).apply(
+                        First().apply({'To': 'you@example.com'}))[0]
+                # Ranking workers doesn't take any token
+                self.assertEqual(
+                    worker['next_available'].isoformat(),
+                    '2016-10-10T08:00:00+00:00')
+
+    def test_worker_settings(self):
+        # Only the worker has a limit for this domain
+        Worker.objects.create(
+            name='worker_01', ip='10.0.0.1',
+            policies_settings={'token_bucket': {
+                'domains': [(r'example\.org', [(1, 60)])],
+                'max_queued': 60 * 5}})
+
+        with fake_time('2016-10-10 08:00:00'):
+            find_worker('you@example.org')
+            self.assertEqual(
+                find_worker('you@example.org')[1].isoformat(),
+                '2016-10-10T08:01:00+00:00')
+
+    def test_global_rate_limits(self):
+        mailsend = dict(MAILSEND, GLOBAL_RATE_LIMITS={
+            'domains': [(r'example\.com', [(1, 60)])]})
+        for i in (1, 2):
+            Worker.objects.create(
+                name='worker_0{}'.format(i), ip='10.0.0.{}'.format(i),
+                policies_settings={'token_bucket': {
+                    'domains': [(r'.*', [(10, 1)])], 'max_queued': 120}})
+
+        with override_settings(MAILSEND=mailsend), \
+                fake_time('2016-10-10 08:00:00'):
+            worker, next_available = find_worker('you@example.com')
+            self.assertEqual(
+                next_available.isoformat(), '2016-10-10T08:00:00+00:00')
+            workers = token_bucket.Policy(
+                '0002', {'To': 'you@example.com'}, MailStatus).apply(
+                    First().apply({'To': 'you@example.com'}))
+            # Even the idle worker has to wait for the domain limit
+            self.assertEqual(
+                {w['next_available'].isoformat() for w in workers},
+                {'2016-10-10T08:01:00+00:00'})
+            self.assertEqual(
+                find_worker('you@example.com')[1].isoformat(),
+                '2016-10-10T08:01:00+00:00')
+
+
+def mx_answer(*records):
+    return [
+        mock.Mock(preference=preference, exchange='{}.'.format(exchange))
+        for preference, exchange in records]
+
+
+class MXBucketTestCase(MailSendTestCase):
+    def get_ttl(self, domain):
+        return conn.ttl('{}:mx:{}'.format(token_bucket.CACHE_PREFIX, domain))
+
+    @mock.patch('dns.resolver.query')
+    def test_get_mx_host(self, query):
+        query.return_value = mx_answer(
+            (20, 'MX2.example.net'), (10, 'MX1.example.net'))
+        self.assertEqual(get_mx_host('example.com'), 'mx1.example.net')
+        self.assertEqual(get_mx_host('example.com'), 'mx1.example.net')
+        query.assert_called_once_with(
+            'example.com', 'MX', lifetime=token_bucket.MX_RESOLVE_TIMEOUT)
+        self.assertGreater(
+            self.get_ttl('example.com'),
+            token_bucket.MX_NEGATIVE_CACHE_TIMEOUT)
+
+    @mock.patch('dns.resolver.query')
+    def test_get_mx_host_failure(self, query):
+        query.side_effect = dns.resolver.Timeout()
+        self.assertEqual(get_mx_host('example.com'), 'example.com')
+        # Failures are retried soon
+        self.assertLessEqual(
+            self.get_ttl('example.com'),
+            token_bucket.MX_NEGATIVE_CACHE_TIMEOUT)
+
+    @mock.patch('dns.resolver.query')
+    def test_mx_buckets(self, query):
+        query.return_value = mx_answer((10, 'mx.shared.example.net'))
+        mailsend = dict(MAILSEND, GLOBAL_RATE_LIMITS={'mx': [
+            (r'mx\.shared\.', [(1, 60)])]})
+        for i in (1, 2):
+            Worker.objects.create(
+                name='worker_0{}'.format(i), ip='10.0.0.{}'.format(i),
+                policies_settings={'token_bucket': {
+                    'domains': [(r'.*', [(10, 1)])], 'max_queued': 120}})
+
+        with override_settings(MAILSEND=mailsend), \
+                fake_time('2016-10-10 08:00:00'):
+            self.assertEqual(
+                token_bucket.get_global_buckets('example.com'), [(
+                    '{}:token_bucket:global:mx:mx.shared.example.net'.format(
+                        token_bucket.CACHE_PREFIX), [(1, 60)])])
+            self.assertEqual(
+                find_worker('you@example.com')[1].isoformat(),
+                '2016-10-10T08:00:00+00:00')
+            # Another domain hosted by the same MX shares its bucket,
+            # although it is routed under another lock
+            self.assertEqual(
+                find_worker('you@example.org')[1].isoformat(),
+                '2016-10-10T08:01:00+00:00')
@@ -1,3 +1,5 @@
+import time
+
 from munch_mailsend.models import Worker
 from munch_mailsend.policies.mx import First
 
@@ -14,3 +16,31 @@ class WorkersTestCase(MailSendTestCase):
         Worker.objects.clear_cache()
         workers = First().apply({})
         self.assertEqual(len(workers), 2)
+
+    def test_get_from_cache_by_ip(self):
+        Worker.objects.create(
+            name='worker_01', ip='10.0.0.1',
+            policies_settings={'pool': {'pools': ['other']}})
+        self.assertEqual(
+            Worker.objects.get_from_cache(ip='10.0.0.1')['policies_settings'],
+            {'pool': {'pools': ['other']}})
+        self.assertIsNone(Worker.objects.get_from_cache(ip='10.0.0.2'))
+
+    def test_stale_heartbeat(self):
+        Worker.objects.create(name='worker_01', ip='10.0.0.1')
+        Worker.objects.create(name='worker_02', ip='10.0.0.2')
+        Worker.objects.create(name='worker_03', ip='10.0.0.3')
+
+        now = time.time()
+        Worker.objects.send_heartbeat('10.0.0.1', now=now - 5)
+        Worker.objects.send_heartbeat('10.0.0.2', now=now - 60)
+        # worker_03 never sent any heartbeat (eg. not upgraded yet)
+        self.assertEqual(
+            Worker.objects.get_stale_ips(timeout=30, now=now), {'10.0.0.2'})
+
+        workers = First().apply({})
+        self.assertEqual(
+            sorted(w['ip'] for w in workers), ['10.0.0.1', '10.0.0.3'])
+
+        Worker.objects.send_heartbeat('10.0.0.2')
+        self.assertEqual(len(First().apply({})), 3)
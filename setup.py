@@ -33,7 +33,10 @@ setup(
         'tests': [
             'flake8==2.5.4',
             'bumpversion==0.5.3',
-            'libfaketime==0.2.1']},
+            'libfaketime==0.2.1',
+            # Benchmarks (MAILSEND_BENCHMARK_FAKEREDIS=1)
+            'fakeredis==0.9.0',
+            'lupa==1.5']},
     classifiers=[
         'Environment :: Web Environment',
         'Framework :: Django',